@@ -0,0 +1,51 @@
+package my;
+
+import java.util.List;
+
+import mpicbg.models.PointMatch;
+
+/**
+ * Sum the weighted second moments of many point matches at once,
+ * for assembling the normal equations of a linear least-squares problem.
+ */
+public final class PointMatchMoments
+{
+	/**
+	 * With p and q the local coordinates of the two points of a match, extended with a 1,
+	 * and w its weight, add to pp, pq and qq the sums of w * p * p^T, w * p * q^T and w * q * q^T.
+	 *
+	 * @param pointmatches The point matches.
+	 * @param n The number of dimensions of the points plus one.
+	 * @param pp The n x n matrix in row-major order to add the sum of w * p * p^T to.
+	 * @param pq The n x n matrix in row-major order to add the sum of w * p * q^T to.
+	 * @param qq The n x n matrix in row-major order to add the sum of w * q * q^T to.
+	 */
+	static public final void moments(
+			final List<PointMatch> pointmatches,
+			final int n,
+			final double[] pp,
+			final double[] pq,
+			final double[] qq)
+	{
+		final double[] p = new double[n];
+		final double[] q = new double[n];
+		p[n - 1] = 1.0;
+		q[n - 1] = 1.0;
+		for (int i = 0, size = pointmatches.size(); i < size; ++i) {
+			final PointMatch pm = pointmatches.get(i);
+			final double w = pm.getWeight();
+			System.arraycopy(pm.getP1().getL(), 0, p, 0, n - 1);
+			System.arraycopy(pm.getP2().getL(), 0, q, 0, n - 1);
+			for (int a = 0; a < n; ++a) {
+				final double wpa = w * p[a];
+				final double wqa = w * q[a];
+				for (int b = 0; b < n; ++b) {
+					final int k = a * n + b;
+					pp[k] += wpa * p[b];
+					pq[k] += wpa * q[b];
+					qq[k] += wqa * q[b];
+				}
+			}
+		}
+	}
+}
@@ -0,0 +1,30 @@
+package my;
+
+/**
+ * Average many regions of the same flat array at once,
+ * each region defined by a list of indices into the array.
+ */
+public final class RegionMeans
+{
+	/**
+	 * @param volume The flat pixel array, e.g. of a 3D volume in XYZ order.
+	 * @param offsets The indices into volume of all regions, concatenated.
+	 * @param starts For each region, where its indices start in offsets; plus one last value for the end.
+	 * @param means Where to store the mean of each region; its length is the number of regions.
+	 */
+	static public final void measure(
+			final float[] volume,
+			final int[] offsets,
+			final int[] starts,
+			final float[] means)
+	{
+		for (int i = 0; i < means.length; ++i) {
+			final int end = starts[i + 1];
+			double sum = 0;
+			for (int k = starts[i]; k < end; ++k) {
+				sum += volume[offsets[k]];
+			}
+			means[i] = (float)(sum / (end - starts[i]));
+		}
+	}
+}
@@ -56,6 +56,7 @@ paramsTileConfiguration = {
   "maxPlateauwidth": 200, # Like in TrakEM2
   "maxIterations": 2, # Saalfeld recommends 1000 -- here, 2 iterations (!!) shows the lowest mean and max error for dataset FIBSEM_L1116
   "damp": 1.0, # Saalfeld recommends 1.0, which means no damp
+  "solver": "linear", # solve directly, exactly: maxIterations etc. are then only for the fallback TileConfiguration
 }
 
 # Parameters for SIFT features, in case blockmatching fails due to large translation
@@ -431,3 +431,63 @@ def makeCompositeToRealConverter(reducer_class=Math,
     classloader = CustomClassLoader()
   return classloader.defineClass(class_name, cw.toByteArray())
 
+
+
+def makeRealToRealConverter(function_class=Math,
+                            function_method="sqrt",
+                            function_method_signature="(D)D",
+                            classloader=None):
+  """
+  Takes a RealType as input and converts it into another RealType,
+  by applying a static function of one double argument to its value.
+  function_class: e.g. Math
+  function_method: e.g. "sqrt", a method that takes a double and returns another.
+  function_method_signature: e.g. "(D)D", one double argument, returning a double.
+  """
+  class_name = "my/RealToRealConverterVia_" + function_class.getName().replace('.', '_') + '_' + function_method
+  # Turn e.g. class Math into "java/lang/Math":
+  function_class_string = function_class.getName().replace('.', '/')
+
+  cw = ClassWriter(0)
+
+  cw.visit(52, Opcodes.ACC_PUBLIC + Opcodes.ACC_SUPER, class_name, "<S::Lnet/imglib2/type/numeric/RealType<TS;>;T::Lnet/imglib2/type/numeric/RealType<TT;>;>Ljava/lang/Object;Lnet/imglib2/converter/Converter<TS;TT;>;", "java/lang/Object", ["net/imglib2/converter/Converter"])
+
+
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC, "<init>", "()V", None, None)
+  mv.visitCode()
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitMethodInsn(Opcodes.INVOKESPECIAL, "java/lang/Object", "<init>", "()V", False)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(1, 1)
+  mv.visitEnd()
+
+
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC + Opcodes.ACC_FINAL, "convert", "(Lnet/imglib2/type/numeric/RealType;Lnet/imglib2/type/numeric/RealType;)V", "(TS;TT;)V", None)
+  mv.visitCode()
+  mv.visitVarInsn(Opcodes.ALOAD, 2)
+  mv.visitVarInsn(Opcodes.ALOAD, 1)
+  mv.visitMethodInsn(Opcodes.INVOKEINTERFACE, "net/imglib2/type/numeric/RealType", "getRealDouble", "()D", True)
+  mv.visitMethodInsn(Opcodes.INVOKESTATIC, function_class_string, function_method, function_method_signature, False)
+  mv.visitMethodInsn(Opcodes.INVOKEINTERFACE, "net/imglib2/type/numeric/RealType", "setReal", "(D)V", True)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(3, 3)
+  mv.visitEnd()
+
+
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC + Opcodes.ACC_BRIDGE + Opcodes.ACC_SYNTHETIC, "convert", "(Ljava/lang/Object;Ljava/lang/Object;)V", None, None)
+  mv.visitCode()
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitVarInsn(Opcodes.ALOAD, 1)
+  mv.visitTypeInsn(Opcodes.CHECKCAST, "net/imglib2/type/numeric/RealType")
+  mv.visitVarInsn(Opcodes.ALOAD, 2)
+  mv.visitTypeInsn(Opcodes.CHECKCAST, "net/imglib2/type/numeric/RealType")
+  mv.visitMethodInsn(Opcodes.INVOKEVIRTUAL, class_name, "convert", "(Lnet/imglib2/type/numeric/RealType;Lnet/imglib2/type/numeric/RealType;)V", False)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(3, 3)
+  mv.visitEnd()
+
+  cw.visitEnd()
+
+  if not classloader:
+    classloader = CustomClassLoader()
+  return classloader.defineClass(class_name, cw.toByteArray())
@@ -1,59 +1,173 @@
 from __future__ import with_statement
-import sys, os, csv
+import sys, os, csv, math
 from lib.ui import showStack, wrap, showAsComposite
 from lib.nuclei import findPeaks, mergePeaks, filterNuclei, findNucleiByMaxProjection
+from lib.util import newFixedThreadPool, Task, numCPUs
+from lib.measurement_asm import createNativeRegionMeansClass
+from lib.timeseries import TimeSeries, TimeSeriesWriter, saveTimeSeries, savePeaks, loadPeaks
+from lib.features import artifactKey
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.algorithm.math.ImgMath import compute, minimum, add, sub, div, IF, THEN, ELSE, EQ
+from net.imglib2.algorithm.math import ImgSource
+from net.imglib2 import RealPoint, FinalInterval
 from net.imglib2.util import Intervals
+from java.lang import System, ThreadLocal
+from java.math import BigInteger
+from java.security import MessageDigest
+from bisect import bisect_left, insort
+from collections import deque
 from net.imglib2.view import Views
-from net.imglib2.roi.geom.real import ClosedWritableSphere
-from net.imglib2.roi import Masks, Regions
 from itertools import islice, izip
 from jarray import zeros, array
 
 
-def measureFluorescence(tgtDir, series_name, img4D, params, mask=None, showDetections=True):
+RegionMeans = createNativeRegionMeansClass()
+
+# Parameters that determine the peaks, see nuclei.py:findNucleiByMaxProjection
+PEAK_PARAM_NAMES = ["minPeakValue", "sigmaSmaller", "sigmaLarger", "calibration"]
+
+
+def maskSignature(mask):
+  """ The dimensions of the 3D mask plus the SHA-1 digest of which of its voxels are nonzero,
+      read one plane at a time, as a string. """
+  dims = Intervals.dimensionsAsLongArray(mask)
+  digest = MessageDigest.getInstance("SHA-1")
+  plane = zeros(dims[0] * dims[1], 'b')
+  target = ArrayImgs.unsignedBytes(plane, dims[0], dims[1])
+  mask = Views.zeroMin(mask)
+  for z in xrange(dims[2]):
+    compute(IF(EQ(0, ImgSource(Views.hyperSlice(mask, 2, z))), THEN(0), ELSE(1))).into(target)
+    digest.update(plane)
+  return "%s:%s" % ("x".join(str(d) for d in dims), BigInteger(1, digest.digest()).toString(16))
+
+
+def sphereOffsets(peaks, radius, interval):
+  """
+  For each peak, find the voxels of interval within radius of the peak,
+  as with a ClosedWritableSphere, and express them as indices into
+  the flat array of a copy of interval in XYZ order.
+  Voxels outside the interval are ignored.
+
+  peaks: list of RealLocalizable.
+  radius: the radius of the spheres, in pixels.
+  interval: the 3D volume to measure.
+
+  Returns two int arrays: the concatenated offsets of all spheres,
+  and for each sphere the index of its first offset, plus one last value
+  with the total number of offsets.
+  """
+  mins = [interval.min(d) for d in xrange(3)]
+  dims = [interval.dimension(d) for d in xrange(3)]
+  width, plane = dims[0], dims[0] * dims[1]
+  radius_sq = radius * radius
+  offsets = []
+  starts = [0]
+  for peak in peaks:
+    center = [peak.getDoublePosition(d) - mins[d] for d in xrange(3)]
+    lower = [max(0, int(math.ceil(c - radius))) for c in center]
+    upper = [min(dims[d] - 1, int(math.floor(center[d] + radius))) for d in xrange(3)]
+    for z in xrange(lower[2], upper[2] + 1):
+      dz_sq = (z - center[2]) * (z - center[2])
+      for y in xrange(lower[1], upper[1] + 1):
+        dyz_sq = dz_sq + (y - center[1]) * (y - center[1])
+        for x in xrange(lower[0], upper[0] + 1):
+          if dyz_sq + (x - center[0]) * (x - center[0]) <= radius_sq:
+            offsets.append(x + y * width + z * plane)
+    starts.append(len(offsets))
+  return array(offsets, 'i'), array(starts, 'i')
+
+
+def sphereGroups(peaks, radius, interval, max_voxels=pow(2, 26)):
+  """
+  Group the spheres around the peaks, in order of their Z coordinate, so that the bounding box
+  of each group holds at most max_voxels (or the sphere alone when larger),
+  and find the voxels of each sphere as indices into the flat array of a copy of its group's box.
+  See sphereOffsets.
+
+  peaks: list of RealLocalizable.
+  radius: the radius of the spheres, in pixels.
+  interval: the 3D volume to measure.
+  max_voxels: defaults to 2^26, which also keeps the indices within the range of an int.
+
+  Returns a list of tuples, one per group, with the indices of its peaks in the list of peaks,
+  its bounding box as a FinalInterval, and the offsets and starts of its spheres.
   """
-  srcDir: the directory containing the CSV files and max intensity projection .zip file.
+  mins = [interval.min(d) for d in xrange(3)]
+  maxs = [interval.max(d) for d in xrange(3)]
+  # The box of each sphere, clipped to the interval, like in sphereOffsets
+  boxes = []
+  for peak in peaks:
+    center = [peak.getDoublePosition(d) for d in xrange(3)]
+    boxes.append(([max(mins[d], int(math.ceil(center[d] - radius))) for d in xrange(3)],
+                  [min(maxs[d], int(math.floor(center[d] + radius))) for d in xrange(3)]))
+
+  def volume(lower, upper):
+    return reduce(lambda a, b: a * b, (max(0, u - l + 1) for l, u in izip(lower, upper)), 1)
+
+  groups = []
+  indices, lower, upper = [], None, None
+  for i in sorted(xrange(len(peaks)), key=lambda i: peaks[i].getDoublePosition(2)):
+    lo, up = boxes[i]
+    if 0 == volume(lo, up):
+      # Sphere outside the interval: no voxels, but still measured, as a mean over no voxels
+      indices.append(i)
+      continue
+    if lower is None:
+      lower, upper = lo, up
+    else:
+      lower2 = map(min, lower, lo)
+      upper2 = map(max, upper, up)
+      if volume(lower2, upper2) > max_voxels:
+        groups.append((indices, lower, upper))
+        indices, lower, upper = [], lo, up
+      else:
+        lower, upper = lower2, upper2
+    indices.append(i)
+  if indices:
+    groups.append((indices, lower or mins, upper or mins))
+
+  result = []
+  for indices, lower, upper in groups:
+    box = FinalInterval(array(lower, 'l'), array(upper, 'l'))
+    offsets, starts = sphereOffsets([peaks[i] for i in indices], radius, box)
+    result.append((indices, box, offsets, starts))
+  return result
+
+
+def measureFluorescence(tgtDir, series_name, img4D, params, mask=None, showDetections=True, n_threads=0, prefetch=2):
+  """
+  srcDir: the directory containing the time series files and max intensity projection .zip file.
   series_name: the name or title, to be used for e.g. writing (and finding to load when it exists)
                a .zip file with the max intensity projection used for detecting nuclei,
-               and for the .csv file containing the fluorescence measurements.
+               and for the files containing the coordinates of the nuclei, "<series_name>_peaks.<key>.bin",
+               and the fluorescence measurements, "<series_name>_fluorescence.<key>.bin" (see timeseries.py:TimeSeries).
+               The key of the peaks is the artifactKey of the PEAK_PARAM_NAMES and of the mask (see maskSignature),
+               and that of the fluorescence, of the "somaDiameter" and the coordinates of the peaks:
+               an interrupted measurement is resumed only for the same peaks and measurement radius.
+               A "<series_name>_fluorescence.csv" from earlier versions is read when present,
+               unless there are peaks for the params.
   img4D: the ImgLib2 data (ideally e.g. an N5 volume for fast access).
   params: the dictionary of parameters for detecting nuclei with difference of Gaussian.
           See nuclei.py:findNucleiByMaxProjection for the parameter keys.
   mask: optional, defaults to None. If it exists, it is a 3D volume with zero for space to ignore
         nuclei detections, and non-zero otherwise.
+  n_threads: the number of timepoints to measure in parallel; zero means as many as CPU cores.
+  prefetch: the number of additional timepoints to measure ahead of those being written to the store.
+            Each thread reads only the bounding boxes of groups of spheres (see sphereGroups)
+            into a buffer of its own.
+
+  Returns the list of peaks and a TimeSeries with the measurements, one row per timepoint
+  (or a list of lists when read from a CSV file). The caller must close() the TimeSeries when done:
+  it keeps its file open and mapped into memory.
   """
   csv_fluorescence = os.path.join(tgtDir, "%s_fluorescence.csv" % series_name)
-  if not os.path.exists(csv_fluorescence):
-    # Generate projection over time (the img3D) and extract peaks with difference of Gaussian using the params
-    # (Will check if file for projection over time exists and just load it)
-    img3D_filepath = os.path.join(tgtDir, "%s_4D-to-3D_max_projection.zip" % series_name)
-    img3D, peaks, spheresRAI, impSpheres = findNucleiByMaxProjection(img4D, params, img3D_filepath, mask=mask, show=showDetections)
-    comp = showAsComposite([wrap(img3D), impSpheres])
-    # Measure intensity over time, for every peak
-    # by averaging the signal within a radius of each peak.
-    measurement_radius = somaDiameter / 3.0
-    spheres = [ClosedWritableSphere([peak.getFloatPosition(d) for d in xrange(3)], measurement_radius) for peak in peaks]
-    insides = [Regions.iterable( # TODO can be simplified with new method Masks.toIterableRegion
-                 Views.interval(
-                   Views.raster(Masks.toRealRandomAccessible(sphere)),
-                   Intervals.largestContainedInterval(sphere))
-               for sphere in spheres]
-
-    count = float(Regions.countTrue(insides[0])) # same for all
-    measurements = []
-
-    with open(csv_fluorescence, 'w') as csvfile:
-      w = csv.writer(csvfile, delimiter=",", quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-      # Header: with peak coordinates
-      w.writerow(["timepoint"] + ["%.2f::%.2f::%.2f" % tuple(peak.getFloatPosition(d) for d in xrange(3)) for peak in peaks])
-      # Each time point
-      for t in xrange(img4D.dimension(3)):
-        img3D = Views.hyperSlice(img4D, 3, t)
-        mean_intensities = array(((sum(t.get() for t in Regions.sample(inside, img3D)) / count) for inside in insides), 'f')
-        w.writerow([t] + mean_intensities)
-        measurements.append(mean_intensities)
-
-  else:
+  peak_params = {k: params[k] for k in PEAK_PARAM_NAMES if k in params}
+  if mask is not None:
+    peak_params["mask"] = maskSignature(mask)
+  path_peaks = os.path.join(tgtDir, "%s_peaks.%s.bin" % (series_name, artifactKey(peak_params)[:16]))
+  n_timepoints = img4D.dimension(3)
+
+  if os.path.exists(csv_fluorescence) and not os.path.exists(path_peaks):
     # Parse CSV file
     with open(csv_fluorescence, 'r') as csvfile:
       reader = csv.reader(csvfile, delimiter=',', quotechar='"')
@@ -62,42 +176,293 @@ def measureFluorescence(tgtDir, series_name, img4D, params, mask=None, showDetec
       peaks = [RealPoint.wrap(map(float, h.split("::"))) for h in islice(header, 1, None)]
       # Parse rows
       measurements = [map(float, islice(row, 1, None)) for row in reader]
-  
-  return peaks, measurements
+    return peaks, measurements
+
+  peaks = loadPeaks(path_peaks) if os.path.exists(path_peaks) else None
+  resume = peaks is not None
+  if peaks is None:
+    # Generate projection over time (the img3D) and extract peaks with difference of Gaussian using the params
+    # (Will check if file for projection over time exists and just load it)
+    img3D_filepath = os.path.join(tgtDir, "%s_4D-to-3D_max_projection.zip" % series_name)
+    if showDetections:
+      img3D, peaks, spheresRAI, impSpheres = findNucleiByMaxProjection(img4D, params, img3D_filepath, mask=mask, show=True)
+      comp = showAsComposite([wrap(img3D), impSpheres])
+    else:
+      img3D, peaks = findNucleiByMaxProjection(img4D, params, img3D_filepath, mask=mask, show=False)
+    savePeaks(path_peaks, peaks)
+
+  fluorescence_params = {"somaDiameter": params["somaDiameter"],
+                         "peaks": [peak.getDoublePosition(d) for peak in peaks for d in xrange(peak.numDimensions())]}
+  path_fluorescence = os.path.join(tgtDir, "%s_fluorescence.%s.bin" % (series_name, artifactKey(fluorescence_params)[:16]))
+  if resume and os.path.exists(path_fluorescence):
+    # Resume, or return, an earlier measurement
+    measurements = TimeSeries(path_fluorescence)
+    if len(measurements) == n_timepoints and measurements.n_nuclei == len(peaks):
+      return peaks, measurements
+    measurements.close()
+
+  # Measure intensity over time, for every peak
+  # by averaging the signal within a radius of each peak.
+  # The voxels of each sphere are found once, as indices into the flat array of
+  # the bounding box of a group of spheres: only these boxes are read from each 3D volume.
+  measurement_radius = params["somaDiameter"] / 3.0
+  groups = sphereGroups(peaks, measurement_radius, Views.hyperSlice(img4D, 3, 0))
+  buffer_size = max([Intervals.numElements(box) for indices, box, offsets, starts in groups] + [1])
+  # One buffer per thread, reused for every group and timepoint
+  buffers = ThreadLocal.withInitial(lambda: zeros(buffer_size, 'f'))
+
+  def measureTimepoint(t):
+    # Copy the box of each group of spheres into a flat float array, then average its spheres at once
+    img3D = Views.hyperSlice(img4D, 3, t)
+    buffer = buffers.get()
+    mean_intensities = zeros(len(peaks), 'f')
+    for indices, box, offsets, starts in groups:
+      compute(ImgSource(Views.zeroMin(Views.interval(img3D, box)))) \
+        .into(ArrayImgs.floats(buffer, Intervals.dimensionsAsLongArray(box)))
+      means = zeros(len(indices), 'f')
+      RegionMeans.measure(buffer, offsets, starts, means)
+      for i, mean in izip(indices, means):
+        mean_intensities[i] = mean
+    return mean_intensities
+
+  # Each time point, measured in parallel but appended to the store in order
+  # Peaks just regenerated: start over, rather than append to rows of any earlier measurement
+  writer = TimeSeriesWriter(path_fluorescence, len(peaks), resume=resume)
+  n_threads = n_threads if n_threads > 0 else numCPUs()
+  exe = newFixedThreadPool(n_threads=n_threads, name="measure-fluorescence")
+  try:
+    futures = deque()
+    next_t = writer.n_timepoints
+    for t in xrange(writer.n_timepoints, n_timepoints):
+      # Keep at most n_threads + prefetch timepoints in flight
+      while next_t < n_timepoints and next_t - t < n_threads + prefetch:
+        futures.append(exe.submit(Task(measureTimepoint, next_t)))
+        next_t += 1
+      writer.append(futures.popleft().get())
+  finally:
+    exe.shutdownNow()
+    writer.close()
 
+  return peaks, TimeSeries(path_fluorescence)
 
-def computeBaselineFluorescence(measurements, window_size):
+
+def computeBaselineFluorescence(measurements, window_size, percentile=None, n_threads=0, writer=None):
   """
   measurements: a list of lists containing, for each time point, a list of measurements
                 of mean fluorescence intensity at each peak (where a peak represents a nuclei).
+                Can also be a TimeSeries (see function measureFluorescence).
   window_size: the number of timepoints (i.e. indices in measurements) to use for computing
                the baseline using the mininum fluorescence value across the whole window.
                The window has the timepoint centered on it. So the first and last few timepoints
                will use at least only half a window.
                Makes sense to make window_size an odd number, so an equal amount of timepoints
                are included from before and after each timepoint.
-  """
-  # List of lists: one for each measurement in measurements
-  baselines = []
+  percentile: defaults to None, meaning the baseline is the minimum in the window.
+              Otherwise a number between 0 and 100, e.g. 8 for the 8th percentile
+              of the fluorescence values in the window (linearly interpolated).
+  n_threads: for the percentile baseline, the number of threads; zero means as many as CPU cores.
+  writer: defaults to None. A TimeSeriesWriter to append the baseline rows to as they are computed,
+          so that only a few windows of rows are in memory at any time.
 
+  Returns a list of float arrays, one per time point, with the baseline of each peak,
+  or None when the rows are appended to the writer instead.
+  """
   n_peaks = len(measurements[0]) # columns
   n_timepoints = len(measurements) # rows
 
   half_window_size = window_size / 2
 
-  # While I am sure that it can be done more efficiently, this is correct and suffices
-  for ti in xrange(n_timepoints):
-    b = zeros(n_peaks, 'f')
-    for peakIndex in xrange(n_peaks):
-      b[peakIndex] = min(measurements[t][peakIndex]
-                         for t in xrange(max(0,            ti - half_window_size),
-                                         min(n_timepoints, ti + half_window_size)))
-    baselines.append(b)
+  # The window of timepoint ti is [ti - half_window_size, ti + half_window_size), clipped to the series
+  def window(ti):
+    if 0 == half_window_size:
+      return ti, ti + 1
+    return max(0, ti - half_window_size), min(n_timepoints, ti + half_window_size)
+
+  baselines = None if writer else []
+  emit = writer.append if writer else baselines.append
+
+  if percentile is not None:
+    computePercentileBaseline(measurements, window, percentile, n_threads=n_threads,
+                              block_size=max(64, window_size),
+                              emitBlock=writer.appendBlock if writer else None, emit=emit)
+    return baselines
+
+  # Running minimum by the van Herk/Gil-Werman algorithm: split the series into blocks
+  # as long as the window, and compute the running minimum of each block forward (g)
+  # and backward (h). The minimum of any window is then the minimum of at most two values,
+  # from the same or from two consecutive blocks: only two blocks are in memory at a time.
+  # Each step operates on all peaks at once (a whole row), in O(n_timepoints * n_peaks).
+  L = max(1, 2 * half_window_size)
+
+  def runningMinimum(rows, indices):
+    # The running minimum of rows in the order of indices, starting with the first index
+    mins = [None] * len(rows)
+    previous = None
+    for k in indices:
+      mins[k] = zeros(n_peaks, 'f')
+      if previous is None:
+        System.arraycopy(rows[k], 0, mins[k], 0, n_peaks)
+      else:
+        compute(minimum(previous, ArrayImgs.floats(rows[k], [n_peaks]))).into(ArrayImgs.floats(mins[k], [n_peaks]))
+      previous = ArrayImgs.floats(mins[k], [n_peaks])
+    return mins
+
+  h_previous = None # the backward running minimum of the previous block
+  ti = 0
+  for block_first in xrange(0, n_timepoints, L):
+    block_end = min(block_first + L, n_timepoints)
+    rows = [m if 'f' == getattr(m, "typecode", None) else array(m, 'f')
+            for m in (measurements[t] for t in xrange(block_first, block_end))]
+    g = runningMinimum(rows, xrange(len(rows)))
+    h = runningMinimum(rows, xrange(len(rows) -1, -1, -1))
+    # Emit the baselines of the timepoints whose window ends within this block
+    while ti < n_timepoints:
+      first, end = window(ti)
+      last = end - 1
+      if last >= block_end:
+        break
+      b = zeros(n_peaks, 'f')
+      if first >= block_first:
+        # Within a single block: either starts at the block start (windows clipped at the beginning),
+        # or ends at the block end or the end of the series (windows clipped at the end)
+        System.arraycopy(g[last - block_first] if first == block_first else h[first - block_first], 0, b, 0, n_peaks)
+      else:
+        compute(minimum(ArrayImgs.floats(h_previous[first - (block_first - L)], [n_peaks]),
+                        ArrayImgs.floats(g[last - block_first], [n_peaks]))).into(ArrayImgs.floats(b, [n_peaks]))
+      emit(b)
+      ti += 1
+    h_previous = h
+
+  return baselines
+
+
+def computePercentileBaseline(measurements, window, percentile, n_threads=0, block_size=64, emitBlock=None, emit=None):
+  """
+  measurements: see computeBaselineFluorescence.
+  window: a function that returns the first (inclusive) and last (exclusive) timepoint of the window of a timepoint.
+  percentile: between 0 and 100, with linear interpolation between the nearest ranks.
+  n_threads: zero means as many as CPU cores.
+  block_size: the number of timepoints to compute at a time, ideally at least as many as a window:
+              only the rows of their windows are read.
+  emitBlock: defaults to None. A function that takes a float[] with the baselines of a block of timepoints,
+             row after row, e.g. the appendBlock method of a TimeSeriesWriter.
+  emit: defaults to None. When emitBlock is None, a function that takes the float[] with
+        the baselines of each timepoint, e.g. the append method of a list.
+
+  For each peak, keeps the values of the window sorted as the window slides,
+  inserting and removing a value per timepoint by binary search.
+  Within each block of timepoints, peaks are processed in parallel, in chunks.
+
+  Returns a list of float arrays, one per time point, with the baseline of each peak,
+  or None when given emitBlock or emit.
+  """
+  n_peaks = len(measurements[0])
+  n_timepoints = len(measurements)
+  fraction = percentile / 100.0
+  baselines = None
+  if emitBlock is None and emit is None:
+    baselines = []
+    emit = baselines.append
+
+  def computeColumns(values, w_first, t_first, t_end, block, first_peak, last_peak):
+    # values: the rows from timepoint w_first onward; block: the baselines of timepoints t_first to t_end
+    for peakIndex in xrange(first_peak, last_peak):
+      sortedWindow = []
+      first = end = window(t_first)[0] # current window, empty
+      for ti in xrange(t_first, t_end):
+        first2, end2 = window(ti)
+        for t in xrange(end, end2):
+          insort(sortedWindow, values[(t - w_first) * n_peaks + peakIndex])
+        for t in xrange(first, first2):
+          del sortedWindow[bisect_left(sortedWindow, values[(t - w_first) * n_peaks + peakIndex])]
+        first, end = first2, end2
+        # Linear interpolation between nearest ranks
+        rank = fraction * (len(sortedWindow) - 1)
+        lower = int(rank)
+        upper = min(lower + 1, len(sortedWindow) - 1)
+        block[(ti - t_first) * n_peaks + peakIndex] = sortedWindow[lower] + (rank - lower) * (sortedWindow[upper] - sortedWindow[lower])
+
+  exe = newFixedThreadPool(n_threads=n_threads, name="percentile-baseline")
+  try:
+    chunk_size = max(1, n_peaks / (numCPUs() * 4))
+    for t_first in xrange(0, n_timepoints, block_size):
+      t_end = min(t_first + block_size, n_timepoints)
+      w_first, w_end = window(t_first)[0], window(t_end - 1)[1]
+      values = rowBlock(measurements, w_first, w_end, n_peaks)
+      block = zeros((t_end - t_first) * n_peaks, 'f')
+      futures = [exe.submit(Task(computeColumns, values, w_first, t_first, t_end, block, i, min(i + chunk_size, n_peaks)))
+                 for i in xrange(0, n_peaks, chunk_size)]
+      for f in futures:
+        f.get()
+      if emitBlock:
+        emitBlock(block)
+      else:
+        for k in xrange(t_end - t_first):
+          row = zeros(n_peaks, 'f')
+          System.arraycopy(block, k * n_peaks, row, 0, n_peaks)
+          emit(row)
+  finally:
+    exe.shutdown()
 
   return baselines
 
 
-def computeDeltaFOverF(tgtDir, series_name, img4D, params, mask=None, imgCameraNoise=None, showDetections=True):
+def sampleCameraNoise(imgCameraNoise, peaks):
+  """
+  Read, once, the camera noise pixel under each peak.
+  imgCameraNoise: a 2D image.
+  peaks: a list of RealLocalizable.
+
+  Returns a float array with one value per peak.
+  """
+  ra_noise = imgCameraNoise.randomAccess() # two-dimensional
+  noise = zeros(len(peaks), 'f')
+  for i, peak in enumerate(peaks):
+    ra_noise.setPosition(int(peak.getDoublePosition(0)), 0)
+    ra_noise.setPosition(int(peak.getDoublePosition(1)), 1)
+    noise[i] = ra_noise.get().getRealFloat()
+  return noise
+
+
+def rowBlock(rows, first, last, n_peaks):
+  """ The rows from first (inclusive) to last (exclusive) concatenated into a single float array.
+      rows: a TimeSeries or a list of rows. """
+  if isinstance(rows, TimeSeries):
+    return rows.block(first, last)
+  values = zeros((last - first) * n_peaks, 'f')
+  for t in xrange(first, last):
+    row = rows[t] if 'f' == getattr(rows[t], "typecode", None) else array(rows[t], 'f')
+    System.arraycopy(row, 0, values, (t - first) * n_peaks, n_peaks)
+  return values
+
+
+def computeDeltaFOverFBulk(measurements, baselines, camera_noise, regularizer, writer, block_size=64):
+  """
+  delta_F_over_F = (fluorescence - baseline) / (baseline - camera_noise + regularizer)
+  computed for blocks of block_size timepoints at a time, each as a single
+  operation over a 2D image of peaks (X) by timepoints (Y).
+
+  measurements, baselines: a TimeSeries or a list of rows, one per timepoint.
+  camera_noise, regularizer: float arrays with one value per peak.
+  writer: a TimeSeriesWriter, into which the rows of delta_F_over_F are appended.
+  """
+  n_peaks = len(camera_noise)
+  n_timepoints = len(measurements)
+  # Per-peak term of the denominator, added to the baseline
+  offset = array((r - n for r, n in izip(regularizer, camera_noise)), 'f')
+  imgOffset = ArrayImgs.floats(offset, [n_peaks])
+  for first in xrange(0, n_timepoints, block_size):
+    last = min(first + block_size, n_timepoints)
+    dims = [n_peaks, last - first]
+    F = ArrayImgs.floats(rowBlock(measurements, first, last, n_peaks), dims)
+    B = ArrayImgs.floats(rowBlock(baselines, first, last, n_peaks), dims)
+    O = Views.addDimension(imgOffset, 0, last - first - 1) # same offset for every timepoint
+    dFoF = ArrayImgs.floats(dims)
+    compute(div(sub(F, B), add(B, O))).into(dFoF)
+    writer.appendBlock(dFoF.update(None).getCurrentStorageArray())
+
+
+def computeDeltaFOverF(tgtDir, series_name, img4D, params, mask=None, imgCameraNoise=None, showDetections=True, bulk=True):
   """
     delta_F_over_F = (fluorescence - baseline) / (baseline - camera_noise + regularizing_factor)
 
@@ -107,17 +472,39 @@ def computeDeltaFOverF(tgtDir, series_name, img4D, params, mask=None, imgCameraN
     This regularizing factor prevents divisions by zero
     and also enabling comparisons across different data sets (different imaging sessions).
 
-    tgtDir: directory into which to save CSV files.
+    tgtDir: directory into which to save the time series of fluorescence, baseline and deltaF/F,
+            as "<series_name>_fluorescence.<key>.bin" (see function measureFluorescence),
+            "<series_name>_baseline.bin" and "<series_name>_dFoF.bin".
+            See timeseries.py:TimeSeries.
     series_name: used to write relevant files (see function measureFluorescence),
                  and also to find the stdDev param in the params dict.
     img4D: the ImgLib2 4D volume.
     params: dictionary of parameters, see function measureFluorescence.
+            Also "baseline_window_size", and optionally "baseline_percentile"
+            (see function computeBaselineFluorescence).
     mask: consider only nuclei detections within the mask, which has zero values for outside voxels.
     imgCameraNoise: defaults to None, meaning a value of zero for every pixel.
     showDetections: show the 3D max projection plus the nuclei detections.
+    bulk: defaults to True, to compute deltaF/F for many timepoints at once
+          (see function computeDeltaFOverFBulk), with the camera noise sampled once per peak.
+          Otherwise, compute it one value at a time.
+
+    Returns the peaks and, for each of measurements, baselines and dFoF,
+    a TimeSeries with one float array per timepoint (measurements may be a list instead,
+    see function measureFluorescence). The caller must close() each TimeSeries when done:
+    they keep their files open and mapped into memory, and a later run overwrites
+    "<series_name>_baseline.bin" and "<series_name>_dFoF.bin".
   """
   peaks, measurements = measureFluorescence(tgtDir, series_name, img4D, params, mask=mask, showDetections=showDetections)
-  baselines = computeBaselineFluorescence(measurements, params["baseline_window_size"])
+  # Written to the store as computed, a few windows of timepoints at a time
+  path_baseline = os.path.join(tgtDir, "%s_baseline.bin" % series_name)
+  writer = TimeSeriesWriter(path_baseline, len(peaks))
+  try:
+    computeBaselineFluorescence(measurements, params["baseline_window_size"],
+                                percentile=params.get("baseline_percentile", None), writer=writer)
+  finally:
+    writer.close()
+  baselines = TimeSeries(path_baseline)
 
   # In the absence of measured camera noise, use a pixel value of 0
 
@@ -130,6 +517,24 @@ def computeDeltaFOverF(tgtDir, series_name, img4D, params, mask=None, imgCameraN
   # regularizing_factor = (stdDev / 0.04) + camera_noise
   stdDev = params[series_name + "_noise_stdDev"]
 
+  path_dFoF = os.path.join(tgtDir, "%s_dFoF.bin" % series_name)
+
+  if bulk:
+    if imgCameraNoise:
+      camera_noise = sampleCameraNoise(imgCameraNoise, peaks)
+      regularizer = array(((stdDev / 0.04) + noise for noise in camera_noise), 'f')
+    else:
+      noise_mean = params.get(series_name + "_noise_mean", 0)
+      print "Using as camera noise:", noise_mean
+      camera_noise = array([noise_mean] * len(peaks), 'f')
+      regularizer = array([stdDev / 0.04] * len(peaks), 'f')
+    writer = TimeSeriesWriter(path_dFoF, len(peaks))
+    try:
+      computeDeltaFOverFBulk(measurements, baselines, camera_noise, regularizer, writer)
+    finally:
+      writer.close()
+    return peaks, measurements, baselines, TimeSeries(path_dFoF)
+
   def makeComputeFn():
     if imgCameraNoise:
       ra_noise = imgCameraNoise.randomAccess() # two-dimensional
@@ -155,7 +560,10 @@ def computeDeltaFOverF(tgtDir, series_name, img4D, params, mask=None, imgCameraN
 
   compute = makeComputeFn()
 
-  dFoF = [array((compute(m, b, peakIndex) for peakIndex, (m, b) in enumerate(izip(mrow, brow))), 'f')
-          for mrow, brow in izip(measurements, baselines)]
+  # Written to the store one timepoint at a time
+  dFoF = saveTimeSeries(path_dFoF,
+                        (array((compute(m, b, peakIndex) for peakIndex, (m, b) in enumerate(izip(mrow, brow))), 'f')
+                         for mrow, brow in izip(measurements, baselines)),
+                        n_nuclei=len(peaks))
 
   return peaks, measurements, baselines, dFoF
@@ -1,15 +1,27 @@
 from __future__ import with_statement
 from org.scijava.vecmath import Vector3f
 from mpicbg.models import Point, PointMatch
+from java.util import ArrayList
+from java.lang.reflect import Modifier
+from java.util.concurrent.locks import ReentrantLock
 from net.imglib2 import KDTree, RealPoint
+from net.imglib2.img.array import ArrayImgFactory
+from net.imglib2.util import ImgUtil
 from net.imglib2.neighborsearch import RadiusNeighborSearchOnKDTree
 from itertools import imap, izip, product
-from jarray import array
-import os, sys, csv, types
+from jarray import array, zeros
+from java.io import RandomAccessFile
+from java.lang import String, Object
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
+import os, sys, csv, types, json, hashlib
+from math import floor
 from os.path import basename
 # local lib functions:
 from dogpeaks import getDoGPeaks
-from util import syncPrint, Task, Getter
+from pyramid import pyramidAreaAveraging
+from util import syncPrint, Task, Getter, newFixedThreadPool
+from synchronize import make_synchronized
 from features_asm import initNativeClasses
 
 Constellation, PointMatches = initNativeClasses()
@@ -141,7 +153,330 @@ extractFeatures = Constellation.extractFeatures
 #    return tuple(pm.getP1().getW()) + tuple(pm.getP2().getW())
 
 
-def saveFeatures(img_filename, directory, features, params):
+def descriptorGrid(features, descriptor, cell_sizes):
+  """ Bucket features into a grid over their descriptor space.
+      descriptor: a function that returns the descriptor of a feature, as a tuple of numbers.
+      cell_sizes: the side of a grid cell in each dimension of the descriptor space.
+      Returns a dictionary of grid cell (a tuple of integers) vs ArrayList of features. """
+  grid = {}
+  for feature in features:
+    cell = tuple(int(floor(v / size)) for v, size in izip(descriptor(feature), cell_sizes))
+    bucket = grid.get(cell, None)
+    if bucket is None:
+      bucket = ArrayList()
+      grid[cell] = bucket
+    bucket.add(feature)
+  return grid
+
+
+def fromFeaturesIndexed(features1, features2, angle_epsilon, len_epsilon_sq, scale_invariant=False, n_threads=1):
+  """ Like PointMatches.fromFeatures (or fromFeaturesScaleInvariant when scale_invariant is True):
+      the same point matches, in the same order, but without comparing all to all.
+      Constellation features are bucketed in a grid over their (angle, len1, len2) descriptors
+      (or (angle, len1 / (len1 + len2)) when scale_invariant), with cells the size of the epsilons,
+      so that each feature of features1 is compared only with the features of features2
+      in the same or in adjacent grid cells: those that can match.
+      The comparisons themselves are done all to all, by PointMatches, within each group of candidates.
+
+      n_threads: defaults to 1. The number of threads to split the grid cells of features1 into.
+
+      Returns a PointMatches instance. """
+  if angle_epsilon <= 0 or len_epsilon_sq <= 0 or 0 == len(features1) or 0 == len(features2):
+    method = PointMatches.fromFeaturesScaleInvariant if scale_invariant else PointMatches.fromFeatures
+    return method(features1, features2, angle_epsilon, len_epsilon_sq)
+  if scale_invariant:
+    def descriptor(c):
+      angle, len1, len2 = c.asRow()[0:3]
+      return angle, len1 / (len1 + len2)
+    cell_sizes = [angle_epsilon, len_epsilon_sq]
+    method = PointMatches.fromFeaturesScaleInvariant
+  else:
+    descriptor = lambda c: c.asRow()[0:3]
+    cell_sizes = [angle_epsilon, len_epsilon_sq, len_epsilon_sq]
+    method = PointMatches.fromFeatures
+  # Cells marginally larger than the epsilons: features that match, being closer than epsilon,
+  # are then always in the same or in adjacent cells despite floating-point rounding
+  cell_sizes = [size * (1 + 1e-9) for size in cell_sizes]
+  grid1 = descriptorGrid(features1, descriptor, cell_sizes)
+  grid2 = descriptorGrid(features2, descriptor, cell_sizes)
+  offsets = list(product(*[[-1, 0, 1]] * len(cell_sizes)))
+
+  def matchCells(cells):
+    pointmatches = []
+    for cell in cells:
+      candidates = ArrayList()
+      for offset in offsets:
+        bucket = grid2.get(tuple(c + o for c, o in izip(cell, offset)), None)
+        if bucket:
+          candidates.addAll(bucket)
+      if not candidates.isEmpty():
+        pointmatches.extend(method(grid1[cell], candidates, angle_epsilon, len_epsilon_sq).pointmatches)
+    return pointmatches
+
+  cells = grid1.keys()
+  if n_threads > 1:
+    exe = newFixedThreadPool(n_threads=n_threads, name="pointmatches")
+    try:
+      futures = [exe.submit(Task(matchCells, cells[i::n_threads])) for i in xrange(n_threads)]
+      pointmatches = [pm for f in futures for pm in f.get()]
+    finally:
+      exe.shutdown()
+  else:
+    pointmatches = matchCells(cells)
+  # Same order as when comparing all to all: by feature in features1, then by feature in features2
+  index1 = {c.position: i for i, c in enumerate(features1)}
+  index2 = {c.position: i for i, c in enumerate(features2)}
+  pointmatches.sort(key=lambda pm: (index1[pm.getP1()], index2[pm.getP2()]))
+  return PointMatches(ArrayList(pointmatches))
+
+
+def fromNearbyFeaturesScaleInvariant(radius, features1, features2, angle_epsilon, len_epsilon_sq):
+  """ Like PointMatches.fromNearbyFeatures, but comparing features as PointMatches.fromFeaturesScaleInvariant does.
+      Returns a PointMatches instance. """
+  features2 = ArrayList(features2)
+  search2 = RadiusNeighborSearchOnKDTree(KDTree(features2, ArrayList([RealPoint.wrap(c2.position.getW()) for c2 in features2])))
+  pointmatches = ArrayList()
+  for c1 in features1:
+    search2.search(RealPoint.wrap(c1.position.getW()), radius, False) # no need to sort
+    if search2.numNeighbors() > 0:
+      candidates = ArrayList([search2.getSampler(i).get() for i in xrange(search2.numNeighbors())])
+      pointmatches.addAll(PointMatches.fromFeaturesScaleInvariant(ArrayList([c1]), candidates,
+                                                                  angle_epsilon, len_epsilon_sq).pointmatches)
+  return PointMatches(pointmatches)
+
+
+def fromPredictedFeatures(model, radius, features1, features2, angle_epsilon, len_epsilon_sq, scale_invariant=False):
+  """ Like PointMatches.fromNearbyFeatures, but comparing each feature of features1 only with
+      the features of features2 within radius of its position as predicted by the model,
+      e.g. a model estimated from the features of a coarser level of the image pyramid.
+      model: an mpicbg CoordinateTransform from the coordinates of features1 to those of features2.
+      scale_invariant: defaults to False. If True, compare features like PointMatches.fromFeaturesScaleInvariant,
+                       see fromNearbyFeaturesScaleInvariant.
+      Returns a PointMatches instance, with point matches between the original positions. """
+  if 0 == len(features1) or 0 == len(features2):
+    return PointMatches(ArrayList())
+  predicted = ArrayList(len(features1))
+  originals = {}
+  for c in features1:
+    angle, len1, len2 = c.asRow()[0:3]
+    p = Constellation(angle, len1, len2, model.apply(c.position.getW()))
+    originals[p.position] = c.position
+    predicted.add(p)
+  method = fromNearbyFeaturesScaleInvariant if scale_invariant else PointMatches.fromNearbyFeatures
+  pm = method(radius, predicted, features2, angle_epsilon, len_epsilon_sq)
+  return PointMatches(ArrayList([PointMatch(originals[m.getP1()], m.getP2()) for m in pm.pointmatches]))
+
+
+def canonicalParams(params):
+  """ Return a string representation of the params dictionary that does not depend
+      on the order of the keys, and where integers and floats of equal value
+      are written the same way (like checkParams, which considers all numbers as floats). """
+  def canonical(value):
+    if isinstance(value, (types.IntType, types.LongType, types.FloatType)):
+      return repr(float(value))
+    if isinstance(value, (types.ListType, types.TupleType)):
+      return "[" + ",".join(imap(canonical, value)) + "]"
+    if isinstance(value, Object) and value.getClass().getMethod("toString").getDeclaringClass() == Object:
+      # e.g. FloatArray2DSIFT.Param: the default toString includes the identity hash code,
+      # which differs across runs, so use instead the values of its public fields
+      fields = sorted((f for f in value.getClass().getFields() if not Modifier.isStatic(f.getModifiers())),
+                      key=lambda f: f.getName())
+      return "%s{%s}" % (value.getClass().getName(),
+                         ",".join("%s=%s" % (f.getName(), canonical(f.get(value))) for f in fields))
+    return str(value)
+  return ";".join("%s=%s" % (key, canonical(params[key])) for key in sorted(params.iterkeys()))
+
+
+def paramsHash(params):
+  """ A SHA-1 hex digest of the canonical representation of the params dictionary. """
+  return hashlib.sha1(canonicalParams(params)).hexdigest()
+
+
+# Parameters that determine the features, and the pointmatches (which depend on the features)
+FEATURE_PARAM_NAMES = ["minPeakValue", "sigmaSmaller", "sigmaLarger", # DoG peak params
+                       "radius", "min_angle", "max_per_peak"]         # Constellation params
+POINTMATCH_PARAM_NAMES = FEATURE_PARAM_NAMES + ["angle_epsilon", "len_epsilon_sq"]
+# Optional parameters that, when present, also determine the pointmatches
+POINTMATCH_OPTIONAL_PARAM_NAMES = ["pointmatches_nearby", "pointmatches_search_radius"]
+
+
+def sourceSignature(img_filename):
+  """ The file name plus the modification time and size of the image file,
+      or only the file name when it is not a file (e.g. an image from an InRAMLoader). """
+  name = basename(img_filename)
+  if os.path.isfile(img_filename):
+    st = os.stat(img_filename)
+    return "%s:%i:%i" % (name, int(st.st_mtime * 1000), st.st_size)
+  return name
+
+
+def artifactKey(params, *img_filenames):
+  """ A content-addressed key for an artifact (features, pointmatches, matrices)
+      made with params from the image files: a SHA-1 hex digest that changes
+      when any of the params or any of the image files change.
+      params must contain only the parameters that the artifact depends on,
+      so that changing any other parameter doesn't invalidate it. """
+  return hashlib.sha1("|".join([canonicalParams(params)] + map(sourceSignature, img_filenames))).hexdigest()
+
+
+def featuresPath(img_filename, directory, params):
+  """ The path to the binary feature store of img_filename for these params.
+      Feature stores for different params or different versions of the image coexist side by side. """
+  return os.path.join(directory, "%s.%s.features.bin" % (basename(img_filename),
+                                                         artifactKey(params, img_filename)[:16]))
+
+
+# Binary feature store:
+#  * magic: 8 bytes, the ASCII string in FEATURES_MAGIC
+#  * params: 4-byte int with the length of the UTF-8 JSON string that follows,
+#            which encodes the dictionary of parameters
+#  * hash: 40 bytes, the ASCII hex digest of paramsHash(params)
+#  * count: 8-byte long with the number of features
+#  * zero padding up to a multiple of 8 bytes
+#  * 6 columns of count 64-bit floats each: angle, len1, len2, x, y, z
+# All numbers are little-endian.
+FEATURES_MAGIC = "IVFEAT01"
+
+
+def writeBinaryHeader(ra, magic, params):
+  """ Write the magic string, the JSON-encoded params and their hash
+      into the RandomAccessFile ra at its current position.
+      Returns the hash. """
+  phash = paramsHash(params)
+  sparams = String(json.dumps(params, sort_keys=True, default=str)).getBytes("UTF-8")
+  bb = ByteBuffer.allocate(8 + 4 + len(sparams) + 40).order(ByteOrder.LITTLE_ENDIAN)
+  bb.put(String(magic).getBytes("US-ASCII"))
+  bb.putInt(len(sparams))
+  bb.put(sparams)
+  bb.put(String(phash).getBytes("US-ASCII"))
+  ra.write(bb.array())
+  return phash
+
+
+def readBinaryHeader(bb, magic):
+  """ Read the header written by writeBinaryHeader from the ByteBuffer bb,
+      which must be at its start and in little-endian order.
+      Returns the dictionary of params and their hash,
+      or None when the magic string doesn't match. """
+  bmagic = zeros(8, 'b')
+  bb.get(bmagic)
+  if str(String(bmagic, "US-ASCII")) != magic:
+    return None
+  sparams = zeros(bb.getInt(), 'b')
+  bb.get(sparams)
+  bhash = zeros(40, 'b')
+  bb.get(bhash)
+  return json.loads(unicode(String(sparams, "UTF-8"))), str(String(bhash, "US-ASCII"))
+
+
+def saveFeaturesBinary(img_filename, directory, features, params):
+  """ Store features in the binary feature store at featuresPath.
+      See FEATURES_MAGIC for the layout. """
+  path = featuresPath(img_filename, directory, params)
+  try:
+    ra = RandomAccessFile(path, 'rw')
+    try:
+      ra.setLength(0)
+      writeBinaryHeader(ra, FEATURES_MAGIC, params)
+      n = len(features)
+      padding = (8 - (ra.getFilePointer() + 8) % 8) % 8
+      bb = ByteBuffer.allocate(8 + padding + 6 * 8 * n).order(ByteOrder.LITTLE_ENDIAN)
+      bb.putLong(n)
+      bb.position(8 + padding)
+      # Transpose rows into columns
+      columns = [zeros(n, 'd') for _ in xrange(6)]
+      for i, feature in enumerate(features):
+        for column, value in izip(columns, feature.asRow()):
+          column[i] = value
+      db = bb.asDoubleBuffer()
+      for column in columns:
+        db.put(column)
+      ra.write(bb.array())
+      ra.getFD().sync() # Ensure it's written
+    finally:
+      ra.close()
+  except:
+    syncPrint("Failed to save features at %s" % path)
+    syncPrint(str(sys.exc_info()))
+
+
+def loadFeatureColumns(path):
+  """ Memory-map the binary feature store at path and read it
+      into 6 double[] arrays: angle, len1, len2, x, y, z.
+      Returns the params dictionary, its hash, and the list of columns;
+      or None if the file is not a binary feature store. """
+  ra = RandomAccessFile(path, 'r')
+  try:
+    fc = ra.getChannel()
+    bb = fc.map(FileChannel.MapMode.READ_ONLY, 0, fc.size()).order(ByteOrder.LITTLE_ENDIAN)
+    header = readBinaryHeader(bb, FEATURES_MAGIC)
+    if header is None:
+      return None
+    params, phash = header
+    n = int(bb.getLong())
+    bb.position(bb.position() + (8 - bb.position() % 8) % 8)
+    db = bb.slice().order(ByteOrder.LITTLE_ENDIAN).asDoubleBuffer()
+    columns = [zeros(n, 'd') for _ in xrange(6)]
+    for column in columns:
+      db.get(column) # bulk copy
+    return params, phash, columns
+  finally:
+    ra.close()
+
+
+def featuresFromColumns(columns):
+  """ Create a list of Constellation features from the 6 columns
+      angle, len1, len2, x, y, z. """
+  return [Constellation(angle, len1, len2, array((x, y, z), 'd'))
+          for angle, len1, len2, x, y, z in izip(*columns)]
+
+
+def loadFeaturesBinary(img_filename, directory, params, validateOnly=False, verbose=True):
+  """ Attempts to load features from the binary feature store at featuresPath if it exists,
+      returning a list of Constellation features or None.
+      Parameters are compared by their paramsHash.
+      validateOnly: if True, return after checking that parameters match. """
+  path = featuresPath(img_filename, directory, params)
+  if not os.path.exists(path):
+    return None
+  try:
+    stored = loadFeatureColumns(path)
+    if stored is None:
+      syncPrint("Not a binary feature store: %s" % path)
+      return None
+    stored_params, phash, columns = stored
+    if phash != paramsHash(params):
+      syncPrint("Mismatching parameters for %s:\n  stored: %s\n  wanted: %s" % \
+                (path, canonicalParams(stored_params), canonicalParams(params)))
+      return None
+    if validateOnly:
+      return True
+    features = featuresFromColumns(columns)
+    if verbose:
+      syncPrint("Loaded %i features for %s" % (len(features), img_filename))
+    return features
+  except:
+    syncPrint("Could not load features for %s" % img_filename)
+    syncPrint(str(sys.exc_info()))
+    return None
+
+
+def exportFeaturesCSV(img_filename, directory, params):
+  """ Export the binary feature store of img_filename as a ".features.csv" file
+      as written by saveFeatures with binary=False. Returns the number of features,
+      or None when the binary feature store doesn't exist or its params mismatch. """
+  features = loadFeaturesBinary(img_filename, directory, params, verbose=False)
+  if features is None:
+    return None
+  saveFeatures(img_filename, directory, features, params, binary=False)
+  return len(features)
+
+
+def saveFeatures(img_filename, directory, features, params, binary=True):
+  """ Store features in the binary feature store at featuresPath (the default),
+      or as a CSV file at filename + ".features.csv" when binary is False. """
+  if binary:
+    return saveFeaturesBinary(img_filename, directory, features, params)
   path = os.path.join(directory, basename(img_filename)) + ".features.csv"
   try:
     with open(path, 'w') as csvfile:
@@ -194,13 +529,16 @@ def checkParams(params, names, values, epsilon):
 
 
 def loadFeatures(img_filename, directory, params, validateOnly=False, epsilon=0.00001, verbose=True):
-  """ Attempts to load features from filename + ".features.csv" if it exists,
+  """ Attempts to load features from the binary feature store at featuresPath if it exists,
+      and otherwise from filename + ".features.csv" if it exists,
       returning a list of Constellation features or None.
       params: dictionary of parameters with which features are wanted now,
               to compare with parameter with which features were extracted.
               In case of mismatch, return None.
-      epsilon: allowed error when comparing floating-point values.
+      epsilon: allowed error when comparing floating-point values (CSV files only).
       validateOnly: if True, return after checking that parameters match. """
+  if os.path.exists(featuresPath(img_filename, directory, params)):
+    return loadFeaturesBinary(img_filename, directory, params, validateOnly=validateOnly, verbose=verbose)
   try:
     csvpath = os.path.join(directory, basename(img_filename) + ".features.csv")
     if os.path.exists(csvpath):
@@ -226,7 +564,217 @@ def loadFeatures(img_filename, directory, params, validateOnly=False, epsilon=0.
     return None
 
 
-def savePointMatches(img_filename1, img_filename2, pointmatches, directory, params):
+POINTMATCHES_MAGIC = "IVPMDB01"
+
+
+class PointMatchStore:
+  """ A single file storing the pointmatches of many pairs of images, keyed by the
+      pair of image file names and the artifactKey of the parameters and images used to make them.
+      Records are only ever appended: a newer record for the same key shadows older ones.
+      Writes are synchronized, so many threads can append concurrently;
+      reads are positional (FileChannel.read with an offset) and don't block each other.
+      An index of the records is built when opening the file, by reading only record headers.
+
+      File layout: the 8-byte ASCII POINTMATCHES_MAGIC, then records, each with:
+       * 4-byte int with the length of the key, then the key as UTF-8: img1, img2 and artifactKey separated by newlines
+       * 4-byte int with the number of dimensions of each point (2 or 3; zero when there are no pointmatches)
+       * 4-byte int with the number of pointmatches
+       * one row per pointmatch of 2 * n_dims 64-bit floats: x1, y1, [z1,] x2, y2, [z2]
+      All numbers are little-endian. """
+  def __init__(self, path):
+    self.path = path
+    self.ra = RandomAccessFile(path, 'rw')
+    self.channel = self.ra.getChannel()
+    self.index = {} # (img1, img2, artifactKey) vs (offset to data, n_dims, count)
+    if 0 == self.channel.size():
+      self.channel.write(ByteBuffer.wrap(String(POINTMATCHES_MAGIC).getBytes("US-ASCII")), 0)
+      self.end = 8
+    else:
+      self.end = self.scan()
+
+  def readFully(self, bb, offset):
+    while bb.hasRemaining():
+      if self.channel.read(bb, offset + bb.position()) < 0:
+        return False # end of file
+    bb.flip()
+    return True
+
+  def scan(self):
+    """ Populate the index from the record headers, and return the offset
+        at which to append the next record. A truncated last record
+        (e.g. from a crash while writing) is ignored and will be overwritten. """
+    bb = ByteBuffer.allocate(8)
+    if not self.readFully(bb, 0) or str(String(bb.array(), "US-ASCII")) != POINTMATCHES_MAGIC:
+      raise Exception("Not a pointmatches store: %s" % self.path)
+    offset = 8
+    size = self.channel.size()
+    while offset < size:
+      bb = ByteBuffer.allocate(4).order(ByteOrder.LITTLE_ENDIAN)
+      if not self.readFully(bb, offset):
+        break
+      key_length = bb.getInt()
+      bb = ByteBuffer.allocate(key_length + 8).order(ByteOrder.LITTLE_ENDIAN)
+      if not self.readFully(bb, offset + 4):
+        break
+      bkey = zeros(key_length, 'b')
+      bb.get(bkey)
+      n_dims, count = bb.getInt(), bb.getInt()
+      data_offset = offset + 4 + key_length + 8
+      next_offset = data_offset + count * n_dims * 2 * 8
+      if next_offset > size:
+        break
+      self.index[tuple(unicode(String(bkey, "UTF-8")).split("\n"))] = (data_offset, n_dims, count)
+      offset = next_offset
+    return offset
+
+  def contains(self, img1_filename, img2_filename, akey):
+    return (basename(img1_filename), basename(img2_filename), akey) in self.index
+
+  @make_synchronized
+  def append(self, bb, key, header_length, n_dims, count):
+    offset = self.end
+    while bb.hasRemaining():
+      self.channel.write(bb, offset + bb.position())
+    self.index[key] = (offset + header_length, n_dims, count)
+    self.end = offset + bb.limit()
+
+  def put(self, img1_filename, img2_filename, akey, pointmatches):
+    """ Append the pointmatches (a list, set or any iterable of PointMatch) for the pair of images. """
+    rows = [PointMatches.asRow(pm) for pm in pointmatches]
+    n_dims = len(rows[0]) / 2 if rows else 0
+    key = (basename(img1_filename), basename(img2_filename), akey)
+    bkey = String("\n".join(key)).getBytes("UTF-8")
+    header_length = 4 + len(bkey) + 8
+    bb = ByteBuffer.allocate(header_length + len(rows) * n_dims * 2 * 8).order(ByteOrder.LITTLE_ENDIAN)
+    bb.putInt(len(bkey))
+    bb.put(bkey)
+    bb.putInt(n_dims)
+    bb.putInt(len(rows))
+    db = bb.asDoubleBuffer()
+    for row in rows:
+      db.put(row)
+    bb.rewind()
+    self.append(bb, key, header_length, n_dims, len(rows))
+
+  def get(self, img1_filename, img2_filename, akey):
+    """ Return an ArrayList of PointMatch, or None if not stored. """
+    entry = self.index.get((basename(img1_filename), basename(img2_filename), akey), None)
+    if entry is None:
+      return None
+    offset, n_dims, count = entry
+    bb = ByteBuffer.allocate(count * n_dims * 2 * 8).order(ByteOrder.LITTLE_ENDIAN)
+    self.readFully(bb, offset)
+    db = bb.asDoubleBuffer()
+    pointmatches = ArrayList(count)
+    for i in xrange(count):
+      c1 = zeros(n_dims, 'd')
+      c2 = zeros(n_dims, 'd')
+      db.get(c1)
+      db.get(c2)
+      pointmatches.add(PointMatch(Point(c1), Point(c2)))
+    return pointmatches
+
+  def importCSVs(self, img_filenames, directory, params, validate=True, epsilon=0.00001):
+    """ Import the ".pointmatches.csv" files in directory made for pairs of img_filenames,
+        storing them under the artifactKey of params and the pair of images.
+        validate: when True (the default), import only CSV files whose parameters match params.
+        Returns the number of imported files. """
+    paths = {basename(img_filename): img_filename for img_filename in img_filenames}
+    names = set(paths.iterkeys())
+    count = 0
+    for filename in sorted(os.listdir(directory)):
+      if not filename.endswith(".pointmatches.csv"):
+        continue
+      pair = filename[:-len(".pointmatches.csv")]
+      # Image file names contain dots: find the split point using the known names
+      for i in (i for i, c in enumerate(pair) if '.' == c):
+        img1, img2 = pair[:i], pair[i+1:]
+        if img1 in names and img2 in names:
+          break
+      else:
+        continue
+      pointmatches = loadPointMatchesCSV(img1, img2, directory, params if validate else None,
+                                         epsilon=epsilon, verbose=False)
+      if pointmatches is not None:
+        self.put(img1, img2, artifactKey(params, paths[img1], paths[img2]), pointmatches)
+        count += 1
+    syncPrint("Imported %i pointmatches CSV files into %s" % (count, self.path))
+    return count
+
+  def flush(self):
+    self.channel.force(False)
+
+  def close(self):
+    self.flush()
+    self.ra.close()
+
+
+__stores = {}
+__stores_lock = ReentrantLock()
+
+def pointMatchStore(directory, create=True):
+  """ Return the PointMatchStore at directory/pointmatches.db, shared by all threads.
+      create: when False, return None if the file doesn't exist yet. """
+  path = os.path.join(directory, "pointmatches.db")
+  __stores_lock.lock()
+  try:
+    store = __stores.get(path, None)
+    if store is None:
+      if not create and not os.path.exists(path):
+        return None
+      store = PointMatchStore(path)
+      __stores[path] = store
+    return store
+  finally:
+    __stores_lock.unlock()
+
+
+def closePointMatchStores():
+  """ Flush and close all open PointMatchStore, e.g. before deleting their files. """
+  __stores_lock.lock()
+  try:
+    for store in __stores.itervalues():
+      store.close()
+    __stores.clear()
+  finally:
+    __stores_lock.unlock()
+
+
+def hasPointMatches(img1_filename, img2_filename, directory, params, epsilon=0.00001):
+  """ Whether pointmatches for the pair of images exist, for these params in the
+      PointMatchStore, or as a ".pointmatches.csv" file whose parameters match params
+      (like loadPointMatches, but reading only the first two rows of the CSV file). """
+  store = pointMatchStore(directory, create=False)
+  if store and store.contains(img1_filename, img2_filename, artifactKey(params, img1_filename, img2_filename)):
+    return True
+  csvpath = os.path.join(directory, basename(img1_filename) + '.' + basename(img2_filename) + ".pointmatches.csv")
+  if not os.path.exists(csvpath):
+    return False
+  try:
+    with open(csvpath, 'r') as csvfile:
+      reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+      # First line contains parameter names, second line their values
+      return bool(checkParams(params, reader.next(), reader.next(), epsilon))
+  except:
+    syncPrint("Could not read the parameters of the pointmatches at %s" % csvpath)
+    syncPrint(str(sys.exc_info()))
+    return False
+
+
+def savePointMatches(img_filename1, img_filename2, pointmatches, directory, params, binary=True):
+  """ Store pointmatches in the PointMatchStore of the directory (the default),
+      or as a CSV file at filename1 + '.' + filename2 + ".pointmatches.csv" when binary is False.
+      In the PointMatchStore, pointmatches are keyed by the artifactKey of params and both image files:
+      pass as params only those that the pointmatches depend on, and the image file paths
+      (rather than only their names) so that re-generated images invalidate them. """
+  if binary:
+    try:
+      akey = artifactKey(params, img_filename1, img_filename2)
+      pointMatchStore(directory).put(img_filename1, img_filename2, akey, pointmatches)
+    except:
+      syncPrint("Failed to save pointmatches for pair %s, %s" % (img_filename1, img_filename2))
+      syncPrint(str(sys.exc_info()))
+    return
   filename = basename(img_filename1) + '.' + basename(img_filename2) + ".pointmatches.csv"
   path = os.path.join(directory, filename)
   try:
@@ -251,12 +799,28 @@ def savePointMatches(img_filename1, img_filename2, pointmatches, directory, para
 
 
 def loadPointMatches(img1_filename, img2_filename, directory, params, epsilon=0.00001, verbose=True):
-  """ Attempts to load point matches from filename1 + '.' + filename2 + ".pointmatches.csv" if it exists,
+  """ Attempts to load point matches from the PointMatchStore of the directory,
+      and otherwise from filename1 + '.' + filename2 + ".pointmatches.csv" if it exists,
       returning a list of PointMatch instances or None.
       params: dictionary of parameters with which pointmatches are wanted now,
               to compare with parameter with which pointmatches were made.
               In case of mismatch, return None.
-      epsilon: allowed error when comparing floating-point values. """
+      epsilon: allowed error when comparing floating-point values (CSV files only). """
+  store = pointMatchStore(directory, create=False)
+  if store:
+    pointmatches = store.get(img1_filename, img2_filename, artifactKey(params, img1_filename, img2_filename))
+    if pointmatches is not None:
+      if verbose:
+        syncPrint("Loaded %i pointmatches for %s, %s" % (len(pointmatches), img1_filename, img2_filename))
+      return pointmatches
+  return loadPointMatchesCSV(img1_filename, img2_filename, directory, params, epsilon=epsilon, verbose=verbose)
+
+
+def loadPointMatchesCSV(img1_filename, img2_filename, directory, params, epsilon=0.00001, verbose=True):
+  """ Attempts to load point matches from filename1 + '.' + filename2 + ".pointmatches.csv" if it exists,
+      returning a list of PointMatch instances or None.
+      params: dictionary of parameters to check against those in the CSV file,
+              or None to skip the check. """
   try:
     csvpath = os.path.join(directory, basename(img1_filename) + '.' + basename(img2_filename) + ".pointmatches.csv")
     if not os.path.exists(csvpath):
@@ -266,7 +830,8 @@ def loadPointMatches(img1_filename, img2_filename, directory, params, epsilon=0.
     with open(csvpath, 'r') as csvfile:
       reader = csv.reader(csvfile, delimiter=',', quotechar='"')
       # First line contains parameter names, second line their values
-      if not checkParams(params, reader.next(), reader.next(), epsilon):
+      names, values = reader.next(), reader.next()
+      if params is not None and not checkParams(params, names, values, epsilon):
         return None
       reader.next() # skip header with column names
       pointmatches = PointMatches.fromRows(reader).pointmatches
@@ -279,9 +844,24 @@ def loadPointMatches(img1_filename, img2_filename, directory, params, epsilon=0.
     return None
 
 
-def makeFeatures(img_filename, img_loader, getCalibration, csv_dir, params):
-  """ Helper function to extract features from an image. """
-  img = img_loader.load(img_filename)
+def makeFeatures(img_filename, img_loader, getCalibration, csv_dir, params, level=0, img=None):
+  """ Helper function to extract features from an image.
+      level: the level of the image pyramid to extract them from (see pyramid.pyramidAreaAveraging,
+             for images of integer type), defaults to zero: the image itself. Peak coordinates are always in calibrated units
+             of the image itself, so that features from any level can be compared.
+      img: defaults to None, meaning load it with img_loader. Otherwise the image already loaded. """
+  if img is None:
+    img = img_loader.load(img_filename)
+  calibration = getCalibration(img_filename)
+  if level > 0:
+    levels = pyramidAreaAveraging(img, level)
+    factor = pow(2, len(levels) -1) # the top level may be lower than requested for small images
+    # Copy the pyramid level: it is a view that would be computed anew for every read
+    img = ArrayImgFactory(img.randomAccess().get().createVariable()).create(levels[-1])
+    ImgUtil.copy(levels[-1], img)
+    # Each pixel is the average of a block of factor pixels per side
+    offsets = [(factor - 1) / 2.0 * cal for cal in calibration]
+    calibration = [cal * factor for cal in calibration]
   # Find a list of peaks by difference of Gaussian
   peaks = []
   sigmaSmaller = params["sigmaSmaller"]
@@ -290,8 +870,13 @@ def makeFeatures(img_filename, img_loader, getCalibration, csv_dir, params):
     sigmaSmaller = [sigmaSmaller]
     sigmaLarger = [sigmaLarger]
   for ss, sl in izip(sigmaSmaller, sigmaLarger):
-    peaks.extend(getDoGPeaks(img, getCalibration(img_filename),
+    peaks.extend(getDoGPeaks(img, calibration,
                              ss, sl, params['minPeakValue']))
+  if level > 0:
+    # From the top-left corner to the center of each block of pixels
+    for peak in peaks:
+      for d, offset in enumerate(offsets):
+        peak.move(offset, d)
   #
   if 0 == len(peaks):
     features = []
@@ -309,12 +894,13 @@ def makeFeatures(img_filename, img_loader, getCalibration, csv_dir, params):
 
 
 def findPointMatches(img1_filename, img2_filename, img_loader, getCalibration, csv_dir, exe, params, verbose=True):
-  """ Attempt to load them from a CSV file, otherwise compute them and save them. """
-  names = set(["minPeakValue", "sigmaSmaller", "sigmaLarger", # DoG peak params
-               "radius", "min_angle", "max_per_peak",         # Constellation params
-               "angle_epsilon", "len_epsilon_sq"])            # pointmatches params
-  pm_params = {k: params[k] for k in names}
-  # Attempt to load pointmatches from CSV file
+  """ Attempt to load them from the PointMatchStore or a CSV file, otherwise compute them and save them.
+      Pointmatches are keyed by the parameters they depend on (including those of the features)
+      and by the image files, so changing any of these computes new pointmatches
+      without discarding those made with other parameters. """
+  pm_params = {k: params[k] for k in POINTMATCH_PARAM_NAMES}
+  pm_params.update((k, params[k]) for k in POINTMATCH_OPTIONAL_PARAM_NAMES if k in params)
+  # Attempt to load stored pointmatches
   pointmatches = loadPointMatches(img1_filename, img2_filename, csv_dir, pm_params, verbose=verbose)
   if pointmatches is not None:
     return pointmatches
@@ -322,9 +908,7 @@ def findPointMatches(img1_filename, img2_filename, img_loader, getCalibration, c
   # Load features from CSV files
   # otherwise compute them and save them.
   img_filenames = [img1_filename, img2_filename]
-  names = set(["minPeakValue", "sigmaSmaller", "sigmaLarger",
-                "radius", "min_angle", "max_per_peak"])
-  feature_params = {k: params[k] for k in names}
+  feature_params = {k: params[k] for k in FEATURE_PARAM_NAMES}
   csv_features = [loadFeatures(img_filename, csv_dir, feature_params, verbose=verbose)
                   for img_filename in img_filenames]
   # If features were loaded, just return them, otherwise compute them (and save them to CSV files)
@@ -346,38 +930,47 @@ def findPointMatches(img1_filename, img2_filename, img_loader, getCalibration, c
         features[0], features[1],
         params["angle_epsilon"], params["len_epsilon_sq"])
   else:
-    if 2 == pointmatches_nearby:
-      method = PointMatches.fromFeaturesScaleInvariant
-    else: # 0
-      method = PointMatches.fromFeatures
-    # All to all
-    pm = method(
+    # All to all, or rather all to those that could match, with the same result
+    pm = fromFeaturesIndexed(
         features[0], features[1],
-        params["angle_epsilon"], params["len_epsilon_sq"])
+        params["angle_epsilon"], params["len_epsilon_sq"],
+        scale_invariant=2 == pointmatches_nearby, # else 0
+        n_threads=params.get("pointmatches_n_threads", 1))
 
   if verbose:
     syncPrint("Found %i point matches between:\n    %s\n    %s" % \
               (len(pm.pointmatches), basename(img1_filename), basename(img2_filename)))
 
-  # Store as CSV file
+  # Store in the PointMatchStore
   savePointMatches(img1_filename, img2_filename, pm.pointmatches, csv_dir, pm_params)
   #
   return pm.pointmatches
 
 
-def ensureFeatures(img_filename, img_loader, getCalibration, csv_dir, params, verbose=True):
-  names = set(["minPeakValue", "sigmaSmaller", "sigmaLarger",
-               "radius", "min_angle", "max_per_peak"])
-  feature_params = {k: params[k] for k in names}
+def ensureFeatures(img_filename, img_loader, getCalibration, csv_dir, params, verbose=True, coarse_params=None):
+  """ coarse_params: defaults to None. Otherwise the feature params for a coarse level of the image pyramid,
+                     including the "coarse_level" itself: ensure those features exist too,
+                     extracting them from the same loaded image as the features of the image itself. """
+  feature_params = {k: params[k] for k in FEATURE_PARAM_NAMES}
+  missing = [] # pairs of params and pyramid level
   if not loadFeatures(img_filename, csv_dir, feature_params, validateOnly=True, verbose=verbose):
-    # Create features from scratch, which overwrites any CSV files
-    makeFeatures(img_filename, img_loader, getCalibration, csv_dir, feature_params)
-    # TODO: Delete CSV files for pointmatches, if any
-
-
-def ensureFeaturesForAll(img_filenames, img_loader, getCalibration, csv_dir, params, exe, verbose=True):
-  """ Ensure features exist in CSV files, or create them, for each image file. """
-  futures = [exe.submit(Task(ensureFeatures, img_filename, img_loader, getCalibration, csv_dir, params, verbose=verbose))
+    # Create features from scratch, into a new file keyed by the params and the image file.
+    # Pointmatches are keyed by the same params and image files, so the ones made
+    # from other features are not reused, and need not be deleted.
+    missing.append((feature_params, 0))
+  if coarse_params and not loadFeaturesBinary(img_filename, csv_dir, coarse_params, validateOnly=True, verbose=verbose):
+    missing.append((coarse_params, coarse_params["coarse_level"]))
+  if missing:
+    img = img_loader.load(img_filename) # once for all levels
+    for ps, level in missing:
+      makeFeatures(img_filename, img_loader, getCalibration, csv_dir, ps, level=level, img=img)
+
+
+def ensureFeaturesForAll(img_filenames, img_loader, getCalibration, csv_dir, params, exe, verbose=True, coarse_params=None):
+  """ Ensure features exist in feature stores or CSV files, or create them, for each image file.
+      coarse_params: defaults to None. See ensureFeatures. """
+  futures = [exe.submit(Task(ensureFeatures, img_filename, img_loader, getCalibration, csv_dir, params,
+                             verbose=verbose, coarse_params=coarse_params))
              for img_filename in img_filenames]
   # Wait until all complete
   for f in futures:
@@ -1,32 +1,38 @@
-from java.io import RandomAccessFile
-from net.imglib2.img.array import ArrayImgs
+from java.io import RandomAccessFile, File, ByteArrayOutputStream
+from net.imglib2.img.array import ArrayImgs, ArrayImgFactory
 from jarray import zeros, array
 from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
 from java.math import BigInteger
-from java.util import Arrays
-from java.lang import System, Long
-import operator, sys
+from java.util import Arrays, LinkedHashMap
+from java.util.concurrent import FutureTask
+from java.util.zip import Deflater, Inflater
+from java.lang import System, Long, Integer, Class, String
+import operator, sys, os, hashlib
 from net.imglib2 import RandomAccessibleInterval, IterableInterval
 from net.imglib2.view import Views
 from net.imglib2.img.display.imagej import ImageJFunctions as IL
 from net.imglib2.img import ImgView
-from net.imglib2.cache import CacheLoader
+from net.imglib2.cache import CacheLoader, Cache, LoaderCache
+from net.imglib2.cache.util import KeyBimap, LoaderCacheAsCacheAdapter
 from net.imglib2.realtransform import RealViews
 from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
-from net.imglib2.img.basictypeaccess.array import ByteArray, ShortArray, FloatArray, LongArray
-from net.imglib2.type.numeric.integer import UnsignedByteType, UnsignedShortType, LongType
-from net.imglib2.type.numeric.real import FloatType
+from net.imglib2.img.basictypeaccess.array import ByteArray, ShortArray, IntArray, FloatArray, LongArray, DoubleArray
+from net.imglib2.type.numeric.integer import UnsignedByteType, UnsignedShortType, UnsignedIntType, UnsignedLongType, \
+                                           ByteType, ShortType, IntType, LongType
+from net.imglib2.type.numeric.real import FloatType, DoubleType
 from net.imglib2.type.logic import BitType
 from net.imglib2.type import PrimitiveType
-from net.imglib2.util import Intervals
-from net.imglib2.img.cell import CellGrid, Cell
+from net.imglib2.util import Intervals, ImgUtil, IntervalIndexer
+from net.imglib2.algorithm.math.ImgMath import div, add
+from net.imglib2.img.cell import CellGrid, Cell, CellImgFactory
 from net.imglib2.img.basictypeaccess import AccessFlags, ArrayDataAccessFactory
-from net.imglib2.cache.ref import SoftRefLoaderCache
+from net.imglib2.cache.ref import SoftRefLoaderCache, BoundedSoftRefLoaderCache
 from net.imglib2.cache.img import CachedCellImg
 from ij.io import FileSaver, ImageReader, FileInfo
 from ij import ImagePlus, IJ
 from synchronize import make_synchronized
-from util import syncPrint, newFixedThreadPool
+from util import syncPrint, newFixedThreadPool, Task, numCPUs, LRUCache
 from ui import showStack, showBDV
 try:
   # Needs 'SiMView' Fiji update site enabled
@@ -38,13 +44,21 @@ try:
   from org.janelia.saalfeldlab.n5 import N5FSReader, N5FSWriter, GzipCompression, RawCompression
 except:
   print "*** n5-imglib2 from github.com/saalfeldlab/n5-imglib2 not installed. ***"
+try:
+  # Buffer-backed accesses, in recent ImgLib2 versions
+  from net.imglib2.img.basictypeaccess.nio import ByteBufferAccess, ShortBufferAccess, FloatBufferAccess
+except:
+  ByteBufferAccess, ShortBufferAccess, FloatBufferAccess = None, None, None
 from com.google.gson import GsonBuilder
 from math import ceil
-from itertools import imap
+from itertools import imap, izip, product
 
 
-def readFloats(path, dimensions, header=0, byte_order=ByteOrder.LITTLE_ENDIAN):
-  """ Read a file as an ArrayImg of FloatType """
+def readFloats(path, dimensions, header=0, byte_order=ByteOrder.LITTLE_ENDIAN, memory_mapped=False):
+  """ Read a file as an ArrayImg of FloatType.
+      memory_mapped: defaults to False. If True, see readMapped. """
+  if memory_mapped:
+    return readMapped(path, dimensions, pixelType=FloatType, header=header, byte_order=byte_order)
   size = reduce(operator.mul, dimensions)
   ra = RandomAccessFile(path, 'r')
   try:
@@ -62,8 +76,11 @@ def readFloats(path, dimensions, header=0, byte_order=ByteOrder.LITTLE_ENDIAN):
     ra.close()
 
 
-def readUnsignedShorts(path, dimensions, header=0, return_array=False, byte_order=ByteOrder.LITTLE_ENDIAN):
-  """ Read a file as an ArrayImg of UnsignedShortType """
+def readUnsignedShorts(path, dimensions, header=0, return_array=False, byte_order=ByteOrder.LITTLE_ENDIAN, memory_mapped=False):
+  """ Read a file as an ArrayImg of UnsignedShortType.
+      memory_mapped: defaults to False. If True and not return_array, see readMapped. """
+  if memory_mapped and not return_array:
+    return readMapped(path, dimensions, pixelType=UnsignedShortType, header=header, byte_order=byte_order)
   size = reduce(operator.mul, dimensions)
   ra = RandomAccessFile(path, 'r')
   try:
@@ -81,8 +98,11 @@ def readUnsignedShorts(path, dimensions, header=0, return_array=False, byte_orde
     ra.close()
 
 
-def readUnsignedBytes(path, dimensions, header=0):
-  """ Read a file as an ArrayImg of UnsignedShortType """
+def readUnsignedBytes(path, dimensions, header=0, memory_mapped=False):
+  """ Read a file as an ArrayImg of UnsignedByteType.
+      memory_mapped: defaults to False. If True, see readMapped. """
+  if memory_mapped:
+    return readMapped(path, dimensions, pixelType=UnsignedByteType, header=header)
   ra = RandomAccessFile(path, 'r')
   try:
     if header < 0:
@@ -97,6 +117,103 @@ def readUnsignedBytes(path, dimensions, header=0):
     ra.close()
 
 
+def mapFile(path, offset, n_bytes, byte_order=ByteOrder.LITTLE_ENDIAN):
+  """ Memory-map n_bytes of the file at path, starting at offset, as a read-only ByteBuffer
+      in the given byte order. A single mapping can't be larger than Integer.MAX_VALUE bytes.
+      The mapping remains valid after the file is closed. """
+  ra = RandomAccessFile(path, 'r')
+  try:
+    return ra.getChannel().map(FileChannel.MapMode.READ_ONLY, offset, n_bytes).order(byte_order)
+  finally:
+    ra.close()
+
+
+# pixelType vs: bytes per pixel, function to create an ArrayImg from an array or an access,
+# function to create an array, function to view a ByteBuffer as the matching buffer,
+# the buffer-backed access class (or None), and the primitive type
+__mapped_types__ = {
+  UnsignedByteType: (1, ArrayImgs.unsignedBytes, lambda n: zeros(n, 'b'), lambda bb: bb,
+                     ByteBufferAccess, PrimitiveType.BYTE),
+  UnsignedShortType: (2, ArrayImgs.unsignedShorts, lambda n: zeros(n, 'h'), lambda bb: bb.asShortBuffer(),
+                      ShortBufferAccess, PrimitiveType.SHORT),
+  FloatType: (4, ArrayImgs.floats, lambda n: zeros(n, 'f'), lambda bb: bb.asFloatBuffer(),
+              FloatBufferAccess, PrimitiveType.FLOAT)
+}
+
+
+class MappedCellLoader(CacheLoader):
+  """ A CacheLoader of Cell instances for a raw image file too large for a single mapping.
+      Cells tile only the last dimension: each is a slab of consecutive planes,
+      copied straight from its own memory-mapped region of the file. """
+  def __init__(self, path, dimensions, cell_dimensions, pixelType, header=0, byte_order=ByteOrder.LITTLE_ENDIAN):
+    self.path = path
+    self.dimensions = dimensions
+    self.cell_dimensions = cell_dimensions
+    self.header = header
+    self.byte_order = byte_order
+    self.n_bytes_per_pixel, _, self.createArray, self.asBuffer, _, _ = __mapped_types__[pixelType]
+    self.Access = {UnsignedByteType: ByteArray, UnsignedShortType: ShortArray, FloatType: FloatArray}[pixelType]
+
+  def get(self, index):
+    plane_size = reduce(operator.mul, self.dimensions[:-1], 1)
+    first = index * self.cell_dimensions[-1]
+    n_planes = min(self.cell_dimensions[-1], self.dimensions[-1] - first)
+    size = plane_size * n_planes
+    bb = mapFile(self.path, self.header + first * plane_size * self.n_bytes_per_pixel,
+                 size * self.n_bytes_per_pixel, self.byte_order)
+    pixels = self.createArray(size)
+    self.asBuffer(bb).get(pixels) # single bulk copy, without byte swapping when in native order
+    return Cell(list(self.dimensions[:-1]) + [n_planes],
+                [0] * (len(self.dimensions) -1) + [first],
+                self.Access(pixels))
+
+  def load(self, index):
+    return self.get(index)
+
+
+def readMapped(path, dimensions, pixelType=UnsignedShortType, header=0, byte_order=ByteOrder.LITTLE_ENDIAN,
+               max_cell_bytes=256 * 1024 * 1024):
+  """ Read a raw image file by memory-mapping it, without first reading it into a byte[].
+
+      path: the file path to the raw image.
+      dimensions: a sequence of integer values e.g. [512, 512, 512], the first moving fastest.
+      pixelType: UnsignedByteType, UnsignedShortType or FloatType.
+      header: the number of bytes before the image data; if negative, counts from the end of the file.
+      byte_order: the byte order of the pixel data in the file. When it is the native order
+                  (see ByteOrder.nativeOrder()), pixels are read without any byte swapping.
+      max_cell_bytes: for files larger than a single mapping, the maximum size of a cell.
+
+      When the image fits in a single mapping (up to 2 GB), returns an ArrayImg:
+      backed directly by the mapped buffer when the ImgLib2 library provides buffer accesses
+      (net.imglib2.img.basictypeaccess.nio), or else copied into an array with a single bulk copy.
+      For larger files, returns a lazy CachedCellImg whose cells are slabs of whole planes,
+      each mapped and copied only when first accessed.
+  """
+  n_bytes_per_pixel, asArrayImg, createArray, asBuffer, BufferAccess, primitiveType = __mapped_types__[pixelType]
+  if header < 0:
+    # Interpret from the end: useful for files with variable header lengths
+    # such as some types of uncompressed TIFF formats
+    header = File(path).length() + header
+  size = reduce(operator.mul, dimensions)
+  n_bytes = size * n_bytes_per_pixel
+  if n_bytes <= Integer.MAX_VALUE:
+    bb = mapFile(path, header, n_bytes, byte_order)
+    if BufferAccess:
+      try:
+        return asArrayImg(BufferAccess(bb, True), dimensions) # zero-copy
+      except:
+        syncPrint("Could not create a buffer-backed image, will copy instead:\n" + str(sys.exc_info()))
+    pixels = createArray(size)
+    asBuffer(bb).get(pixels)
+    return asArrayImg(pixels, dimensions)
+  # Too large for a single mapping: cells of as many whole planes as fit in max_cell_bytes
+  plane_bytes = reduce(operator.mul, dimensions[:-1], 1) * n_bytes_per_pixel
+  n_planes = max(1, min(dimensions[-1], max_cell_bytes / plane_bytes))
+  cell_dimensions = list(dimensions[:-1]) + [n_planes]
+  loader = MappedCellLoader(path, dimensions, cell_dimensions, pixelType, header=header, byte_order=byte_order)
+  return lazyCachedCellImg(loader, dimensions, cell_dimensions, pixelType, primitiveType)
+
+
 __klb__ = KLB.newInstance()
 
 def readKLB(path):
@@ -122,14 +239,88 @@ def readIJ(path):
   return IJ.openImage(path)
 
 
+# KLB data type code vs pixelType, bytes per pixel, array typecode, access and primitive type
+__klb_types__ = {0: (UnsignedByteType, 1, 'b', ByteArray, PrimitiveType.BYTE),
+                 1: (UnsignedShortType, 2, 'h', ShortArray, PrimitiveType.SHORT),
+                 8: (FloatType, 4, 'f', FloatArray, PrimitiveType.FLOAT)}
+
+# Cells of all KLB files read with readKLBBlocks, keyed by file path and cell index,
+# so that e.g. the images of all cameras share a single pool of soft references.
+__klb_block_cache__ = SoftRefLoaderCache()
+
+
+class KLBBlockLoader(CacheLoader):
+  """ A CacheLoader of Cell instances, one per block of a KLB file.
+      KLB files are compressed block by block, so loading a cell
+      decompresses only the one block it maps to. """
+  def __init__(self, path, klb=None):
+    self.path = path
+    self.klb = klb if klb else __klb__
+    header = self.klb.readHeader(path)
+    # KLB images are 5D (XYZCT): drop the trailing dimensions of size 1, but keep XYZ
+    n_dims = max([3] + [d + 1 for d in xrange(5) if header.imageSize[d] > 1])
+    self.dimensions = list(header.imageSize)[:n_dims]
+    self.cell_dimensions = [int(b) for b in list(header.blockSize)[:n_dims]]
+    self.pixelType, self.n_bytes_per_pixel, self.typecode, self.Access, self.primitiveType = __klb_types__[header.dataType]
+    self.grid = CellGrid(self.dimensions, self.cell_dimensions)
+
+  def get(self, index):
+    cell_min = zeros(len(self.dimensions), 'l')
+    cell_dims = zeros(len(self.dimensions), 'i')
+    self.grid.getCellDimensions(index, cell_min, cell_dims)
+    padding = [0] * (5 - len(self.dimensions))
+    xyzct_min = list(cell_min) + padding
+    xyzct_max = [m + d - 1 for m, d in izip(cell_min, cell_dims)] + padding
+    size = reduce(operator.mul, cell_dims)
+    bytes = zeros(size * self.n_bytes_per_pixel, 'b')
+    self.klb.readROIinPlace(self.path, xyzct_min, xyzct_max, bytes)
+    if 1 == self.n_bytes_per_pixel:
+      pixels = bytes
+    else:
+      # Decompressed in the native byte order
+      pixels = zeros(size, self.typecode)
+      bb = ByteBuffer.wrap(bytes).order(ByteOrder.nativeOrder())
+      (bb.asShortBuffer() if 2 == self.n_bytes_per_pixel else bb.asFloatBuffer()).get(pixels)
+    return Cell(cell_dims, cell_min, self.Access(pixels))
+
+  def load(self, index):
+    return self.get(index)
+
+
+def readKLBBlocks(path, cache=__klb_block_cache__):
+  """ Open a KLB file as a lazy CachedCellImg with one cell per KLB block,
+      so that only the blocks that are accessed are read and decompressed:
+      e.g. when cropping the image to a region of interest.
+
+      path: the file path to the KLB file.
+      cache: defaults to a SoftRefLoaderCache shared by all KLB files opened with this function.
+             Its keys are pairs of file path and cell index.
+
+      Returns a CachedCellImg of UnsignedByteType, UnsignedShortType or FloatType. """
+  loader = KLBBlockLoader(path)
+  keymap = KeyBimap.build(lambda index: (path, index), # cell index to key in the shared cache
+                          lambda key: key[1])
+  return lazyCachedCellImg(loader, loader.dimensions, loader.cell_dimensions,
+                           loader.pixelType, loader.primitiveType,
+                           cache=cache.mapKeys(keymap))
+
+
 class KLBLoader(CacheLoader):
-  def __init__(self):
+  def __init__(self, lazy=False, cache=__klb_block_cache__):
+    """ lazy: defaults to False, to read and decompress whole KLB files.
+              If True, return instead a CachedCellImg that decompresses blocks
+              only when accessed, see readKLBBlocks.
+        cache: the cache for the blocks when lazy. """
     self.klb = KLB.newInstance()
+    self.lazy = lazy
+    self.cache = cache
 
   def load(self, path):
     return self.get(path)
 
   def get(self, path):
+    if self.lazy:
+      return readKLBBlocks(path, cache=self.cache)
     return self.klb.readFull(path)
 
 
@@ -196,7 +387,260 @@ class SectionCellLoader(CacheLoader):
                 img.update(None))
 
 
-def lazyCachedCellImg(loader, volume_dimensions, cell_dimensions, pixelType, primitiveType):
+# Array typecode vs the method of ByteBuffer to view it as a buffer of that type, and bytes per element
+__buffer_views__ = {'b': (lambda bb: bb, 1),
+                    'h': (lambda bb: bb.asShortBuffer(), 2),
+                    'i': (lambda bb: bb.asIntBuffer(), 4),
+                    'l': (lambda bb: bb.asLongBuffer(), 8),
+                    'f': (lambda bb: bb.asFloatBuffer(), 4),
+                    'd': (lambda bb: bb.asDoubleBuffer(), 8)}
+
+
+class CompressedCellCache(LoaderCache):
+  """ A two-tier LoaderCache of Cell instances:
+        1. hot cells are kept as they are, in an LRU cache of up to max_cells;
+        2. cells evicted from the hot tier are compressed with java.util.zip.Deflater
+           and kept, up to max_compressed_bytes in total, until evicted in turn,
+           least recently used first.
+      A cell found in the compressed tier is decompressed and moved back to the hot tier,
+      so that revisiting a cell, e.g. a section during export or browsing, doesn't reload it.
+      Concurrent requests for the same cell wait on a single load or decompression.
+      Compression and decompression run outside of the lock that guards both tiers,
+      so that threads requesting other cells don't wait on them.
+
+      Use like any LoaderCache, e.g. in lazyCachedCellImg(..., cache=CompressedCellCache()).
+      See stats() for hits, misses and compression ratios. """
+  def __init__(self, max_cells=64, max_compressed_bytes=1024 * 1024 * 1024, compression_level=1):
+    """ max_cells: the maximum number of cells to keep uncompressed.
+        max_compressed_bytes: the maximum number of bytes of compressed cells to keep.
+        compression_level: from 1 (fastest, the default) to 9 (smallest), see java.util.zip.Deflater. """
+    self.hot = LRUCache(max_cells, eldestFn=lambda entry: self.evict(*entry))
+    self.evicted = {} # key vs cell evicted from the hot tier and not yet compressed
+    self.to_compress = [] # keys of evicted cells, in order of eviction
+    self.cold = LinkedHashMap(16, 0.75, True) # in access order: key vs compressed cell
+    self.max_compressed_bytes = max_compressed_bytes
+    self.compression_level = compression_level
+    self.compressed_bytes = 0
+    self.pending = {} # key vs FutureTask loading or decompressing it, and whether it decompresses
+    self.hot_hits = 0
+    self.cold_hits = 0
+    self.misses = 0
+    self.n_compressed = 0
+    self.n_dropped = 0
+    self.uncompressed_bytes = 0 # of the compressed cells in memory, for the compression ratio
+
+  def evict(self, key, cell):
+    # Called from within the synchronized methods that put cells into the hot tier:
+    # only queue the cell, to be compressed by compressEvicted once the lock is released
+    self.evicted[key] = cell
+    self.to_compress.append(key)
+
+  @make_synchronized
+  def nextEvicted(self):
+    """ Returns the key and cell of the next evicted cell to compress, or None when there are none.
+        The cell remains in self.evicted, and can be requested, until compressed. """
+    while self.to_compress:
+      key = self.to_compress.pop(0)
+      cell = self.evicted.get(key, None)
+      if cell is not None:
+        return key, cell
+    return None
+
+  def compressEvicted(self):
+    """ Compress, outside of the lock, the cells evicted from the hot tier. """
+    while True:
+      evicted = self.nextEvicted()
+      if evicted is None:
+        return
+      key, cell = evicted
+      self.stash(key, cell, self.compress(cell))
+
+  def compress(self, cell):
+    dims = zeros(cell.numDimensions(), 'i')
+    cell.dimensions(dims)
+    cell_min = zeros(cell.numDimensions(), 'l')
+    cell.min(cell_min)
+    access = cell.getData()
+    data = access.getCurrentStorageArray()
+    asBuffer, n_bytes = __buffer_views__[data.typecode]
+    bb = ByteBuffer.allocate(len(data) * n_bytes)
+    asBuffer(bb).put(data)
+    deflater = Deflater(self.compression_level)
+    deflater.setInput(bb.array())
+    deflater.finish()
+    out = ByteArrayOutputStream(max(64, len(data) * n_bytes / 4))
+    buf = zeros(65536, 'b')
+    while not deflater.finished():
+      out.write(buf, 0, deflater.deflate(buf))
+    deflater.end()
+    return (out.toByteArray(), dims, cell_min, data.typecode, len(data), access.getClass())
+
+  @make_synchronized
+  def stash(self, key, cell, entry):
+    """ Move the compressed cell into the cold tier, unless it was requested again,
+        and so moved back to the hot tier, or invalidated while being compressed. """
+    if self.evicted.get(key, None) is not cell:
+      return
+    del self.evicted[key]
+    compressed, dims, cell_min, typecode, length, Access = entry
+    self.cold.put(key, entry)
+    self.compressed_bytes += len(compressed)
+    self.uncompressed_bytes += length * __buffer_views__[typecode][1]
+    self.n_compressed += 1
+    # Drop the least recently used compressed cells when over budget
+    it = self.cold.entrySet().iterator()
+    while self.compressed_bytes > self.max_compressed_bytes and it.hasNext():
+      self.discount(it.next().getValue())
+      it.remove()
+      self.n_dropped += 1
+
+  def discount(self, entry):
+    # Account for the removal of a compressed cell
+    compressed, dims, cell_min, typecode, length, Access = entry
+    self.compressed_bytes -= len(compressed)
+    self.uncompressed_bytes -= length * __buffer_views__[typecode][1]
+
+  def decompress(self, entry):
+    compressed, dims, cell_min, typecode, length, Access = entry
+    asBuffer, n_bytes = __buffer_views__[typecode]
+    bytes = zeros(length * n_bytes, 'b')
+    inflater = Inflater()
+    inflater.setInput(compressed)
+    offset = 0
+    while offset < len(bytes) and not inflater.finished():
+      offset += inflater.inflate(bytes, offset, len(bytes) - offset)
+    inflater.end()
+    data = zeros(length, typecode)
+    asBuffer(ByteBuffer.wrap(bytes)).get(data)
+    try:
+      access = Access(data)
+    except:
+      access = Access(data, True) # a volatile access: valid
+    return Cell(dims, cell_min, access)
+
+  @make_synchronized
+  def lookup(self, key):
+    """ Returns the cell for key if uncompressed, or else the FutureTask that decompresses it
+        and whether the caller must run it, or None when the cell isn't cached. """
+    cell = self.hot.get(key)
+    if cell is not None:
+      self.hot_hits += 1
+      return cell[1], None, False
+    cell = self.evicted.pop(key, None)
+    if cell is not None:
+      # Not compressed yet: back to the hot tier
+      self.hot_hits += 1
+      self.hot.put(key, (key, cell))
+      return cell, None, False
+    task, decompressing = self.pending.get(key, (None, False))
+    if decompressing:
+      return None, task, False
+    entry = self.cold.remove(key)
+    if entry is not None:
+      self.cold_hits += 1
+      self.discount(entry)
+      task = FutureTask(Task(self.decompress, entry))
+      self.pending[key] = (task, True)
+      return None, task, True
+    return None, None, False
+
+  def getIfPresent(self, key):
+    key = long(key) # same key type regardless of the caller
+    cell, task, run = self.lookup(key)
+    if task is not None:
+      if run:
+        self.complete(key, task)
+      cell = task.get()
+    self.compressEvicted()
+    return cell
+
+  @make_synchronized
+  def contains(self, key):
+    """ Whether the cell for key is in either tier or being loaded, without side effects:
+        unlike getIfPresent, a compressed cell is not decompressed nor moved to the hot tier,
+        the order of least recent use is unchanged, and no hit is counted. """
+    key = long(key)
+    return self.hot.containsKey(key) or key in self.evicted or self.cold.containsKey(key) or key in self.pending
+
+  @make_synchronized
+  def pendingLoad(self, key, loader):
+    """ Returns the FutureTask that loads the cell for key, and whether the caller must run it. """
+    task, decompressing = self.pending.get(key, (None, False))
+    if task:
+      return task, False
+    self.misses += 1
+    task = FutureTask(Task(loader.get, key))
+    self.pending[key] = (task, False)
+    return task, True
+
+  @make_synchronized
+  def loaded(self, key, task, cell):
+    # Unless invalidated meanwhile, which removed the task from pending
+    if self.pending.get(key, (None, False))[0] is task:
+      del self.pending[key]
+      if cell is not None:
+        self.hot.put(key, (key, cell))
+
+  def complete(self, key, task):
+    """ Run the FutureTask that loads or decompresses the cell for key,
+        and move the cell into the hot tier. """
+    cell = None
+    try:
+      task.run()
+      cell = task.get()
+    finally:
+      self.loaded(key, task, cell)
+
+  def get(self, key, loader):
+    key = long(key)
+    cell = self.getIfPresent(key)
+    if cell is not None:
+      return cell
+    task, run = self.pendingLoad(key, loader)
+    if run:
+      self.complete(key, task)
+      self.compressEvicted()
+    return task.get()
+
+  def withLoader(self, loader):
+    return LoaderCacheAsCacheAdapter(self, loader)
+
+  @make_synchronized
+  def invalidate(self, key):
+    key = long(key)
+    self.hot.remove(key)
+    self.evicted.pop(key, None)
+    self.pending.pop(key, None)
+    entry = self.cold.remove(key)
+    if entry is not None:
+      self.discount(entry)
+
+  @make_synchronized
+  def invalidateAll(self):
+    self.hot.clear()
+    self.evicted.clear()
+    self.to_compress = []
+    self.cold.clear()
+    self.pending.clear()
+    self.compressed_bytes = 0
+    self.uncompressed_bytes = 0
+
+  def stats(self):
+    """ Returns a dictionary with the number of hits in each tier, of misses, of cells in each tier,
+        of compressed and dropped cells, the bytes used by compressed cells and the compression ratio. """
+    return {"hot_hits": self.hot_hits,
+            "cold_hits": self.cold_hits,
+            "misses": self.misses,
+            "hot_cells": self.hot.size() + len(self.evicted),
+            "compressed_cells": self.cold.size(),
+            "compressed_bytes": self.compressed_bytes,
+            "n_compressed": self.n_compressed,
+            "n_dropped": self.n_dropped,
+            "compression_ratio": self.uncompressed_bytes / float(self.compressed_bytes) if self.compressed_bytes > 0 else 0.0}
+
+
+def lazyCachedCellImg(loader, volume_dimensions, cell_dimensions, pixelType, primitiveType, cache=None,
+                      prefetch=0, block_depth=0, n_threads=0):
   """ Create a lazy CachedCellImg, backed by a SoftRefLoaderCache,
       which can be used to e.g. create the equivalent of ij.VirtualStack but with ImgLib2,
       with the added benefit of a cache based on SoftReference (i.e. no need to manage memory).
@@ -207,23 +651,271 @@ def lazyCachedCellImg(loader, volume_dimensions, cell_dimensions, pixelType, pri
       cell_dimensions: a list of int or long numbers, whose last dimension is 1.
       pixelType: e.g. UnsignedByteType
       primitiveType: e.g. BYTE
+      cache: defaults to None, meaning a new SoftRefLoaderCache. Otherwise e.g.
+             a BoundedSoftRefLoaderCache, possibly shared with other images of the same loader,
+             or a CompressedCellCache to keep evicted cells compressed in memory.
+      prefetch: defaults to 0. When larger than zero, watch which cells are requested
+                and load asynchronously the next prefetch cells in the direction of the sweep,
+                see PrefetchingCache. Call img.getCache().close() when done.
+      block_depth: defaults to 0. When larger than zero, also load asynchronously the rest
+                   of the cells of the current block of that many cells, e.g. the sections
+                   needed for the current Z-block when writing to N5.
+      n_threads: the number of threads for loading cells ahead. Defaults to as many as CPU cores.
 
       Returns a CachedCellImg.
   """
-  return CachedCellImg(CellGrid(volume_dimensions, cell_dimensions),
+  grid = CellGrid(volume_dimensions, cell_dimensions)
+  if prefetch > 0 or block_depth > 0:
+    cellCache = PrefetchingCache(loader, grid, prefetch=prefetch, n_threads=n_threads,
+                                 cache=cache, block_depth=block_depth)
+  else:
+    cellCache = (cache if cache else SoftRefLoaderCache()).withLoader(loader)
+  return CachedCellImg(grid,
                        pixelType(),
-                       SoftRefLoaderCache().withLoader(loader),
+                       cellCache,
                        ArrayDataAccessFactory.get(primitiveType, AccessFlags.setOf(AccessFlags.VOLATILE)))
 
 
-def readN5(path, dataset_name, show=None):
+# N5 data type name vs pixelType, array typecode, access and primitive type
+__n5_types__ = {"uint8": (UnsignedByteType, 'b', ByteArray, PrimitiveType.BYTE),
+                "int8": (ByteType, 'b', ByteArray, PrimitiveType.BYTE),
+                "uint16": (UnsignedShortType, 'h', ShortArray, PrimitiveType.SHORT),
+                "int16": (ShortType, 'h', ShortArray, PrimitiveType.SHORT),
+                "uint32": (UnsignedIntType, 'i', IntArray, PrimitiveType.INT),
+                "int32": (IntType, 'i', IntArray, PrimitiveType.INT),
+                "uint64": (UnsignedLongType, 'l', LongArray, PrimitiveType.LONG),
+                "int64": (LongType, 'l', LongArray, PrimitiveType.LONG),
+                "float32": (FloatType, 'f', FloatArray, PrimitiveType.FLOAT),
+                "float64": (DoubleType, 'd', DoubleArray, PrimitiveType.DOUBLE)}
+
+
+class N5BlockLoader(CacheLoader):
+  """ A CacheLoader of Cell instances, one per block of an N5 dataset,
+      which keeps count of the number of blocks decoded and the time spent decoding them. """
+  def __init__(self, n5, dataset_name):
+    self.n5 = n5
+    self.dataset_name = dataset_name
+    self.attributes = n5.getDatasetAttributes(dataset_name)
+    dataType = str(self.attributes.getDataType())
+    if dataType not in __n5_types__:
+      raise Exception("Unsupported N5 data type %s in %s: open it with N5Utils.open instead." % (dataType, dataset_name))
+    self.pixelType, self.typecode, self.Access, self.primitiveType = __n5_types__[dataType]
+    self.grid = CellGrid(self.attributes.getDimensions(), self.attributes.getBlockSize())
+    self.n_decoded = 0
+    self.decode_time = 0 # nanoseconds
+
+  @make_synchronized
+  def record(self, nanoseconds):
+    self.n_decoded += 1
+    self.decode_time += nanoseconds
+
+  def get(self, index):
+    cell_min = zeros(self.grid.numDimensions(), 'l')
+    cell_dims = zeros(self.grid.numDimensions(), 'i')
+    self.grid.getCellDimensions(index, cell_min, cell_dims)
+    blockSize = self.attributes.getBlockSize()
+    t0 = System.nanoTime()
+    block = self.n5.readBlock(self.dataset_name, self.attributes,
+                              array([m / b for m, b in izip(cell_min, blockSize)], 'l'))
+    self.record(System.nanoTime() - t0)
+    # Blocks never written are empty
+    data = block.getData() if block else zeros(reduce(operator.mul, cell_dims), self.typecode)
+    return Cell(cell_dims, cell_min, self.Access(data))
+
+  def load(self, index):
+    return self.get(index)
+
+
+class PrefetchingCache(Cache):
+  """ A Cache of the Cell instances of a CachedCellImg that detects the direction in which
+      cells are being swept along one dimension (by default the last, e.g. Z or T),
+      and loads the cells ahead of the sweep on a thread pool, so that decoding happens
+      in parallel and ahead of time rather than serially on the thread that touches each cell.
+      Only cells ahead of those accessed in the current slab of cells are prefetched,
+      so that sweeping a region of interest doesn't load the whole volume.
+      A sweep is assumed to go forward when its first access is to the first slab,
+      and backward when to the last one.
+      Cells already being loaded are not requested again.
+
+      Counts hits, misses and prefetched cells: see stats().
+      Call close() when done, to shut down the thread pool. """
+  def __init__(self, loader, grid, prefetch=2, n_threads=0, max_cached_cells=0, sweep_dimension=-1,
+               cache=None, block_depth=0):
+    """ loader: the CacheLoader of Cell instances, e.g. an N5BlockLoader or a SectionCellLoader.
+        grid: the CellGrid of the CachedCellImg.
+        prefetch: how many slabs of cells to load ahead of the sweep.
+        n_threads: for the thread pool that loads cells ahead. Defaults to as many as CPU cores.
+        max_cached_cells: defaults to 0, meaning unbounded: cells are cached with SoftReference.
+                          Otherwise the maximum number of cells to keep strongly cached.
+        sweep_dimension: defaults to the last dimension.
+        cache: defaults to None. The LoaderCache to hold the cells, e.g. a CompressedCellCache.
+               When given, max_cached_cells is ignored.
+        block_depth: defaults to 0. When larger than zero, and in slabs of cells, also prefetch
+                     up to the end of the current block of that depth along the sweep dimension:
+                     e.g. all the sections needed for writing the current Z-block of an N5 volume. """
+    self.loader = loader
+    if cache:
+      self.cache = cache
+    else:
+      self.cache = BoundedSoftRefLoaderCache(max_cached_cells) if max_cached_cells > 0 else SoftRefLoaderCache()
+    self.grid_dimensions = grid.getGridDimensions()
+    self.prefetch = prefetch
+    self.block_depth = block_depth
+    self.exe = newFixedThreadPool(n_threads=n_threads, name="jython-prefetcher")
+    self.sweep_dimension = sweep_dimension % grid.numDimensions()
+    self.last = None # the coordinate in the grid along the sweep dimension of the last access
+    self.direction = 0 # 1 or -1 once detected
+    self.columns = set() # grid coordinates, except along the sweep dimension, accessed in the current slab
+    self.pending = set() # indices of cells being prefetched
+    self.hits = 0
+    self.misses = 0
+    self.n_prefetched = 0
+
+  def getIfPresent(self, index):
+    return self.cache.getIfPresent(Long(index))
+
+  def get(self, index):
+    key = Long(index) # a java.lang.Long, like the keys used by CachedCellImg
+    cell = self.cache.getIfPresent(key)
+    hit = cell is not None
+    if not hit:
+      cell = self.cache.get(key, self.loader)
+    self.accessed(index, hit)
+    return cell
+
+  def invalidateAll(self):
+    self.cache.invalidateAll()
+
+  @make_synchronized
+  def accessed(self, index, hit):
+    if hit:
+      self.hits += 1
+    else:
+      self.misses += 1
+    position = zeros(len(self.grid_dimensions), 'l')
+    IntervalIndexer.indexToPosition(index, self.grid_dimensions, position)
+    c = position[self.sweep_dimension]
+    column = tuple(position[d] for d in xrange(len(position)) if d != self.sweep_dimension)
+    if self.last is None:
+      # A sweep from either end
+      if 0 == c:
+        self.direction = 1
+      elif self.grid_dimensions[self.sweep_dimension] -1 == c:
+        self.direction = -1
+    if self.last is not None and c != self.last:
+      # Moved on to another slab of cells: continue ahead those columns accessed in the previous slab
+      self.direction = 1 if c > self.last else -1
+      previous = self.columns
+      self.columns = set([column])
+      for col in previous:
+        self.prefetchAhead(col, c)
+      if column not in previous:
+        self.prefetchAhead(column, c)
+    elif column not in self.columns:
+      self.columns.add(column)
+      if self.direction:
+        self.prefetchAhead(column, c)
+    self.last = c
+
+  def prefetchAhead(self, column, c):
+    # Called only from the synchronized accessed method
+    n_ahead = self.prefetch
+    if self.block_depth > 0:
+      # Up to the end of the current block
+      if self.direction > 0:
+        n_ahead = max(n_ahead, (c / self.block_depth + 1) * self.block_depth -1 - c)
+      else:
+        n_ahead = max(n_ahead, c - (c / self.block_depth) * self.block_depth)
+    for k in xrange(1, n_ahead + 1):
+      cc = c + self.direction * k
+      if cc < 0 or cc >= self.grid_dimensions[self.sweep_dimension]:
+        break
+      position = list(column)
+      position.insert(self.sweep_dimension, cc)
+      index = IntervalIndexer.positionToIndex(array(position, 'l'), self.grid_dimensions)
+      if index not in self.pending and not self.isCached(index):
+        self.pending.add(index)
+        self.exe.submit(Task(self.load, index))
+
+  def isCached(self, index):
+    # Probe without side effects when the cache supports it, like CompressedCellCache.contains,
+    # rather than with getIfPresent, which may decompress the cell and reorder or evict others
+    if hasattr(self.cache, "contains"):
+      return self.cache.contains(Long(index))
+    return self.cache.getIfPresent(Long(index)) is not None
+
+  def load(self, index):
+    try:
+      self.cache.get(Long(index), self.loader)
+      self.prefetched(index)
+    except:
+      syncPrint("Failed to prefetch cell %i:\n%s" % (index, str(sys.exc_info())))
+      self.prefetched(index, count=False)
+
+  @make_synchronized
+  def prefetched(self, index, count=True):
+    self.pending.discard(index)
+    if count:
+      self.n_prefetched += 1
+
+  def stats(self):
+    """ Returns a dictionary with the number of hits and misses, the hit rate,
+        the number of cells prefetched, and, when the loader keeps count (like N5BlockLoader),
+        the number of cells decoded and the total and average decoding time in milliseconds. """
+    n = self.hits + self.misses
+    d = {"hits": self.hits,
+         "misses": self.misses,
+         "hit_rate": self.hits / float(n) if n > 0 else 0.0,
+         "prefetched": self.n_prefetched}
+    if hasattr(self.loader, "decode_time"):
+      d["decoded"] = self.loader.n_decoded
+      d["decode_time_ms"] = self.loader.decode_time / 1000000.0
+      d["mean_decode_time_ms"] = d["decode_time_ms"] / self.loader.n_decoded if self.loader.n_decoded > 0 else 0.0
+    return d
+
+  def close(self):
+    self.exe.shutdownNow()
+
+
+def readN5Prefetching(path, dataset_name, prefetch=2, n_threads=0, max_cached_blocks=0, sweep_dimension=-1):
+  """ Open an N5 dataset as a CachedCellImg whose blocks are decoded ahead of a sweep
+      along the sweep_dimension (by default the last one, e.g. Z or T) on a thread pool.
+      See PrefetchingCache.
+
+      The PrefetchingCache is img.getCache(): call its stats() method for the hit rate
+      and decoding times, and its close() method when done. """
+  loader = N5BlockLoader(N5FSReader(path, GsonBuilder()), dataset_name)
+  cache = PrefetchingCache(loader, loader.grid, prefetch=prefetch, n_threads=n_threads,
+                           max_cached_cells=max_cached_blocks, sweep_dimension=sweep_dimension)
+  return CachedCellImg(loader.grid,
+                       loader.pixelType(),
+                       cache,
+                       ArrayDataAccessFactory.get(loader.primitiveType, AccessFlags.setOf(AccessFlags.VOLATILE)))
+
+
+def readN5(path, dataset_name, show=None, prefetch=0, n_threads=0, max_cached_blocks=0):
   """ path: filepath to the folder with N5 data.
       dataset_name: name of the dataset to use (there could be more than one).
       show: defaults to None. "IJ" for virtual stack, "BDV" for BigDataViewer.
+      prefetch: defaults to 0. When larger than zero, decode that many slabs of blocks
+                ahead of sweeps along the last dimension, see readN5Prefetching.
+      n_threads: for prefetching. Defaults to as many as CPU cores.
+      max_cached_blocks: when prefetching, defaults to 0, meaning no bound.
+      Data types without prefetching support (see __n5_types__) are read without prefetching.
       
       If "IJ", returns the RandomAccessibleInterval and the ImagePlus.
       If "BDV", returns the RandomAccessibleInterval and the bdv instance. """
-  img = N5Utils.open(N5FSReader(path, GsonBuilder()), dataset_name)
+  n5 = N5FSReader(path, GsonBuilder())
+  if prefetch > 0:
+    dataType = str(n5.getDatasetAttributes(dataset_name).getDataType())
+    if dataType not in __n5_types__:
+      syncPrint("Can't prefetch N5 data of type %s: reading %s without prefetching." % (dataType, dataset_name))
+      prefetch = 0
+  if prefetch > 0:
+    img = readN5Prefetching(path, dataset_name, prefetch=prefetch, n_threads=n_threads,
+                            max_cached_blocks=max_cached_blocks)
+  else:
+    img = N5Utils.open(n5, dataset_name)
   if show:
     if "IJ" == show:
       return img, showStack(img, title=dataset_name)
@@ -247,6 +939,131 @@ def writeN5(img, path, dataset_name, blockSize, gzip_compression_level=4, n_thre
                newFixedThreadPool(n_threads=n_threads, name="jython-n5writer"))
 
 
+def writeN5Multiscale(img, path, dataset_name, blockSize, n_levels=0, min_width=32,
+                      gzip_compression_level=4, n_threads=0):
+  """ Write img and its area-averaging pyramid to N5 in a single pass over img,
+      as the multiscale datasets dataset_name/s0, dataset_name/s1, ... where each level
+      is half the size of the previous one in every dimension.
+
+      img is read in slabs along its last dimension, each blockSize[-1] deep, and each slab
+      block by block on a thread pool: every block is copied into an ArrayImg of blockSize,
+      written, and area-averaged into the slab of s1, so no copy of a whole s0 slab is ever made.
+      The slab of each further level is a CellImg with cells of blockSize, which is written
+      block by block when full, each block being averaged into the slab of the next level.
+      At most one slab per level from s1 onward is held in memory, each a quarter the size
+      of that of the previous level: about a third of an s0 slab in total.
+
+      img: the RandomAccessibleInterval to store in N5 format, e.g. a lazy CachedCellImg.
+      path: the directory to store the N5 data.
+      dataset_name: the name of the group containing the scale levels.
+      blockSize: an array or list as long as dimensions has the img. Must be even
+                 in every dimension when writing more than one level.
+      n_levels: defaults to 0, meaning as many levels as possible until the width is min_width or less.
+      min_width: the smallest width of the last level, when n_levels is 0.
+      gzip_compression_level: defaults to 4, ranges from 0 (no compression) to 9 (maximum;
+                              see java.util.zip.Deflater for details.).
+      n_threads: defaults to as many as CPU cores, for parallel copying and writing of blocks.
+
+      Writes the "scales" and "multiScale" attributes of the group, and the "downsamplingFactors"
+      attribute of each level, as expected by e.g. BigDataViewer's N5 viewers. """
+  n_dims = img.numDimensions()
+  # Dimensions of every level
+  levels = [Intervals.dimensionsAsLongArray(img)]
+  while (0 == n_levels and levels[-1][0] > min_width) or len(levels) < n_levels:
+    dims = [d / 2 for d in levels[-1]]
+    if 0 in dims:
+      break
+    levels.append(dims)
+  if len(levels) > 1 and any(0 != b % 2 for b in blockSize):
+    # Each block then averages into a whole region of a single block of the next level
+    raise ValueError("blockSize must be even in every dimension, got %s" % str(list(blockSize)))
+  depth = blockSize[-1]
+
+  pixelType = img.randomAccess().get().createVariable()
+  n5 = N5FSWriter(path, GsonBuilder())
+  compression = GzipCompression(gzip_compression_level) if gzip_compression_level > 0 else RawCompression()
+  n5.createGroup(dataset_name)
+  for i, dims in enumerate(levels):
+    name = "%s/s%i" % (dataset_name, i)
+    n5.createDataset(name, dims, blockSize, N5Utils.dataType(pixelType), compression)
+    n5.setAttribute(name, "downsamplingFactors", array([pow(2, i)] * n_dims, 'l'))
+  n5.setAttribute(dataset_name, "scales", array([array([pow(2, i)] * n_dims, 'd') for i in xrange(len(levels))],
+                                                Class.forName("[D")))
+  n5.setAttribute(dataset_name, "multiScale", True)
+
+  exe = newFixedThreadPool(n_threads=n_threads, name="jython-n5writer")
+  # For each level: the slab being filled, how many of its planes are filled, and the next slab index
+  cellFactory = CellImgFactory(pixelType, array(blockSize, 'i'))
+  slabs = [None] + [cellFactory.create(list(dims[:-1]) + [min(depth, dims[-1])])
+                    for dims in levels[1:]]
+  filled = [0] * len(levels)
+  z_indices = [0] * len(levels)
+  # Offsets of the corners of the 2x2x... box averaged into one pixel of the next level
+  corners = list(product([0, 1], repeat=n_dims))
+
+  def downsampleBlock(level, block, position, z):
+    # Area-average the block (zero-min, from position in its slab) into the slab of level,
+    # at plane z onward: a region within a single cell of the slab, so blocks don't overlap
+    if level == len(levels):
+      return
+    half = [block.dimension(d) / 2 for d in xrange(n_dims)]
+    if 0 in half:
+      return
+    views = [Views.subsample(Views.zeroMin(Views.interval(block, corner, [c + 2 * (h -1) for c, h in izip(corner, half)])), 2)
+             for corner in corners]
+    minC = [c / 2 for c in position] + [z]
+    target = Views.interval(slabs[level], minC, [c + h -1 for c, h in izip(minC, half)])
+    average = div(add(*views), len(views)).view(FloatType(), pixelType.createVariable())
+    ImgUtil.copy(average, Views.zeroMin(target))
+
+  def writeBlock(level, slab, position, minC, maxC, gridOffset):
+    # Write a block of the slab of level, or of img for level 0 after copying it into an ArrayImg,
+    # and average it into the slab of the next level
+    if 0 == level:
+      block = ArrayImgFactory(pixelType).create([mx - mn + 1 for mn, mx in izip(minC, maxC)])
+      ImgUtil.copy(Views.zeroMin(Views.interval(img, minC, maxC)), block)
+    else:
+      block = Views.zeroMin(Views.interval(slab, minC, maxC))
+    N5Utils.saveBlock(block, n5, "%s/s%i" % (dataset_name, level), gridOffset)
+    downsampleBlock(level + 1, block, position, filled[level + 1] if level + 1 < len(levels) else 0)
+
+  def writeSlab(level, slab, z, slab_depth):
+    # Write every block of the slab, in parallel, at the current slab index of the level.
+    # slab is img for level 0, with the slab starting at plane z
+    dims = levels[level]
+    grid = [xrange(0, dims[d], blockSize[d]) for d in xrange(n_dims -1)]
+    futures = []
+    for position in product(*grid):
+      minC = list(position) + [z]
+      maxC = [min(c + blockSize[d], dims[d]) -1 for d, c in enumerate(position)] + [z + slab_depth -1]
+      gridOffset = array([c / blockSize[d] for d, c in enumerate(position)] + [z_indices[level]], 'l')
+      futures.append(exe.submit(Task(writeBlock, level, slab, list(position), minC, maxC, gridOffset)))
+    for f in futures:
+      f.get()
+    z_indices[level] += 1
+    if level + 1 < len(levels):
+      filled[level + 1] += slab_depth / 2
+      if filled[level + 1] == slabs[level + 1].dimension(n_dims -1):
+        flush(level + 1)
+
+  def flush(level):
+    if 0 == filled[level]:
+      return
+    n_planes = filled[level]
+    filled[level] = 0
+    writeSlab(level, slabs[level], 0, n_planes)
+
+  try:
+    dims = levels[0]
+    for z in xrange(0, dims[-1], depth):
+      writeSlab(0, img, z, min(depth, dims[-1] - z))
+    # Write the partially filled slabs at the end of each level
+    for level in xrange(1, len(levels)):
+      flush(level)
+  finally:
+    exe.shutdown()
+
+
 def read2DImageROI(path, dimensions, interval, pixelType=UnsignedShortType, header=0, byte_order=ByteOrder.LITTLE_ENDIAN):
   """ Read a region of interest (the interval) of an image in a file.
       Assumes the image is written with the first dimension moving slowest.
@@ -302,6 +1119,103 @@ def read2DImageROI(path, dimensions, interval, pixelType=UnsignedShortType, head
     ra.close()
 
 
+def readImageROIs(path, dimensions, intervals, pixelType=UnsignedShortType, header=0,
+                  byte_order=ByteOrder.LITTLE_ENDIAN, memory_mapped=False,
+                  max_gap=4096, max_read_bytes=64 * 1024 * 1024):
+  """ Read many regions of interest of a 2D or 3D (or any N-dimensional) raw image file at once,
+      e.g. all the blockmatching patches or nuclei crops of one section or volume.
+      Assumes the image is written with the first dimension moving fastest.
+
+      The rows of all ROIs are sorted by their position in the file, and rows that overlap
+      or are less than max_gap bytes apart are merged into a single read of up to max_read_bytes,
+      so that each contiguous byte range of the file is read only once, with the file opened once.
+
+      path: the file path to the image file.
+      dimensions: a sequence of integer values e.g. [512, 512, 512]
+      intervals: a sequence of intervals, each two sequences of integer values defining
+                 the min and max coordinates (inclusive), e.g. [[20, 0], [400, 550]]
+      pixelType: UnsignedByteType, UnsignedShortType or FloatType.
+      header: the number of bytes before the image data; if negative, counts from the end of the file.
+      byte_order: the byte order of the pixel data in the file.
+      memory_mapped: defaults to False. If True, map the range of the file spanned by all ROIs
+                     and copy each row from the mapping instead of reading it.
+      max_gap: the largest number of bytes between two rows for them to be read together.
+      max_read_bytes: the largest number of bytes to read at once, unless a single row is larger.
+
+      Returns a list of ArrayImg of the given type, one per interval and in the same order.
+  """
+  n_bytes_per_pixel, asArrayImg, createArray, asBuffer, _, _ = __mapped_types__[pixelType]
+  if header < 0:
+    # Interpret from the end: useful for files with variable header lengths
+    # such as some types of uncompressed TIFF formats
+    header = File(path).length() + header
+  # Stride, in pixels, of each dimension
+  strides = [1]
+  for dim in dimensions[:-1]:
+    strides.append(strides[-1] * dim)
+  # The ROIs, as their dimensions and the byte[] to read them into
+  rois = []
+  # The rows of all ROIs, as (offset in the file, length, index of the ROI, offset in the ROI's byte[])
+  spans = []
+  for i, (minimum, maximum) in enumerate(intervals):
+    roi_dims = [maxC - minC + 1 for minC, maxC in izip(minimum, maximum)]
+    rois.append((roi_dims, zeros(reduce(operator.mul, roi_dims) * n_bytes_per_pixel, 'b')))
+    row_length = roi_dims[0] * n_bytes_per_pixel
+    # Positions of the rows in dimensions 1 to n-1, with dimension 1 moving fastest
+    higher = range(len(dimensions) -1, 0, -1)
+    for k, position in enumerate(product(*[xrange(minimum[d], maximum[d] + 1) for d in higher])):
+      index = minimum[0] + sum(c * strides[d] for c, d in izip(position, higher))
+      spans.append((header + index * n_bytes_per_pixel, row_length, i, k * row_length))
+  spans.sort()
+
+  def asImgs():
+    imgs = []
+    for roi_dims, bytes in rois:
+      if 1 == n_bytes_per_pixel:
+        imgs.append(asArrayImg(bytes, roi_dims))
+      else:
+        pixels = createArray(len(bytes) / n_bytes_per_pixel)
+        asBuffer(ByteBuffer.wrap(bytes).order(byte_order)).get(pixels)
+        imgs.append(asArrayImg(pixels, roi_dims))
+    return imgs
+
+  if not spans:
+    return asImgs()
+
+  if memory_mapped:
+    first = spans[0][0]
+    last = max(start + length for start, length, _, _ in spans)
+    if last - first <= Integer.MAX_VALUE:
+      bb = mapFile(path, first, last - first, byte_order)
+      for start, length, i, offset in spans:
+        bb.position(start - first)
+        bb.get(rois[i][1], offset, length)
+      return asImgs()
+    syncPrint("ROIs span more than 2 GB of %s: will read them instead" % path)
+
+  ra = RandomAccessFile(path, 'r')
+  try:
+    channel = ra.getChannel()
+    j = 0
+    while j < len(spans):
+      # Merge the next rows into a single read while they overlap or are near enough
+      start = spans[j][0]
+      end = start + spans[j][1]
+      k = j + 1
+      while k < len(spans) and spans[k][0] <= end + max_gap \
+            and max(end, spans[k][0] + spans[k][1]) - start <= max_read_bytes:
+        end = max(end, spans[k][0] + spans[k][1])
+        k += 1
+      bytes = zeros(end - start, 'b')
+      readChannel(channel, start, ByteBuffer.wrap(bytes))
+      for s, length, i, offset in spans[j:k]:
+        System.arraycopy(bytes, s - start, rois[i][1], offset, length)
+      j = k
+  finally:
+    ra.close()
+  return asImgs()
+
+
 def parseNextIntBigEndian(ra, count):
   # ra: a RandomAccessFile at the correct place to read the next sequence of bytes
   bytes = zeros(count + 1, 'b')
@@ -407,9 +1321,250 @@ def parseIFD(ra, parseNextInt):
   return tags, nextIFDoffset
 
 
-def parse_TIFF_IFDs(filepath):
+# TIFF tags read by scanIFD, with the same names as in parseIFD, plus those of tiled TIFF files
+TIFF_TAG_NAMES = {256: "width",
+                  257: "height", # aka image length
+                  258: "bitDepth",
+                  259: "compression",
+                  273: "StripOffsets",
+                  277: "samples_per_pixel",
+                  278: "RowsPerStrip",
+                  279: "StripByteCounts",
+                  322: "TileWidth",
+                  323: "TileLength",
+                  324: "TileOffsets",
+                  325: "TileByteCounts"}
+# Tags that are always lists, even when they contain a single value
+TIFF_COUNTABLE_TAGS = set(["StripOffsets", "RowsPerStrip", "StripByteCounts", "TileOffsets", "TileByteCounts"])
+# TIFF data type vs number of bytes, including the 64-bit types of BigTIFF: 16 long8, 17 slong8, 18 ifd8
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+
+
+def decodeTIFFValues(bb, dataType, count):
+  """ Decode count integer values of the TIFF dataType from the ByteBuffer bb at its current position,
+      in bulk. Unsigned types are returned as non-negative numbers.
+      Returns a list, or None for non-integer types (rational, float and double). """
+  if dataType in (1, 2, 6, 7):
+    values = zeros(count, 'b')
+    bb.get(values)
+    return list(values) if 6 == dataType else [v & 0xff for v in values]
+  if dataType in (3, 8):
+    values = zeros(count, 'h')
+    bb.asShortBuffer().get(values)
+    return list(values) if 8 == dataType else [v & 0xffff for v in values]
+  if dataType in (4, 9, 13):
+    values = zeros(count, 'i')
+    bb.asIntBuffer().get(values)
+    return list(values) if 9 == dataType else [v & 0xffffffffL for v in values]
+  if dataType in (16, 17, 18):
+    values = zeros(count, 'l')
+    bb.asLongBuffer().get(values)
+    return list(values)
+  return None
+
+
+def readTIFFHeader(ra):
+  """ Read the header of a TIFF or BigTIFF file open as RandomAccessFile ra.
+      Returns whether it is big endian, whether it is a BigTIFF, and the offset to the first IFD. """
+  # Bytes 1 and 2: either II or MM, for little-endian and big-endian, respectively.
+  # Bytes 3 and 4: the version, 42 for TIFF and 43 for BigTIFF.
+  # TIFF: bytes 5 to 8 are the offset to the first IFD.
+  # BigTIFF: bytes 5 and 6 are the size of offsets (always 8), 7 and 8 are zero,
+  #          and 9 to 16 are the offset to the first IFD.
+  header = zeros(16, 'b')
+  ra.seek(0)
+  ra.readFully(header, 0, int(min(16, ra.length())))
+  bigEndian = 'M' == chr(header[0])
+  bb = ByteBuffer.wrap(header).order(ByteOrder.BIG_ENDIAN if bigEndian else ByteOrder.LITTLE_ENDIAN)
+  version = bb.getShort(2)
+  if 43 == version:
+    return bigEndian, True, bb.getLong(8)
+  if 42 != version:
+    raise Exception("Not a TIFF file: version is %i" % version)
+  return bigEndian, False, bb.getInt(4) & 0xffffffffL
+
+
+def scanIFD(ra, offset, bigEndian, bigTIFF):
+  """ Read the IFD at offset with one bulk read of its block of tags,
+      decoding them from a ByteBuffer. See parseIFD for the layout,
+      which for BigTIFF has an 8-byte count of tags, 20-byte tags with
+      8-byte DataCount and DataOffset, and an 8-byte NextIFDOffset.
+      Tag values that don't fit in DataOffset are read with one bulk read per tag.
+
+      Returns a dictionary with the tags in TIFF_TAG_NAMES and the offset of the next IFD. """
+  order = ByteOrder.BIG_ENDIAN if bigEndian else ByteOrder.LITTLE_ENDIAN
+  count_size, tag_size, offset_size = (8, 20, 8) if bigTIFF else (2, 12, 4)
+  ra.seek(offset)
+  bcount = zeros(count_size, 'b')
+  ra.readFully(bcount)
+  bb = ByteBuffer.wrap(bcount).order(order)
+  nTags = int(bb.getLong() if bigTIFF else bb.getShort() & 0xffff)
+  block = zeros(nTags * tag_size + offset_size, 'b')
+  ra.readFully(block)
+  bb = ByteBuffer.wrap(block).order(order)
+  tags = {}
+  for i in xrange(nTags):
+    start = i * tag_size
+    name = TIFF_TAG_NAMES.get(bb.getShort(start) & 0xffff, None)
+    if not name:
+      continue
+    dataType = bb.getShort(start + 2) & 0xffff
+    dataCount = bb.getLong(start + 4) if bigTIFF else bb.getInt(start + 4) & 0xffffffffL
+    n_bytes = TIFF_TYPE_SIZES.get(dataType, 1) * dataCount
+    if n_bytes <= offset_size:
+      # Data embedded in DataOffset, left-justified
+      bb.position(start + 4 + offset_size) # after TagId, DataType and DataCount
+      values = decodeTIFFValues(bb.slice().order(order), dataType, dataCount)
+    else:
+      pos = bb.getLong(start + 12) if bigTIFF else bb.getInt(start + 8) & 0xffffffffL
+      data = zeros(n_bytes, 'b')
+      ra.seek(pos)
+      ra.readFully(data)
+      values = decodeTIFFValues(ByteBuffer.wrap(data).order(order), dataType, dataCount)
+    if values is None:
+      continue
+    tags[name] = values if (name in TIFF_COUNTABLE_TAGS or len(values) > 1) else values[0]
+  last = nTags * tag_size
+  nextIFDoffset = bb.getLong(last) if bigTIFF else bb.getInt(last) & 0xffffffffL
+  return tags, nextIFDoffset
+
+
+def scan_TIFF_IFDs(filepath):
+  """ Returns a list of dictionaries of tags for each IFD in the TIFF or BigTIFF file,
+      as defined by the 'scanIFD' function above, each with also the "bigEndian" and "bigTIFF" keys. """
+  ra = RandomAccessFile(filepath, 'r')
+  try:
+    bigEndian, bigTIFF, nextIFDoffset = readTIFFHeader(ra)
+    IFDs = []
+    while nextIFDoffset != 0:
+      tags, nextIFDoffset = scanIFD(ra, nextIFDoffset, bigEndian, bigTIFF)
+      tags["bigEndian"] = bigEndian
+      tags["bigTIFF"] = bigTIFF
+      IFDs.append(tags)
+    return IFDs
+  finally:
+    ra.close()
+
+
+# Binary IFD index, see saveIFDIndex:
+#  * magic: 8 bytes, the ASCII string in IFD_INDEX_MAGIC
+#  * length and lastModified of the TIFF file: two 8-byte longs
+#  * n_IFDs: 4-byte int
+#  * for each IFD:
+#    * flags: 1 byte, with bit 0 for bigEndian and bit 1 for bigTIFF
+#    * n_tags: 2-byte short
+#    * for each tag: its 2-byte TIFF tag number (see TIFF_TAG_NAMES), 1 byte with 1 when its value
+#      is a list and 0 otherwise, a 4-byte int count, and count 8-byte longs
+# All numbers are little-endian.
+IFD_INDEX_MAGIC = "IVIFDX01"
+TIFF_TAG_IDS = dict((name, tag) for tag, name in TIFF_TAG_NAMES.iteritems())
+
+
+def IFDIndexPath(filepath, index_dir):
+  """ The path to the file in index_dir with the IFDs of the TIFF file at filepath,
+      named after the file and a digest of its absolute path, so that TIFF files
+      of the same name in different directories don't share it. """
+  digest = hashlib.sha1(os.path.abspath(filepath)).hexdigest()[:16]
+  return os.path.join(index_dir, "%s.%s.ifds.bin" % (os.path.basename(filepath), digest))
+
+
+def loadIFDIndex(filepath, index_dir):
+  """ Returns the list of IFDs of the TIFF file at filepath stored in index_dir,
+      or None when there isn't one or the TIFF file has changed since it was written. """
+  path = IFDIndexPath(filepath, index_dir)
+  if not os.path.exists(path):
+    return None
+  try:
+    ra = RandomAccessFile(path, 'r')
+    try:
+      fc = ra.getChannel()
+      bb = fc.map(FileChannel.MapMode.READ_ONLY, 0, fc.size()).order(ByteOrder.LITTLE_ENDIAN)
+    finally:
+      ra.close()
+    bmagic = zeros(8, 'b')
+    bb.get(bmagic)
+    if str(String(bmagic, "US-ASCII")) != IFD_INDEX_MAGIC:
+      return None
+    f = File(filepath)
+    if bb.getLong() != f.length() or bb.getLong() != f.lastModified():
+      return None
+    IFDs = []
+    for i in xrange(bb.getInt()):
+      flags = bb.get()
+      tags = {"bigEndian": bool(flags & 1), "bigTIFF": bool(flags & 2)}
+      for k in xrange(bb.getShort()):
+        name = TIFF_TAG_NAMES[bb.getShort() & 0xffff]
+        is_list = 1 == bb.get()
+        values = zeros(bb.getInt(), 'l')
+        bb.asLongBuffer().get(values) # bulk, from the current position
+        bb.position(bb.position() + len(values) * 8)
+        tags[name] = list(values) if is_list else values[0]
+      IFDs.append(tags)
+    return IFDs
+  except:
+    syncPrint("Could not read IFD index at %s" % path)
+    syncPrint(str(sys.exc_info()))
+    return None
+
+
+def saveIFDIndex(filepath, IFDs, index_dir):
+  """ Store the list of IFDs of the TIFF file at filepath in index_dir, see IFD_INDEX_MAGIC.
+      Fails silently (other than printing the error) e.g. when the directory is not writable. """
+  path = IFDIndexPath(filepath, index_dir)
+  try:
+    tag_items = [[(name, value) for name, value in tags.iteritems() if name in TIFF_TAG_IDS] for tags in IFDs]
+    n_bytes = 8 + 8 + 8 + 4 + sum(1 + 2 + sum(2 + 1 + 4 + 8 * (len(value) if isinstance(value, list) else 1)
+                                              for name, value in items)
+                                  for items in tag_items)
+    bb = ByteBuffer.allocate(n_bytes).order(ByteOrder.LITTLE_ENDIAN)
+    bb.put(String(IFD_INDEX_MAGIC).getBytes("US-ASCII"))
+    f = File(filepath)
+    bb.putLong(f.length())
+    bb.putLong(f.lastModified())
+    bb.putInt(len(IFDs))
+    for tags, items in izip(IFDs, tag_items):
+      bb.put((1 if tags.get("bigEndian", False) else 0) | (2 if tags.get("bigTIFF", False) else 0))
+      bb.putShort(len(items))
+      for name, value in items:
+        bb.putShort(TIFF_TAG_IDS[name])
+        is_list = isinstance(value, list)
+        values = value if is_list else [value]
+        bb.put(1 if is_list else 0)
+        bb.putInt(len(values))
+        bb.asLongBuffer().put(array(values, 'l')) # bulk, from the current position
+        bb.position(bb.position() + len(values) * 8)
+    ra = RandomAccessFile(path, 'rw')
+    try:
+      ra.setLength(0)
+      ra.write(bb.array())
+    finally:
+      ra.close()
+  except:
+    syncPrint("Could not write IFD index at %s" % path)
+    syncPrint(str(sys.exc_info()))
+
+
+def parse_TIFF_IFDs(filepath, index_dir=None):
+  """ Returns a list of dictionaries of tags for each IFD in the TIFF file,
+      as defined by the 'scanIFD' function above.
+      index_dir: defaults to None. A directory (e.g. the target or CSV directory, never that of
+                 the source images) in which to store the IFDs after scanning the TIFF file,
+                 and from which to read them on reopening it while the TIFF file hasn't changed.
+                 See saveIFDIndex. """
+  if index_dir:
+    IFDs = loadIFDIndex(filepath, index_dir)
+    if IFDs is not None:
+      return IFDs
+  IFDs = scan_TIFF_IFDs(filepath)
+  if index_dir:
+    saveIFDIndex(filepath, IFDs, index_dir)
+  return IFDs
+
+
+def parse_TIFF_IFDs_serially(filepath):
   """ Returns a generator of dictionaries of tags for each IFD in the TIFF file,
-      as defined by the 'parseIFD' function above. """
+      as defined by the 'parseIFD' function above, reading one integer at a time.
+      Slower than parse_TIFF_IFDs, and doesn't support BigTIFF. """
   ra = RandomAccessFile(filepath, 'r')
   try:
     # TIFF file format can have metadata at the end after the images, so the above approach can fail
@@ -537,11 +1692,62 @@ def unpackBits2(bytes_packedbits, tags, use_imagereader=False):
     return bytes
 
 
-def read_TIFF_plane(ra, tags, handler=None):
+def tiffSegments(tags):
+  """ The strips or tiles of a TIFF image plane, as a list of tuples
+      (x, y, width, height, offset, byte_count): the pixel bounds of the segment
+      within the plane, and where its (possibly compressed) bytes are in the file.
+      Tiles at the right and bottom edges extend beyond the plane, as stored. """
+  width, height = tags["width"], tags["height"]
+  if "TileOffsets" in tags:
+    tile_width, tile_height = tags["TileWidth"], tags["TileLength"]
+    n_across = (width + tile_width - 1) / tile_width
+    return [((i % n_across) * tile_width, (i / n_across) * tile_height, tile_width, tile_height, offset, count)
+            for i, (offset, count) in enumerate(izip(tags["TileOffsets"], tags["TileByteCounts"]))]
+  rows = min(tags.get("RowsPerStrip", [height])[0], height)
+  return [(0, i * rows, width, min(rows, height - i * rows), offset, count)
+          for i, (offset, count) in enumerate(izip(tags["StripOffsets"], tags["StripByteCounts"]))]
+
+
+def readChannel(channel, offset, bb):
+  """ Fill the ByteBuffer bb, from its position to its limit, with the bytes of the FileChannel
+      starting at offset. Uses positional reads, which are safe to use from multiple threads at once. """
+  start = bb.position()
+  while bb.hasRemaining():
+    if channel.read(bb, offset + bb.position() - start) < 0:
+      break
+
+
+def decodeTIFFSegment(channel, offset, byte_count, compression, n_bytes):
+  """ Read a strip or tile from the FileChannel with a positional read, which is safe
+      to use from multiple threads at once, and decompress it.
+      n_bytes: the expected number of bytes once decompressed. """
+  data = zeros(byte_count, 'b')
+  readChannel(channel, offset, ByteBuffer.wrap(data))
+  if 1 == compression:
+    return data
+  if 32773 == compression:
+    return ImageReader(FileInfo()).packBitsUncompress(data, n_bytes)
+  if 5 == compression:
+    return ImageReader(FileInfo()).lzwUncompress(data, n_bytes)
+  if 32946 == compression or 8 == compression:
+    return ImageReader(FileInfo()).zipUncompress(data, n_bytes)
+  if 6 == compression:
+    raise Exception("Can't handle JPEG compression of TIFF image planes")
+  raise Exception("Can't deal with compression type " + str(compression))
+
+
+def read_TIFF_plane(ra, tags, handler=None, roi=None, exe=None):
   """ ra: RandomAccessFile
       tags: dicctionary of TIFF tags for the IFD of the plane to parse.
       handler: defaults to Nobe; a function that reads the image data and returns an array.
-
+      roi: defaults to None, meaning the whole plane. Otherwise a pair of [minX, minY] and [maxX, maxY]
+           (inclusive) coordinates, to decode only the strips or tiles that intersect it
+           and return only its pixels.
+      exe: defaults to None. An ExecutorService to decode strips or tiles in parallel.
+
+      Supports strip and tile layouts. Each strip or tile is read and decompressed independently,
+      and copied into its place in the returned array. When uncompressed, only the bytes
+      of the rows within the roi are read.
       For compressed image planes, takes advantage of the ij.io.ImageReader class
       which contains methods that ought to be static (no side effects) and therefore
       demand a dummy constructor just to invoke them.
@@ -552,58 +1758,102 @@ def read_TIFF_plane(ra, tags, handler=None):
   #     1: "uncompressed",
   # 32773: "packbits",
   #     5: "LZW",
+  #     8 or 32946: "zip",
   #     6: "JPEG",
   width, height = tags["width"], tags["height"]
   bitDepth = tags["bitDepth"]
-  n_bytes = int(ceil(width * height * (float(bitDepth) / 8))) # supports bitDepth < 8
   compression = tags.get("compression", 1)
-  bytes = None
-
-  if 32773 == compression:
-    bytes = unpackBits(ra, tags, use_imagereader=True) 
-  elif 5 == compression:
-    bytes = ImageReader(FileInfo()).lzwUncompress(getIFDImageBytes(ra, tags),
-                                                  tags["width"] * tags["height"])
-  elif 32946 == compression or 8 == compression:
-    bytes = ImageReader(FileInfo()).zipUncompress(getIFDImageBytes(ra, tags),
-                                                  tags["width"] * tags["height"])
-  elif 1 == compression:
-    bytes = zeros(n_bytes, 'b')
-    index = 0
-    for strip_offset, strip_length in zip(tags["StripOffsets"], tags["StripByteCounts"]):
-      ra.seek(strip_offset)
-      ra.read(bytes, index, strip_length)
-  elif 6 == compression:
+  if 6 == compression:
     print "Unsupported compression: JPEG"
     raise Exception("Can't handle JPEG compression of TIFF image planes")
+
+  if bitDepth < 8:
+    # Support for 1-bit, 2-bit, 3-bit, ... 12-bit, etc. images:
+    # pixels are packed across rows, so strips are decoded whole and concatenated
+    if roi:
+      raise Exception("Can't read a ROI of a TIFF image plane with a bit depth of %i" % bitDepth)
+    n_bytes = int(ceil(width * height * (float(bitDepth) / 8)))
+    pixels = zeros(int(ceil(width * height * bitDepth / 64.0)), 'l')
+    bytes = zeros(len(pixels) * 8, 'b') # padded to a whole number of longs
+    index = 0
+    for x, y, w, h, offset, count in tiffSegments(tags):
+      segment = decodeTIFFSegment(ra.getChannel(), offset, count, compression,
+                                  int(ceil(w * h * (float(bitDepth) / 8))))
+      length = min(len(segment), n_bytes - index)
+      System.arraycopy(segment, 0, bytes, index, length)
+      index += length
+    # Bits are packed starting from the most significant bit of each byte: read longs in big endian
+    ByteBuffer.wrap(bytes).asLongBuffer().get(pixels)
+    # Reverse bits from left to right to right to left for ImgLib2 LongArray
+    pixels = array(imap(Long.reverse, pixels), 'l')
+    return pixels
+
+  minX, minY = roi[0] if roi else (0, 0)
+  maxX, maxY = roi[1] if roi else (width -1, height -1)
+  roi_width, roi_height = maxX - minX + 1, maxY - minY + 1
+  n_bytes_per_pixel = (bitDepth / 8) * tags.get("samples_per_pixel", 1)
+  bytes = zeros(roi_width * roi_height * n_bytes_per_pixel, 'b')
+  channel = ra.getChannel()
+
+  def decodeInto(x, y, w, h, offset, count):
+    x0, x1 = max(x, minX), min(x + w, maxX + 1)
+    y0, y1 = max(y, minY), min(y + h, maxY + 1)
+    length = (x1 - x0) * n_bytes_per_pixel
+    if 1 == compression:
+      # Uncompressed: read only the byte ranges of the rows within the ROI, straight into place
+      if x0 == x and x1 == x + w and x0 == minX and x1 == maxX + 1:
+        # Rows are contiguous both in the file and in the ROI
+        readChannel(channel, offset + (y0 - y) * length,
+                    ByteBuffer.wrap(bytes, (y0 - minY) * length, (y1 - y0) * length))
+      else:
+        for row in xrange(y0, y1):
+          readChannel(channel, offset + ((row - y) * w + x0 - x) * n_bytes_per_pixel,
+                      ByteBuffer.wrap(bytes, ((row - minY) * roi_width + x0 - minX) * n_bytes_per_pixel, length))
+      return
+    segment = decodeTIFFSegment(channel, offset, count, compression, w * h * n_bytes_per_pixel)
+    # Copy the rows of the intersection with the ROI
+    for row in xrange(y0, y1):
+      System.arraycopy(segment, ((row - y) * w + x0 - x) * n_bytes_per_pixel,
+                       bytes, ((row - minY) * roi_width + x0 - minX) * n_bytes_per_pixel,
+                       length)
+
+  segments = [s for s in tiffSegments(tags)
+              if s[0] <= maxX and s[0] + s[2] > minX and s[1] <= maxY and s[1] + s[3] > minY]
+  if exe:
+    futures = [exe.submit(Task(decodeInto, *segment)) for segment in segments]
+    for f in futures:
+      f.get()
   else:
-    raise Exception("Can't deal with compression type " + str(compression))
+    for segment in segments:
+      decodeInto(*segment)
 
-  # If read as bytes, parse to the appropriate primitive type
+  # If read as bytes, parse to the appropriate primitive type, in the byte order of the file
   if 8 == bitDepth:
     return bytes
-  bb = ByteBuffer.wrap(bytes)
-  if not tags["bigEndian"]:
-    bb = bb.order(ByteOrder.BIG_ENDIAN)
+  bb = ByteBuffer.wrap(bytes).order(ByteOrder.BIG_ENDIAN if tags["bigEndian"] else ByteOrder.LITTLE_ENDIAN)
+  size = roi_width * roi_height
   if 16 == bitDepth:
-    pixels = zeros(width * height, 'h')
+    pixels = zeros(size, 'h')
     bb.asShortBuffer().get(pixels)
     return pixels
   if 32 == bitDepth:
-    pixels = zeros(width * height, 'f')
+    pixels = zeros(size, 'f')
     bb.asFloatBuffer().get(pixels)
     return pixels
-  if bitDepth < 8:
-    # Support for 1-bit, 2-bit, 3-bit, ... 12-bit, etc. images
-    pixels = zeros(int(ceil(width * height * bitDepth / 64.0)), 'l')
+  if 64 == bitDepth:
+    pixels = zeros(size, 'l')
     bb.asLongBuffer().get(pixels)
-    # Reverse bits from left to right to right to left for ImgLib2 LongArray
-    pixels = array(imap(Long.reverse, pixels), 'l')
     return pixels
+  raise Exception("Can't deal with a bit depth of %i" % bitDepth)
 
 
 class TIFFSlices(CacheLoader):
-  """ Unless additional types are provided to the constructor,
+  """ A CacheLoader of the image planes of a TIFF file, as cells of a 3D CachedCellImg.
+      Each cell spans a cell_width * cell_height region of one plane, which defaults to the whole plane.
+      Only the strips or tiles that intersect a cell are decoded, and when uncompressed,
+      only the bytes of the rows within the cell are read.
+
+      Unless additional types are provided to the constructor,
       supports only UnsignedByteType, UnsignedShortType, FloatType and LongType. """
   types = { 8: (ByteArray, PrimitiveType.BYTE, UnsignedByteType),
            16: (ShortArray, PrimitiveType.SHORT, UnsignedShortType),
@@ -611,27 +1861,56 @@ class TIFFSlices(CacheLoader):
            64: (LongArray, PrimitiveType.LONG, LongType),
             1: (LongArray, PrimitiveType.LONG, BitType)}
   
-  def __init__(self, filepath, types=None):
+  def __init__(self, filepath, types=None, exe=None, cell_width=None, cell_height=None, index_dir=None):
+    """ filepath: the TIFF file.
+        types: see TIFFSlices.types.
+        exe: defaults to None. An ExecutorService to decode the strips or tiles of a plane in parallel.
+        cell_width, cell_height: default to None, meaning the width and height of the planes.
+                                 Planes with a bit depth under 8 are always read whole.
+        index_dir: defaults to None. A directory in which to keep an index of the IFDs
+                   for reopening the file fast, see parse_TIFF_IFDs. """
     self.filepath = filepath
-    self.IFDs = list(parse_TIFF_IFDs(filepath)) # the tags of each IFD
+    self.exe = exe
+    self.IFDs = list(parse_TIFF_IFDs(filepath, index_dir=index_dir)) # the tags of each IFD
     # Assumes all TIFF slices have the same dimensions and type
     print self.IFDs[0]
-    self.cell_dimensions = [self.IFDs[0]["width"], self.IFDs[0]["height"], 1]
+    width, height = self.IFDs[0]["width"], self.IFDs[0]["height"]
+    self.dimensions = [width, height, len(self.IFDs)]
+    if self.IFDs[0]["bitDepth"] < 8:
+      cell_width, cell_height = None, None # bits are packed across rows
+    self.cell_dimensions = [min(cell_width, width) if cell_width else width,
+                            min(cell_height, height) if cell_height else height,
+                            1]
     self.types = types if types else TIFFSlices.types
+    self.cache = None
   
   def get(self, index):
-    IFD = self.IFDs[index]
+    # Position of the cell in the grid, with X moving fastest
+    n_cells_x = (self.dimensions[0] + self.cell_dimensions[0] - 1) / self.cell_dimensions[0]
+    n_cells_y = (self.dimensions[1] + self.cell_dimensions[1] - 1) / self.cell_dimensions[1]
+    z = index / (n_cells_x * n_cells_y)
+    x0 = (index % n_cells_x) * self.cell_dimensions[0]
+    y0 = ((index / n_cells_x) % n_cells_y) * self.cell_dimensions[1]
+    x1 = min(x0 + self.cell_dimensions[0], self.dimensions[0]) - 1
+    y1 = min(y0 + self.cell_dimensions[1], self.dimensions[1]) - 1
+    IFD = self.IFDs[z]
+    whole = 0 == x0 and 0 == y0 and self.dimensions[0] -1 == x1 and self.dimensions[1] -1 == y1
     ra = RandomAccessFile(self.filepath, 'r')
     try:
-      cell_position = [0, 0, index]
-      pixels = read_TIFF_plane(ra, IFD) # a native array
+      pixels = read_TIFF_plane(ra, IFD, roi=None if whole else [[x0, y0], [x1, y1]],
+                               exe=self.exe) # a native array
       access = self.types[IFD["bitDepth"]][0] # e.g. ByteArray, FloatArray ...
-      return Cell(self.cell_dimensions, cell_position, access(pixels))
+      return Cell([x1 - x0 + 1, y1 - y0 + 1, 1], [x0, y0, z], access(pixels))
     finally:
       ra.close()
   
-  def asLazyCachedCellImg(self):
+  def asLazyCachedCellImg(self, max_cached_cells=0):
+    """ max_cached_cells: defaults to 0, meaning no bound: cells are kept until the garbage
+                          collector reclaims their SoftReference. Otherwise, the maximum number
+                          of cells to keep strongly cached.
+        All images returned share the cache of decoded cells created by the first call. """
+    if self.cache is None:
+      self.cache = BoundedSoftRefLoaderCache(max_cached_cells) if max_cached_cells > 0 else SoftRefLoaderCache()
     access, primitiveType, pixelType = self.types[self.IFDs[0]["bitDepth"]]
-    return lazyCachedCellImg(self, self.cell_dimensions[:-1] + [len(self.IFDs)],
-                             self.cell_dimensions, pixelType, primitiveType)
-
+    return lazyCachedCellImg(self, self.dimensions, self.cell_dimensions, pixelType, primitiveType,
+                             cache=self.cache)
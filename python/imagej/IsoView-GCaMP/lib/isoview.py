@@ -15,7 +15,8 @@ from itertools import izip, chain, repeat
 from operator import itemgetter
 from util import newFixedThreadPool, Task, syncPrint, affine3D
 from io import readFloats, writeZip, KLBLoader, TransformedLoader, ImageJLoader
-from registration import computeOptimizedTransforms, saveMatrices, loadMatrices, asBackwardConcatTransforms, viewTransformed, transformedView, mergeTransforms
+from registration import computeOptimizedTransforms, saveMatrices, loadMatrices, asBackwardConcatTransforms, viewTransformed, transformedView, mergeTransforms, matricesName, matricesParams, \
+                         saveSeries, loadInitialMatrices
 from deconvolution import multiviewDeconvolution, prepareImgForDeconvolution, transformPSFKernelToView
 from converter import convert, createConverter
 from collections import defaultdict
@@ -89,7 +90,7 @@ def deconvolveTimePoints(srcDir,
     # Reuse the same kernel for all views
     kernels = [kernels[0]] * (2 * len(camera_groups)) 
   
-  klb_loader = KLBLoader()
+  klb_loader = KLBLoader(lazy=True) # decompress only the KLB blocks within the ROI
 
   def getCalibration(img_filename):
     return calibration
@@ -331,7 +332,15 @@ def registerDeconvolvedTimePoints(targetDir,
         del timepoint_views[time]
 
   # Register only the view CM00-CM01, given that CM02-CM03 has the same transform
-  matrices_name = "matrices-%s" % modelclass.getSimpleName()
+  timepoints = [] # sorted
+  filepaths = [] # sorted
+  for timepoint, views in sorted(timepoint_views.iteritems(), key=itemgetter(0)):
+    timepoints.append(timepoint)
+    filepaths.append(os.path.join(deconvolvedDir, views["CM00-CM01"]))
+  # Matrices are keyed by the parameters they depend on and by the image files
+  series_name = "matrices-%s" % modelclass.getSimpleName()
+  m_params = matricesParams(params)
+  matrices_name = matricesName(series_name, filepaths, modelclass, m_params)
   matrices = None
   if os.path.exists(os.path.join(csv_dir, matrices_name + ".csv")):
     matrices = loadMatrices(matrices_name, csv_dir)
@@ -346,18 +355,17 @@ def registerDeconvolvedTimePoints(targetDir,
       # Deconvolved images are isotropic
       def getCalibration(img_filepath):
         return [1, 1, 1]
-      timepoints = [] # sorted
-      filepaths = [] # sorted
-      for timepoint, views in sorted(timepoint_views.iteritems(), key=itemgetter(0)):
-        timepoints.append(timepoint)
-        filepaths.append(os.path.join(deconvolvedDir, views["CM00-CM01"]))
       #
       #matrices_fwd = computeForwardTransforms(filepaths, ImageJLoader(), getCalibration,
       #                                        csv_dir, exe, modelclass, params, exe_shutdown=False)
       #matrices = [affine.getRowPackedCopy() for affine in asBackwardConcatTransforms(matrices_fwd)]
+      # When timepoints were added or changed, update the prior matrices, if any
+      initial = loadInitialMatrices(series_name, filepaths, m_params, csv_dir) if "incremental_window" in params else None
       matrices = computeOptimizedTransforms(filepaths, ImageJLoader(), getCalibration,
-                                            csv_dir, exe, modelclass, params, verbose=verbose)
+                                            csv_dir, exe, modelclass, params, verbose=verbose,
+                                            initial=initial)
       saveMatrices(matrices_name, matrices, csv_dir)
+      saveSeries(series_name, filepaths, matrices_name, m_params, csv_dir)
     finally:
       if not original_exe:
         exe.shutdownNow() # Was created new
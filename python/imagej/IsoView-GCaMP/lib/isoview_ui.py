@@ -18,6 +18,7 @@ from io import InRAMLoader
 from util import numCPUs, affine3D, newFixedThreadPool, Task
 from ui import showAsStack
 from registration import transformedView, computeOptimizedTransforms, mergeTransforms
+from features import closePointMatchStores
 from java.util.concurrent import Executors, TimeUnit
 from datetime import datetime
 
@@ -408,9 +409,11 @@ def makeCropUI(imp, images, tgtDir, panel=None, cropContinuationFn=None):
         for a, b in izip(minC + maxC, map(int, reader.next()[1:] + reader.next()[1:])):
           if a != b:
             same = False
-            # Invalidate any CSV files for features and pointmatches: different cropping
+            # Invalidate any files for features and pointmatches: different cropping
+            closePointMatchStores()
             for filename in os.listdir(tgtDir):
-              if filename.endswith("features.csv") or filename.endswith("pointmatches.csv"):
+              if filename.endswith("features.csv") or filename.endswith("features.bin") \
+                 or filename.endswith("pointmatches.csv") or "pointmatches.db" == filename:
                 os.remove(os.path.join(tgtDir, filename))
             break
         if same:
@@ -0,0 +1,91 @@
+from org.objectweb.asm import ClassWriter, Opcodes, Label
+from lib.asm import CustomClassLoader
+
+
+def createNativeRegionMeansClass(classloader=None):
+  """ Bytecode for the class my/RegionMeans, see java/asm/my/RegionMeans.java
+      with its single static method:
+
+      measure(float[] volume, int[] offsets, int[] starts, float[] means)
+
+      which stores in means[i] the average of the volume values at the indices
+      offsets[starts[i]] to offsets[starts[i+1] -1]. """
+  cw = ClassWriter(ClassWriter.COMPUTE_FRAMES) # also computes maxs
+
+  cw.visit(52, Opcodes.ACC_PUBLIC + Opcodes.ACC_FINAL + Opcodes.ACC_SUPER, "my/RegionMeans",
+           None, "java/lang/Object", None)
+
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC, "<init>", "()V", None, None)
+  mv.visitCode()
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitMethodInsn(Opcodes.INVOKESPECIAL, "java/lang/Object", "<init>", "()V", False)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(1, 1)
+  mv.visitEnd()
+
+  # Local variables: 0: volume, 1: offsets, 2: starts, 3: means, 4: i, 5: end, 6-7: sum (double), 8: k
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC + Opcodes.ACC_STATIC + Opcodes.ACC_FINAL, "measure", "([F[I[I[F)V", None, None)
+  mv.visitCode()
+  mv.visitInsn(Opcodes.ICONST_0)
+  mv.visitVarInsn(Opcodes.ISTORE, 4) # i = 0
+  l_outer = Label()
+  l_return = Label()
+  mv.visitLabel(l_outer)
+  mv.visitVarInsn(Opcodes.ILOAD, 4)
+  mv.visitVarInsn(Opcodes.ALOAD, 3)
+  mv.visitInsn(Opcodes.ARRAYLENGTH)
+  mv.visitJumpInsn(Opcodes.IF_ICMPGE, l_return) # i < means.length
+  mv.visitVarInsn(Opcodes.ALOAD, 2)
+  mv.visitVarInsn(Opcodes.ILOAD, 4)
+  mv.visitInsn(Opcodes.ICONST_1)
+  mv.visitInsn(Opcodes.IADD)
+  mv.visitInsn(Opcodes.IALOAD)
+  mv.visitVarInsn(Opcodes.ISTORE, 5) # end = starts[i + 1]
+  mv.visitInsn(Opcodes.DCONST_0)
+  mv.visitVarInsn(Opcodes.DSTORE, 6) # sum = 0
+  mv.visitVarInsn(Opcodes.ALOAD, 2)
+  mv.visitVarInsn(Opcodes.ILOAD, 4)
+  mv.visitInsn(Opcodes.IALOAD)
+  mv.visitVarInsn(Opcodes.ISTORE, 8) # k = starts[i]
+  l_inner = Label()
+  l_inner_end = Label()
+  mv.visitLabel(l_inner)
+  mv.visitVarInsn(Opcodes.ILOAD, 8)
+  mv.visitVarInsn(Opcodes.ILOAD, 5)
+  mv.visitJumpInsn(Opcodes.IF_ICMPGE, l_inner_end) # k < end
+  mv.visitVarInsn(Opcodes.DLOAD, 6)
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitVarInsn(Opcodes.ALOAD, 1)
+  mv.visitVarInsn(Opcodes.ILOAD, 8)
+  mv.visitInsn(Opcodes.IALOAD)
+  mv.visitInsn(Opcodes.FALOAD)
+  mv.visitInsn(Opcodes.F2D)
+  mv.visitInsn(Opcodes.DADD)
+  mv.visitVarInsn(Opcodes.DSTORE, 6) # sum += volume[offsets[k]]
+  mv.visitIincInsn(8, 1) # ++k
+  mv.visitJumpInsn(Opcodes.GOTO, l_inner)
+  mv.visitLabel(l_inner_end)
+  mv.visitVarInsn(Opcodes.ALOAD, 3)
+  mv.visitVarInsn(Opcodes.ILOAD, 4)
+  mv.visitVarInsn(Opcodes.DLOAD, 6)
+  mv.visitVarInsn(Opcodes.ILOAD, 5)
+  mv.visitVarInsn(Opcodes.ALOAD, 2)
+  mv.visitVarInsn(Opcodes.ILOAD, 4)
+  mv.visitInsn(Opcodes.IALOAD)
+  mv.visitInsn(Opcodes.ISUB)
+  mv.visitInsn(Opcodes.I2D)
+  mv.visitInsn(Opcodes.DDIV)
+  mv.visitInsn(Opcodes.D2F)
+  mv.visitInsn(Opcodes.FASTORE) # means[i] = (float)(sum / (end - starts[i]))
+  mv.visitIincInsn(4, 1) # ++i
+  mv.visitJumpInsn(Opcodes.GOTO, l_outer)
+  mv.visitLabel(l_return)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(0, 0) # computed
+  mv.visitEnd()
+
+  cw.visitEnd()
+
+  if not classloader:
+    classloader = CustomClassLoader()
+  return classloader.defineClass("my/RegionMeans", cw.toByteArray())
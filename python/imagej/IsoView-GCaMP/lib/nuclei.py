@@ -1,15 +1,20 @@
-import os
+import os, math
 from lib.dogpeaks import createDoG
 from lib.synthetic import virtualPointsRAI
 from lib.ui import showStack
-from lib.util import newFixedThreadPool, Task
+from lib.util import newFixedThreadPool, Task, numCPUs
 from lib.io import writeZip, ImageJLoader
-from net.imglib2 import KDTree, FinalInterval
-from net.imglib2.neighborsearch import RadiusNeighborSearchOnKDTree
+from lib.converter import makeRealToRealConverter, convert
+from net.imglib2 import RealPoint, FinalInterval
 from net.imglib2.view import Views
 from net.imglib2.img.array import ArrayImgs
 from net.imglib2.util import ImgUtil, Intervals
-from net.imglib2.algorithm.math.ImgMath import compute, add, sub, maximum
+from net.imglib2.algorithm.math.ImgMath import compute, add, sub, mul, div, maximum
+from net.imglib2.algorithm.math import ImgSource
+from net.imglib2.img.array import ArrayImgFactory
+from net.imglib2.type.numeric.real import DoubleType
+from java.lang import Math
+from itertools import izip, product
 
 
 def doGPeaks(img, params):
@@ -19,84 +24,166 @@ def doGPeaks(img, params):
   return dog.getSubpixelPeaks() # as RealPoint
 
 
-def __makeMerge(params):
-  
-  radius = params["searchRadius"]
-  
-  def merge(nuclei, peaks2):
+class NucleiGrid:
+  """
+  Incremental clustering of peaks into nuclei, with a uniform grid hash:
+  space is divided into cubic cells of side radius, so that all nuclei within radius
+  of a peak are found in the 27 cells around the cell containing the peak.
+  Each nucleus is the running mean of the peaks merged into it.
+  Inserting a peak, finding the nearest nucleus within radius and updating
+  its running mean take constant time (amortized, for a bounded density of nuclei).
+  """
+  def __init__(self, radius):
+    self.radius = radius
+    self.radius_sq = radius * radius
+    self.nuclei = [] # list of [x, y, z, count]
+    self.cells = {} # (i, j, k) vs list of indices into self.nuclei
+
+  def cellOf(self, x, y, z):
+    r = self.radius
+    return int(math.floor(x / r)), int(math.floor(y / r)), int(math.floor(z / r))
+
+  def insert(self, x, y, z, count=1):
+    """ Add a new nucleus and return its index. """
+    index = len(self.nuclei)
+    self.nuclei.append([x, y, z, count])
+    self.cells.setdefault(self.cellOf(x, y, z), []).append(index)
+    return index
+
+  def nearest(self, x, y, z):
+    """ Return the index of the nearest nucleus within radius of x, y, z, or -1 if none,
+        and the number of nuclei within radius. """
+    i0, j0, k0 = self.cellOf(x, y, z)
+    best, best_dsq, n = -1, self.radius_sq, 0
+    for i in xrange(i0 -1, i0 + 2):
+      for j in xrange(j0 -1, j0 + 2):
+        for k in xrange(k0 -1, k0 + 2):
+          for index in self.cells.get((i, j, k), ()):
+            nx, ny, nz, _ = self.nuclei[index]
+            dsq = (nx - x) * (nx - x) + (ny - y) * (ny - y) + (nz - z) * (nz - z)
+            if dsq <= self.radius_sq:
+              n += 1
+              if dsq <= best_dsq:
+                best, best_dsq = index, dsq
+    return best, n
+
+  def update(self, index, x, y, z):
+    """ Add the peak x, y, z to the running mean of the nucleus at index,
+        moving the nucleus to another cell when its mean position crosses into it. """
+    nucleus = self.nuclei[index]
+    cell = self.cellOf(*nucleus[:3])
+    count = nucleus[3]
+    new_count = count + 1
+    fraction = count / float(new_count)
+    nucleus[0] = nucleus[0] * fraction + x / float(new_count)
+    nucleus[1] = nucleus[1] * fraction + y / float(new_count)
+    nucleus[2] = nucleus[2] * fraction + z / float(new_count)
+    nucleus[3] = new_count
+    new_cell = self.cellOf(*nucleus[:3])
+    if new_cell != cell:
+      self.cells[cell].remove(index)
+      if not self.cells[cell]:
+        del self.cells[cell]
+      self.cells.setdefault(new_cell, []).append(index)
+
+  def merge(self, peaks):
     """
-    nuclei: a dictionary of RealPoint, representing the average position,
-            vs the number of points averaged.
-    peaks: a list of RealPoint
+    peaks: a list of RealLocalizable, all from the same time point.
 
-    Returns the updated nuclei, with possibly new nuclei, and the existing ones
-    having their coordinates (and counts of points averaged) updated.
+    Each peak is merged into the nearest nucleus within radius, or else becomes a new nucleus.
+    As before, peaks of the same time point are not merged with each other:
+    new nuclei are inserted only after all peaks have been considered.
+
+    Returns self, to enable a reduce operation over many sets of peaks.
     """
-    peaks1 = nuclei.keys()
-    search = RadiusNeighborSearchOnKDTree(KDTree(peaks1, peaks1))
-    for peak2 in peaks2:
-      search.search(peak2, radius, False)
-      n = search.numNeighbors()
-      if 0 == n:
+    new_peaks = []
+    for peak in peaks:
+      x, y, z = (peak.getDoublePosition(d) for d in xrange(3))
+      index, n = self.nearest(x, y, z)
+      if -1 == index:
         # New nuclei not ever seen before
-        nuclei[peak2] = 1
+        new_peaks.append((x, y, z))
       else:
         # Merge peak with nearest found nuclei, which should only be one given the small radius
-        peak1 = search.getSampler(0).get()
-        count = float(nuclei[peak1])
-        new_count = count + 1
-        fraction = count / new_count
-        for d in xrange(3):
-          peak1.setPosition(peak1.getDoublePosition(d) * fraction + peak2.getDoublePosition(d) / new_count, d)
-        nuclei[peak1] = new_count
+        self.update(index, x, y, z)
         # Check for more
         if n > 1:
           print "Ignoring %i additional closeby nuclei" % (n - 1)
-    # Return nuclei to enable a reduce operation over many sets of peaks
-    return nuclei
+    for x, y, z in new_peaks:
+      self.insert(x, y, z)
+    return self
 
-  return merge
+  def asDict(self):
+    """ Returns a dictionary of RealPoint, representing the average position,
+        vs the number of points averaged. """
+    return {RealPoint.wrap([x, y, z]): count for x, y, z, count in self.nuclei}
 
 
-def findPeaks(img4D, params):
+def findPeaks(img4D, params, n_threads=0, ring_size=0):
   """
   img4D: a 4D RandomAccessibleInterval
   params["frames"]: the number of consecutive time points to average
                     towards detecting peaks with difference of Gaussian.
+  n_threads: the number of difference of Gaussian detections to run concurrently;
+             zero means as many as CPU cores.
+  ring_size: the number of 3D sums to keep in memory, at least 2; defaults to n_threads + 1.
+
+  The running sums are computed one after another, each into the next buffer of a ring,
+  while the difference of Gaussian detections run in parallel on the sums already computed.
+  A buffer is reused only once the detection on its previous sum has finished.
 
   Returns a list of lists of peaks found, one list per time point.
   """
   frames = params["frames"]
-  # Work image: the current sum
-  sum3D = ArrayImgs.unsignedLongs([img4D.dimension(d) for d in [0, 1, 2]])
-
-  peaks = []
+  n_threads = n_threads if n_threads > 0 else numCPUs()
+  ring_size = max(2, ring_size if ring_size > 0 else n_threads + 1)
+  # Work images: the current sum, and those still being searched for peaks
+  ring = [ArrayImgs.unsignedLongs([img4D.dimension(d) for d in [0, 1, 2]]) for _ in xrange(ring_size)]
+
+  def hyperSlice(index):
+    return Views.hyperSlice(img4D, 3, index)
+
+  exe = newFixedThreadPool(n_threads=n_threads, name="find-peaks")
+  try:
+    futures = []
+    for i in xrange(img4D.dimension(3) - frames + 1):
+      sum3D = ring[i % ring_size]
+      if i >= ring_size:
+        futures[i - ring_size].get() # wait until done with this buffer
+      if 0 == i:
+        # Sum of the first set of frames
+        compute(add([hyperSlice(k) for k in xrange(frames)])).into(sum3D)
+      else:
+        # Running sums: subtract the first and add the last
+        compute(add(sub(ring[(i - 1) % ring_size],
+                        hyperSlice(i - 1)),
+                    hyperSlice(i - 1 + frames))) \
+          .into(sum3D)
+      # Extract nuclei from sum3D
+      futures.append(exe.submit(Task(doGPeaks, sum3D, params)))
 
-  # Sum of the first set of frames
-  compute(add([Views.hyperSlice(img4D, 3, i) for i in xrange(frames)])).into(sum3D)
-  # Extract nuclei from first sum3D
-  peaks.append(doGPeaks(sum3D, params))
+    # In order of time point
+    return [f.get() for f in futures]
+  finally:
+    exe.shutdownNow()
 
-  # Running sums: subtract the first and add the last
-  for i in xrange(frames, img4D.dimension(3), 1):
-    compute(add(sub(sum3D,
-                    Views.hyperSlice(img4D, 3, i - frames)),
-                Views.hyperSlice(img4D, 3, i))) \
-      .into(sum3D)
-    # Extract nuclei from sum4D
-    peaks.append(doGPeaks(sum3D, params))
 
-  return peaks
+def mergePeaks(peaks, params):
+  """
+  Cluster nearby nuclei detections across time points:
+  each peak is merged into the nearest nucleus found so far within params["searchRadius"],
+  updating its average position, or else starts a new nucleus. See NucleiGrid.
 
+  peaks: a list of lists of peaks, one list per time point.
 
-def mergePeaks(peaks, params):
-  # Cluster nearby nuclei detections:
-  # Make a KDTree from points
-  # For every point, measure distance to nearby points up to e.g. half a soma diameter
-  # and vote on neighboring points, weighed by distance.
-  # Points with more than X votes remain.
-  merged = reduce(__makeMerge(params), peaks[1:], {peak: 1 for peak in peaks[0]})
-  return merged
+  Returns a dictionary of RealPoint, representing the average position,
+  vs the number of peaks averaged.
+  """
+  grid = NucleiGrid(params["searchRadius"])
+  for peak in peaks[0]:
+    x, y, z = (peak.getDoublePosition(d) for d in xrange(3))
+    grid.insert(x, y, z)
+  return reduce(NucleiGrid.merge, peaks[1:], grid).asDict()
 
 
 def filterNuclei(mergedPeaks, params):
@@ -135,7 +222,89 @@ def findNucleiOverTime(img4D, params, show=True):
   return peaks, mergedPeaks, nuclei
 
 
+def projectLastDimension(img, reduction="max", tile_size=64, n_threads=0):
+  """
+  Project img along its last dimension (e.g. time, for a 4D series), one spatial tile at a time.
+
+  img: a RandomAccessibleInterval, ideally a CachedCellImg like an N5 volume,
+       whose tiles will be read one column of time points at a time.
+  reduction: "max", "mean", "sum" or "std" (the population standard deviation).
+  tile_size: the side of the tiles into which to divide the projection, or a list
+             with one value per dimension except the last one.
+  n_threads: the number of tiles to project in parallel; zero means as many as CPU cores.
+
+  Each tile is projected into its own small accumulator image, streaming over all time points,
+  and then copied into the result. Aside from the result, memory use is bounded by
+  n_threads times the size of one tile.
+
+  Returns an ArrayImg: of the same type as img for "max", and of FloatType otherwise.
+  """
+  if reduction not in ("max", "mean", "sum", "std"):
+    raise ValueError("Unknown reduction: %s" % reduction)
+  last_dimension = img.numDimensions() -1
+  n = img.dimension(last_dimension)
+  dimensions = [img.dimension(d) for d in xrange(last_dimension)]
+  tile_dims = tile_size if isinstance(tile_size, (list, tuple)) else [tile_size] * last_dimension
+
+  if "max" == reduction:
+    factory = ArrayImgFactory(img.randomAccess().get().createVariable())
+    projection = factory.create(dimensions)
+  else:
+    projection = ArrayImgs.floats(dimensions)
+  if "std" == reduction:
+    sqrt = makeRealToRealConverter(function_class=Math, function_method="sqrt")
+
+  def projectTile(minC, maxC):
+    dims = [mx - mn + 1 for mn, mx in izip(minC, maxC)]
+
+    def tileAt(t):
+      return Views.zeroMin(Views.interval(Views.hyperSlice(img, last_dimension, t), minC, maxC))
+
+    if "max" == reduction:
+      acc = factory.create(dims)
+      compute(ImgSource(tileAt(0))).into(acc)
+      for t in xrange(1, n):
+        compute(maximum(acc, tileAt(t))).into(acc)
+    else:
+      # Accumulate in double precision
+      acc = ArrayImgs.doubles(dims)
+      if "std" == reduction:
+        acc2 = ArrayImgs.doubles(dims) # sum of squares
+      for t in xrange(n):
+        tile = tileAt(t)
+        compute(add(acc, tile)).into(acc)
+        if "std" == reduction:
+          compute(add(acc2, mul(tile, tile))).into(acc2)
+      if "mean" == reduction or "std" == reduction:
+        compute(div(acc, n)).into(acc)
+      if "std" == reduction:
+        # Variance: mean of squares minus square of the mean, which can't be negative
+        compute(maximum(sub(div(acc2, n), mul(acc, acc)), 0)).into(acc2)
+        acc = convert(acc2, sqrt.newInstance(), DoubleType)
+    compute(ImgSource(acc)).into(Views.zeroMin(Views.interval(projection, minC, maxC)))
+
+  exe = newFixedThreadPool(n_threads=n_threads, name="project-tiles")
+  try:
+    origins = product(*[xrange(0, dim, tile_dim) for dim, tile_dim in izip(dimensions, tile_dims)])
+    futures = [exe.submit(Task(projectTile, list(minC),
+                               [min(mn + tile_dim, dim) -1 for mn, tile_dim, dim in izip(minC, tile_dims, dimensions)]))
+               for minC in origins]
+    for f in futures:
+      f.get()
+  finally:
+    exe.shutdownNow()
+
+  return projection
+
+
 def maxProjectLastDimension(img, strategy="1by1", chunk_size=0):
+  """
+  img: the image to max-project along its last dimension.
+  strategy: "1by1" to merge whole hyperslices in parallel, one per thread,
+            or "tiles" (also "chunks") to project spatial tiles in parallel
+            (see projectLastDimension), which bounds memory use by the size of a tile.
+  chunk_size: for "tiles", the side of a tile; defaults to 64 when zero.
+  """
   last_dimension = img.numDimensions() -1
 
   if "1by1" == strategy:
@@ -168,41 +337,10 @@ def maxProjectLastDimension(img, strategy="1by1", chunk_size=0):
           futures.append(exe.submit(Task(mergeMax, imgT, futures.pop(0).get(), imgT)))
     finally:
       exe.shutdownNow()
+  elif strategy in ("tiles", "chunks"):
+    return projectLastDimension(img, reduction="max", tile_size=chunk_size if chunk_size > 0 else 64)
   else:
-    # By chunks
-    imglibtype =  img.randomAccess().get().getClass()
-    # The Converter class
-    reduce_max = makeCompositeToRealConverter(reducer_class=Math,
-                                              reducer_method="max",
-                                              reducer_method_signature="(DD)D")
-    if chunk_size > 0:
-      # map reduce approach
-      exe = newFixedThreadPool()
-      try:
-        def projectMax(img, minC, maxC, reduce_max):
-          imgA = ArrayImgs.unsignedSorts(Intervals.dimensionsAsLongArray(imgC))
-          ImgUtil.copy(ImgView.wrap(convert(Views.collapseReal(Views.interval(img, minC, maxC)), reduce_max.newInstance(), imglibtype), img.factory()), imgA)
-          return imgA
-        
-        # The min and max coordinates of all dimensions except the last one
-        minCS = [0 for d in xrange(last_dimension)]
-        maxCS = [img.dimension(d) -1 for d in xrange(last_dimension)]
-
-        # Process every chunk in parallel
-        futures = [exe.submit(Task(projectMax, img, minCS + [offset], maxCS + [min(offset + chunk_size, img.dimension(last_dimension)) -1]))
-                   for offset in xrange(0, img.dimension(last_dimension), chunk_size)]
-        
-        return reduce(lambda f1, f2: compute(maximum(f1.get(), f2.get())).into(f1.get(), futures))
-      finally:
-        exe.shutdownNow()
-    else:
-      # One chunk: all at once
-      # Each sample of img3DV is a virtual vector over all time frames at that 3D coordinate
-      # Reduce each vector to a single scalar, using a Converter
-      img3DC = convert(Views.collapseReal(img), reduce_max.newInstance(), imglibtype)
-      imgA = ArrayImgs.unsignedShorts([img.dimension(d) for d in xrange(last_dimension)])
-      ImgUtil.copy(ImgView.wrap(imgV, img.factory()), imgA)
-      return imgA
+    raise ValueError("Unknown strategy: %s" % strategy)
 
 
 def findNucleiByMaxProjection(img4D, params, img3D_filepath, projection_strategy="1by1", mask=None, show=True):
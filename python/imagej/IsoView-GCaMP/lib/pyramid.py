@@ -7,6 +7,7 @@ from net.imglib2.realtransform import RealViews
 from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
 from net.imglib2.realtransform import Scale
 from net.imglib2 import FinalInterval
+from itertools import product
 
 
 def pyramidAreaAveraging(img,
@@ -17,7 +18,7 @@ def pyramidAreaAveraging(img,
                          converter=Util.genericIntegerTypeConverter()):
   """ Return a list of image views, one per scale level of the image pyramid,
       except for level zero (the first image) which is the provided img.
-      All images are of the same type as the source img.
+      All images are of the same type as the source img, of 2 or 3 dimensions.
       Based on an integral image for fast computation.
   """
 
@@ -35,8 +36,10 @@ def pyramidAreaAveraging(img,
   imgE = Views.extendBorder(integralImg)
   blockSide = 1
   level_index = 1
-  # Corners for level 1: a box of 2x2
-  corners = [[0, 0], [1, 0], [0, 1], [1, 1]]
+  # Corners for level 1: a box of 2x2 (or 2x2x2), with X varying fastest
+  # as expected by ImgMath's block for the signs of the integral image corners
+  n_dims = img.numDimensions()
+  corners = [list(reversed(corner)) for corner in product([0, 1], repeat=n_dims)]
   pyramid = [img]
 
   while width > min_width and level_index <= top_level:
@@ -44,15 +47,15 @@ def pyramidAreaAveraging(img,
     width /= 2
     # Scale the corner coordinates to make the block larger
     cs = [[c * blockSide for c in corner] for corner in corners]
-    blockRead = div(block(imgE, cs), pow(blockSide, 2)) # the op
+    blockRead = div(block(imgE, cs), pow(blockSide, n_dims)) # the op
     # a RandomAccessibleInterval view of the op, computed with shorts but seen as bytes
     view = blockRead.view(mathType(), img_type.createVariable())
     # Views.subsample by 2 will turn a 512-pixel width to a 257 width,
     # so crop to proper interval 256
     level = Views.interval(Views.subsample(view, blockSide),
-                           [0] * img.numDimensions(), # min
+                           [0] * n_dims, # min
                            [img.dimension(d) / blockSide -1
-                            for d in xrange(img.numDimensions())]) # max
+                            for d in xrange(n_dims)]) # max
     pyramid.append(level)
     level_index += 1 # for next iteration
 
@@ -62,7 +65,7 @@ def pyramidAreaAveraging(img,
 def pyramid(img,
             top_level,
             min_width=32,
-            ViewOutOfBounds=Views.extendBorder
+            ViewOutOfBounds=Views.extendBorder,
             interpolation_factory=NLinearInterpolatorFactory()):
   """
   Create an image pyramid as interpolated scaled views of the provided img.
@@ -1,35 +1,183 @@
-from mpicbg.models import NotEnoughDataPointsException, Tile, TileConfiguration, ErrorStatistic, TranslationModel3D
+from mpicbg.models import NotEnoughDataPointsException, Tile, TileConfiguration, ErrorStatistic, TranslationModel3D, \
+                          Point, PointMatch, TranslationModel2D, AffineModel2D, AffineModel3D, IllDefinedDataPointsException
 from java.util import ArrayList
+from java.util.concurrent.atomic import AtomicInteger
+from java.util.concurrent.locks import ReentrantLock
+from java.lang import System
 from net.imglib2.view import Views
 from net.imglib2.realtransform import RealViews, AffineTransform3D, Scale3D, Translation3D
 from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
 from jarray import array, zeros
-from itertools import izip, imap, islice, combinations
-import os, sys, csv
+from itertools import izip, imap, islice, combinations, product
+import os, sys, csv, random
 from os.path import basename
+from math import sqrt, log, log1p, ceil, isinf, isnan
 # local lib functions:
 from util import syncPrint, Task, nativeArray, newFixedThreadPool, affine3D
-from features import findPointMatches, ensureFeaturesForAll
+from features import findPointMatches, ensureFeaturesForAll, artifactKey, POINTMATCH_PARAM_NAMES, POINTMATCH_OPTIONAL_PARAM_NAMES, \
+                     FEATURE_PARAM_NAMES, makeFeatures, loadFeatures, loadFeaturesBinary, fromFeaturesIndexed, \
+                     fromPredictedFeatures, pointMatchStore, savePointMatches, sourceSignature
+from registration_asm import createNativePointMatchMomentsClass
+
+PointMatchMoments = createNativePointMatchMomentsClass()
+
+# Parameters that determine the matrices, in addition to those of the pointmatches:
+# for computeOptimizedTransforms
+TILE_CONFIGURATION_PARAM_NAMES = ["n_adjacent", "all_to_all", "fixed_tile_indices",
+                                  "maxAllowedError", "maxPlateauwidth", "maxIterations", "damp",
+                                  "incremental_window", "incremental_maxError", # see optimizeIncrementally
+                                  "solver"] # see optimizeTiles
+# for computeForwardTransforms
+RANSAC_PARAM_NAMES = ["n_iterations", "maxEpsilon", "minInlierRatio", "minNumInliers", "maxTrust"]
+RANSAC_OPTIONAL_PARAM_NAMES = ["ransac_confidence", "ransac_subset_size"] # see ransac
+# for the coarse-to-fine mode of computeOptimizedTransforms, see coarseParams
+COARSE_PARAM_NAMES = ["coarse_level", "coarse_search_radius"]
+# for optimizeIncrementally, and not considered by seriesKey
+INCREMENTAL_PARAM_NAMES = ["incremental_window", "incremental_maxError"]
+
+
+def ransac(model, pointmatches, n_iterations, maxEpsilon, minInlierRatio, minNumInliers,
+           confidence=None, n_threads=1, subset_size=0, seed=69997):
+  """ Like the RANSAC of mpicbg's model.filterRansac, but evaluating hypotheses in parallel
+      and with optional early termination.
+      Each hypothesis is a copy of the model fit to a random minimal sample of the pointmatches,
+      and the hypothesis with the most inliers within maxEpsilon wins.
+      confidence: e.g. 0.99, the probability of having drawn at least one sample of only inliers,
+                  given the best inlier ratio found so far, after which to stop early.
+                  Defaults to None: evaluate all n_iterations hypotheses.
+      n_threads: defaults to 1. The number of threads to evaluate hypotheses with.
+      subset_size: defaults to 0. When larger than zero (preemptive RANSAC), score each hypothesis
+                   first on a random subset of that many pointmatches, and then on all pointmatches
+                   only if its inlier ratio in the subset is at least that of the best hypothesis so far.
+      seed: for the random samples of each thread.
+
+      The model is then fit to the inliers of the best hypothesis, and refit
+      to its own inliers for as long as their number grows.
+      Returns the inliers as an ArrayList, empty when none satisfy minInlierRatio and minNumInliers,
+      and the number of hypotheses evaluated. """
+  n = len(pointmatches)
+  n_min = model.getMinNumMatches()
+  if n < n_min:
+    raise NotEnoughDataPointsException("%i data points are not enough to solve the Model, at least %i data points required." % (n, n_min))
+  counter = AtomicInteger(0)
+  # Shared among threads: the indices of the inliers of the best hypothesis,
+  # and the number of hypotheses after which to stop
+  state = {"best": [], "max_iterations": n_iterations}
+  lock = ReentrantLock()
+
+  def update(indices):
+    lock.lock()
+    try:
+      if len(indices) <= len(state["best"]):
+        return
+      state["best"] = indices
+      if confidence:
+        w = len(indices) / float(n)
+        p = pow(w, n_min)
+        if p >= 1.0:
+          state["max_iterations"] = 0
+        elif p > 0.0:
+          # log1p, because 1.0 - p rounds to 1.0 for p below about 1e-16, e.g. few inliers among many pointmatches
+          q = log1p(-p)
+          if q < 0.0:
+            required = log(1.0 - confidence) / q
+            if not (isinf(required) or isnan(required)):
+              state["max_iterations"] = min(state["max_iterations"], int(ceil(required)))
+    finally:
+      lock.unlock()
+
+  def hypotheses(k):
+    rnd = random.Random(seed + k)
+    # Own copies of the pointmatches: model.test sets the world coordinates of their points
+    local = ArrayList([PointMatch(Point(pm.getP1().getL()), Point(pm.getP2().getL()), pm.getWeight())
+                       for pm in pointmatches])
+    index = {pm: i for i, pm in enumerate(local)}
+    if 0 < subset_size < n:
+      subset = ArrayList([local.get(i) for i in sorted(rnd.sample(xrange(n), subset_size))])
+    else:
+      subset = None
+    count = 0
+    while counter.getAndIncrement() < state["max_iterations"]:
+      count += 1
+      hypothesis = model.copy()
+      try:
+        hypothesis.fit(ArrayList([local.get(i) for i in rnd.sample(xrange(n), n_min)]))
+      except (NotEnoughDataPointsException, IllDefinedDataPointsException):
+        continue
+      inliers = ArrayList()
+      if subset:
+        hypothesis.test(subset, inliers, maxEpsilon, 0.0, 0)
+        if inliers.size() < (len(state["best"]) / float(n)) * subset.size():
+          continue
+      if hypothesis.test(local, inliers, maxEpsilon, minInlierRatio, minNumInliers):
+        update([index[pm] for pm in inliers])
+    return count
+
+  if n_threads > 1:
+    exe = newFixedThreadPool(n_threads=n_threads, name="ransac")
+    try:
+      futures = [exe.submit(Task(hypotheses, k)) for k in xrange(n_threads)]
+      n_evaluated = sum(f.get() for f in futures)
+    finally:
+      exe.shutdown()
+  else:
+    n_evaluated = hypotheses(0)
+
+  inliers = ArrayList([pointmatches[i] for i in state["best"]])
+  if inliers.isEmpty():
+    return inliers, n_evaluated
+  # Refit to all inliers, until their number is stable
+  n_inliers = 0
+  while n_inliers < inliers.size():
+    n_inliers = inliers.size()
+    model.fit(inliers)
+    candidates = ArrayList()
+    if not model.test(pointmatches, candidates, maxEpsilon, minInlierRatio, minNumInliers):
+      break
+    inliers = candidates
+  return inliers, n_evaluated
 
 
 def fit(model, pointmatches, n_iterations, maxEpsilon,
-        minInlierRatio, minNumInliers, maxTrust):
+        minInlierRatio, minNumInliers, maxTrust,
+        confidence=None, n_threads=1, subset_size=0, label=""):
   """ Fit a model to the pointmatches, finding the subset of inlier pointmatches
-      that agree with a joint transformation model. """
+      that agree with a joint transformation model.
+      With the default confidence, n_threads and subset_size, uses mpicbg's model.filterRansac;
+      otherwise uses ransac with them, followed by the same filtering of inliers by maxTrust.
+      Prints the number of RANSAC iterations and the time taken, followed by the label. """
   inliers = ArrayList()
+  t0 = System.currentTimeMillis()
   try:
-    modelFound = model.filterRansac(pointmatches, inliers, n_iterations,
-                                    maxEpsilon, minInlierRatio, minNumInliers, maxTrust)
+    if confidence is None and n_threads <= 1 and subset_size <= 0:
+      modelFound = model.filterRansac(pointmatches, inliers, n_iterations,
+                                      maxEpsilon, minInlierRatio, minNumInliers, maxTrust)
+      n_evaluated = n_iterations
+    else:
+      candidates, n_evaluated = ransac(model, pointmatches, n_iterations, maxEpsilon, minInlierRatio,
+                                       minNumInliers, confidence=confidence, n_threads=n_threads,
+                                       subset_size=subset_size)
+      modelFound = not candidates.isEmpty() \
+                   and model.filter(candidates, inliers, maxTrust, minNumInliers)
   except NotEnoughDataPointsException, e:
     syncPrint(str(e))
     return False, inliers
+  syncPrint("RANSAC: %i iterations in %i ms%s" % (n_evaluated, System.currentTimeMillis() - t0, label))
   return modelFound, inliers
 
 
+def ransacOptions(params):
+  """ The keyword arguments for fit from the optional RANSAC params, when present:
+      "ransac_confidence", "ransac_subset_size" and "ransac_n_threads". """
+  return {name[len("ransac_"):]: params[name] for name in RANSAC_OPTIONAL_PARAM_NAMES + ["ransac_n_threads"]
+          if name in params}
+
+
 def fitModel(img1_filename, img2_filename, img_loader, getCalibration, csv_dir, model, exe, params):
   """ The model can be any subclass of mpicbg.models.Affine3D, such as:
         TranslationModel3D, RigidModel3D, SimilarityModel3D,
         AffineModel3D, InterpolatedAffineModel3D
+      The params include the RANSAC_PARAM_NAMES, and optionally those of ransacOptions.
       Returns the transformation matrix as a 1-dimensional array of doubles,
       which is the identity when the model cannot be fit. """
   pointmatches = findPointMatches(img1_filename, img2_filename, img_loader, getCalibration, csv_dir, exe, params)
@@ -38,7 +186,9 @@ def fitModel(img1_filename, img2_filename, img_loader, getCalibration, csv_dir,
   else:
     modelFound, inliers = fit(model, pointmatches, params["n_iterations"],
                               params["maxEpsilon"], params["minInlierRatio"],
-                              params["minNumInliers"], params["maxTrust"])
+                              params["minNumInliers"], params["maxTrust"],
+                              label=" for:\n    %s\n    %s" % (basename(img1_filename), basename(img2_filename)),
+                              **ransacOptions(params))
   if modelFound:
     syncPrint("Found %i inliers for:\n    %s\n    %s" % (len(inliers),
       basename(img1_filename), basename(img2_filename)))
@@ -75,6 +225,118 @@ def saveMatrices(name, matrices, csv_dir):
     syncPrint(str(sys.exc_info()))
 
 
+def matricesName(name, img_filenames, modelclass, params):
+  """ Return name suffixed with the artifactKey of the params, the modelclass and all image files,
+      so that matrices computed with different parameters coexist side by side,
+      and any change to the parameters or to the image files invalidates them.
+      params: only those that the matrices depend on, see matricesParams. """
+  m_params = dict(params)
+  m_params["modelclass"] = modelclass.getName()
+  return "%s-%s" % (name, artifactKey(m_params, *img_filenames)[:16])
+
+
+def matricesParams(params, names=TILE_CONFIGURATION_PARAM_NAMES):
+  """ The subset of params that the matrices depend on: those of the pointmatches
+      (and therefore of the features) plus those in names, when present. """
+  m_params = {k: params[k] for k in POINTMATCH_PARAM_NAMES + POINTMATCH_OPTIONAL_PARAM_NAMES + names
+              if k in params}
+  if params.get("coarse_level", 0) > 0:
+    m_params.update(coarseToFineParams(params))
+  return m_params
+
+
+def coarseParams(params, names=POINTMATCH_PARAM_NAMES + RANSAC_PARAM_NAMES):
+  """ The params for the coarse level of the image pyramid in the coarse-to-fine mode,
+      plus the "coarse_level" itself. Each of the named params is overriden by its counterpart
+      prefixed with "coarse_" when present, e.g. "coarse_sigmaSmaller" or "coarse_maxEpsilon":
+      all are in calibrated units, but peaks are coarser and less precisely located. """
+  c_params = {name: params["coarse_" + name] if "coarse_" + name in params else params[name]
+              for name in names}
+  c_params["coarse_level"] = params["coarse_level"]
+  return c_params
+
+
+def coarseToFineParams(params):
+  """ The subset of params that the pointmatches of the coarse-to-fine mode depend on. """
+  cf_params = {k: params[k] for k in POINTMATCH_PARAM_NAMES + POINTMATCH_OPTIONAL_PARAM_NAMES + COARSE_PARAM_NAMES
+                                   + RANSAC_OPTIONAL_PARAM_NAMES if k in params}
+  cf_params.update(("coarse_" + name, value) for name, value in coarseParams(params).iteritems()
+                   if "coarse_level" != name)
+  return cf_params
+
+
+def coarseFeatures(img_filename, img_loader, getCalibration, csv_dir, params, validateOnly=False, verbose=True):
+  """ Load the features of the coarse level of the image pyramid from their feature store,
+      otherwise extract them and save them. See coarseParams.
+      validateOnly: if True, return True when they exist already, without loading them. """
+  c_params = coarseParams(params, names=FEATURE_PARAM_NAMES)
+  features = loadFeaturesBinary(img_filename, csv_dir, c_params, validateOnly=validateOnly, verbose=verbose)
+  if features is None:
+    features = makeFeatures(img_filename, img_loader, getCalibration, csv_dir, c_params,
+                            level=c_params["coarse_level"])
+  return features
+
+
+def findPointMatchesCoarseToFine(img1_filename, img2_filename, img_loader, getCalibration, csv_dir, exe,
+                                 modelclass, params, verbose=True):
+  """ Like features.findPointMatches, but rather than comparing all features of both images,
+      first fit a model to the pointmatches of the features extracted from a coarse level
+      of the image pyramid (see coarseParams and coarseFeatures), and then compare each feature
+      of img1 only with those of img2 within params["coarse_search_radius"] of its position
+      as predicted by the coarse model (see features.fromPredictedFeatures).
+      At both levels, features are compared scale-invariantly when params["pointmatches_nearby"] is 2,
+      like findPointMatches does.
+      When no coarse model is found, falls back to features.findPointMatches.
+      Pointmatches, including those of the fallback, are stored in the PointMatchStore,
+      keyed by coarseToFineParams. """
+  cf_params = coarseToFineParams(params)
+  store = pointMatchStore(csv_dir, create=False)
+  if store:
+    pointmatches = store.get(img1_filename, img2_filename, artifactKey(cf_params, img1_filename, img2_filename))
+    if pointmatches is not None:
+      if verbose:
+        syncPrint("Loaded %i pointmatches for %s, %s" % (len(pointmatches), img1_filename, img2_filename))
+      return pointmatches
+
+  # Compare features like findPointMatches does
+  scale_invariant = 2 == params.get("pointmatches_nearby", 0)
+
+  # Estimate the model at the coarse level
+  c_params = coarseParams(params)
+  coarse = [coarseFeatures(img_filename, img_loader, getCalibration, csv_dir, params, verbose=verbose)
+            for img_filename in (img1_filename, img2_filename)]
+  pm = fromFeaturesIndexed(coarse[0], coarse[1], c_params["angle_epsilon"], c_params["len_epsilon_sq"],
+                           scale_invariant=scale_invariant, n_threads=params.get("pointmatches_n_threads", 1))
+  model = modelclass()
+  modelFound, inliers = fit(model, pm.pointmatches, *[c_params[name] for name in RANSAC_PARAM_NAMES],
+                            label=" at the coarse level for:\n    %s\n    %s" % (basename(img1_filename), basename(img2_filename)),
+                            **ransacOptions(params))
+  if not modelFound:
+    syncPrint("Coarse model not found, comparing all features of:\n    %s\n    %s" % \
+              (basename(img1_filename), basename(img2_filename)))
+    pointmatches = findPointMatches(img1_filename, img2_filename, img_loader, getCalibration, csv_dir, exe, params, verbose=verbose)
+    # Also under the coarse-to-fine key, so that later runs don't redo the coarse fit
+    savePointMatches(img1_filename, img2_filename, pointmatches, csv_dir, cf_params)
+    return pointmatches
+
+  # Compare full-resolution features near their predicted positions
+  feature_params = {k: params[k] for k in FEATURE_PARAM_NAMES}
+  features = []
+  for img_filename in (img1_filename, img2_filename):
+    fs = loadFeatures(img_filename, csv_dir, feature_params, verbose=verbose)
+    if fs is None:
+      fs = makeFeatures(img_filename, img_loader, getCalibration, csv_dir, feature_params)
+    features.append(fs)
+  pm = fromPredictedFeatures(model, params["coarse_search_radius"], features[0], features[1],
+                             params["angle_epsilon"], params["len_epsilon_sq"], scale_invariant=scale_invariant)
+  if verbose:
+    syncPrint("Found %i point matches, guided by %i coarse inliers, between:\n    %s\n    %s" % \
+              (len(pm.pointmatches), len(inliers), basename(img1_filename), basename(img2_filename)))
+
+  savePointMatches(img1_filename, img2_filename, pm.pointmatches, csv_dir, cf_params)
+  return pm.pointmatches
+
+
 def loadMatrices(name, csv_dir):
   """ Load all matrices as a list of arrays of doubles
       from a CSV file named <name>.csv """
@@ -92,6 +354,342 @@ def loadMatrices(name, csv_dir):
     syncPrint(str(sys.exc_info()))
 
 
+def seriesKey(params):
+  """ The artifactKey of the params, except for those of the incremental optimization,
+      so that matrices computed from scratch can be updated incrementally. """
+  return artifactKey({k: v for k, v in params.iteritems() if k not in INCREMENTAL_PARAM_NAMES})[:16]
+
+
+def saveSeries(name, img_filenames, matrices_name, params, csv_dir):
+  """ Record in a CSV file named <name>.series.csv that the matrices in <matrices_name>.csv
+      were computed for the img_filenames with the params (see matricesParams),
+      so that loadInitialMatrices can find them when images are added to the series or change. """
+  path = os.path.join(csv_dir, name + ".series.csv")
+  try:
+    with open(path, 'w') as csvfile:
+      w = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+      w.writerow(["params", "matrices"])
+      w.writerow([seriesKey(params), matrices_name])
+      # One row per image, in the same order as the matrices
+      w.writerow(["source"])
+      for img_filename in img_filenames:
+        w.writerow([sourceSignature(img_filename)])
+      csvfile.flush()
+      os.fsync(csvfile.fileno())
+  except:
+    syncPrint("Failed to save series at path %s" % path)
+    syncPrint(str(sys.exc_info()))
+
+
+def loadInitialMatrices(name, img_filenames, params, csv_dir):
+  """ Find the matrices last recorded with saveSeries for the series named name,
+      and return a list with, for each image in img_filenames, its matrix if the image
+      was part of the series and hasn't changed since, or None otherwise.
+      Returns None when the series doesn't exist or the matrices were computed with other params. """
+  path = os.path.join(csv_dir, name + ".series.csv")
+  if not os.path.exists(path):
+    return None
+  try:
+    with open(path, 'r') as csvfile:
+      reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+      reader.next() # skip header
+      key, matrices_name = reader.next()
+      reader.next() # skip header
+      sources = [row[0] for row in reader if row]
+  except:
+    syncPrint("Could not load series from path %s" % path)
+    syncPrint(str(sys.exc_info()))
+    return None
+  if key != seriesKey(params):
+    syncPrint("Series %s was registered with different parameters" % name)
+    return None
+  matrices = loadMatrices(matrices_name, csv_dir)
+  if not matrices or len(matrices) != len(sources):
+    return None
+  by_source = dict(izip(sources, matrices))
+  return [by_source.get(sourceSignature(img_filename), None) for img_filename in img_filenames]
+
+
+def modelFromMatrix(modelclass, matrix):
+  """ Return a new instance of modelclass fit to the affine matrix, a sequence of
+      12 values (3D) or 6 values (2D), by fitting it to the transformed corners of a cube (or square):
+      exact when the modelclass can express the matrix, e.g. a translation with a TranslationModel3D. """
+  n = 3 if 12 == len(matrix) else 2
+  pointmatches = ArrayList()
+  for corner in product([0.0, 100.0], repeat=n):
+    transformed = [sum(matrix[r * (n + 1) + c] * corner[c] for c in xrange(n)) + matrix[r * (n + 1) + n]
+                   for r in xrange(n)]
+    pointmatches.add(PointMatch(Point(array(corner, 'd')), Point(array(transformed, 'd'))))
+  model = modelclass()
+  model.fit(pointmatches)
+  return model
+
+
+def initialTiles(modelclass, initial):
+  """ Return one Tile per matrix in initial, with a model of modelclass set to the matrix,
+      or when None, to the nearest matrix in the list: a guess of the pose of added images. """
+  known = [i for i, m in enumerate(initial) if m is not None]
+  return [Tile(modelFromMatrix(modelclass, m if m is not None else initial[min(known, key=lambda k: abs(k - i))]))
+          for i, m in enumerate(initial)]
+
+
+def pairIndices(n_images, params):
+  """ The pairs of image indices to register, as (i, j) with i < j:
+      all to all when params["all_to_all"] exists and is truthy,
+      otherwise each image i with those in range(i+1, i+n) for n = params["n_adjacent"]. """
+  if params.get("all_to_all", False):
+    return list(combinations(xrange(n_images), 2))
+  n = params["n_adjacent"]
+  return [(i, i + inc) for i in xrange(n_images - n + 1) for inc in xrange(1, n)]
+
+
+def optimize(tc, params):
+  """ Optimize the pose of the tiles of the TileConfiguration tc, expecting in params
+      "maxAllowedError", "maxPlateauwidth", "maxIterations" and "damp". """
+  maxPlateauwidth = params["maxPlateauwidth"]
+  tc.optimizeSilentlyConcurrent(ErrorStatistic(maxPlateauwidth + 1), params["maxAllowedError"],
+                                params["maxIterations"], maxPlateauwidth, params["damp"])
+
+
+def modelMatrix(model, n_dims):
+  """ The matrix of an affine model of 2 or 3 dimensions, as a double[]
+      with n_dims rows of n_dims + 1 values. """
+  if 3 == n_dims:
+    a = nativeArray('d', [3, 4])
+    model.toMatrix(a) # Can't use model.toArray: different order of elements
+    return a[0] + a[1] + a[2] # Concat: flatten to 1-dimensional array
+  # BUG in TransformationModel2D.toMatrix
+  a = zeros(6, 'd')
+  model.toArray(a)
+  return array([a[0], a[2], a[4], a[1], a[3], a[5]], 'd')
+
+
+def connectTiles(tiles, links):
+  """ Connect the tiles at indices i and j with their pointmatches, for each (i, j, pointmatches) in links.
+      Returns the list of links with at least one pointmatch. """
+  connected = []
+  for i, j, pointmatches in links:
+    if not pointmatches: # None when they could not be loaded
+      syncPrint("Zero pointmatches for %i vs %i" % (i, j))
+      continue
+    tiles[i].connect(tiles[j], pointmatches) # reciprocal connection
+    connected.append((i, j, pointmatches))
+  return connected
+
+
+def solveLinear(tiles, indices, fixed_indices, links):
+  """ Fit jointly the models of the tiles at indices, except those at fixed_indices,
+      minimizing the sum of square distances between the two points of every pointmatch,
+      each transformed by the model of its tile, like TileConfiguration does. But rather than
+      iterating, solve the normal equations directly, with a Cholesky decomposition of their band matrix:
+      with the tiles in the order of their indices, the band is as wide as the largest gap between
+      the indices of two linked tiles, e.g. n_adjacent for a series of sections or timepoints.
+      Groups of linked tiles without any fixed tile are solved relative to their first tile,
+      which stays at its current pose.
+      links: a list of (i, j, pointmatches) between the tiles at indices i and j.
+      Returns False when the models are not of type TranslationModel2D, TranslationModel3D,
+      AffineModel2D or AffineModel3D, or the pointmatches don't constrain all their
+      degrees of freedom, and True otherwise. """
+  if not indices:
+    return True
+  modelclass = type(tiles[indices[0]].getModel())
+  if modelclass not in (TranslationModel2D, TranslationModel3D, AffineModel2D, AffineModel3D):
+    syncPrint("Can't solve linearly for models of type %s" % modelclass.getSimpleName())
+    return False
+  fixed = set(fixed_indices)
+  # Fix the first tile of each group of linked tiles without any fixed tile
+  group = {k: k for k in indices}
+  def root(k):
+    while group[k] != k:
+      group[k] = group[group[k]]
+      k = group[k]
+    return k
+  for i, j, _ in links:
+    if i in group and j in group:
+      ri, rj = root(i), root(j)
+      group[max(ri, rj)] = min(ri, rj) # the root is the lowest index
+  roots_fixed = set(root(k) for k in fixed if k in group)
+  fixed.update(k for k in indices if root(k) == k and k not in roots_fixed)
+  free = sorted(k for k in indices if k not in fixed)
+  if not free:
+    return True
+  n_dims = 3 if modelclass in (TranslationModel3D, AffineModel3D) else 2
+  m = n_dims + 1
+  n = m if modelclass in (AffineModel2D, AffineModel3D) else 1 # unknowns per tile and dimension
+  position = {k: p * n for p, k in enumerate(free)} # of the first unknown of each tile
+  poses = {k: modelMatrix(tiles[k].getModel(), n_dims) for k in indices}
+  def unknowns(k, r):
+    # The current values of the unknowns of dimension r of the tile at index k:
+    # a row of its affine matrix, or its translation
+    return poses[k][r * m : (r + 1) * m] if n > 1 else [poses[k][r * m + n_dims]]
+
+  links = [(i, j, pointmatches) for i, j, pointmatches in links
+           if (i in position or j in position) and i in poses and j in poses]
+  gap = max([abs(position[i] - position[j]) for i, j, _ in links if i in position and j in position] + [0])
+  size = len(free) * n
+  band = gap + n # number of stored diagonals, the main one included
+  K = zeros(size * band, 'd') # the upper band of the symmetric matrix, row by row
+  B = [zeros(size, 'd') for _ in xrange(n_dims)] # one right-hand side per dimension
+  def add(u, v, value):
+    # Store only the upper triangle
+    if v >= u:
+      K[u * band + v - u] += value
+
+  for i, j, pointmatches in links:
+    # With p in tile i and q in tile j, each extended with a 1 and for affine matrices A_i and A_j,
+    # the sum of w * |A_i p - A_j q|^2 is, per dimension r and with a_i the row r of A_i:
+    # a_i^T PP a_i - 2 a_i^T PQ a_j + a_j^T QQ a_j, with PP, PQ and QQ the sums of w * p * p^T etc.
+    pp, pq, qq = zeros(m * m, 'd'), zeros(m * m, 'd'), zeros(m * m, 'd')
+    PointMatchMoments.moments(pointmatches, m, pp, pq, qq)
+    if 1 == n:
+      # For translations t_i and t_j, the sum of w * (p + t_i - q - t_j)^2 is, per dimension r,
+      # that of the affine case with the sum of weights as PP, PQ and QQ,
+      # plus the terms of the sum of w * (q - p), which go to the right-hand side
+      shifts = [qq[r * m + n_dims] - pp[r * m + n_dims] for r in xrange(n_dims)]
+      pp = pq = qq = [pp[m * m - 1]]
+    pi = position.get(i, None)
+    pj = position.get(j, None)
+    for a in xrange(n):
+      for b in xrange(n):
+        if pi is not None:
+          add(pi + a, pi + b, pp[a * n + b])
+        if pj is not None:
+          add(pj + a, pj + b, qq[a * n + b])
+        if pi is not None and pj is not None:
+          if pi < pj:
+            add(pi + a, pj + b, -pq[a * n + b])
+          else:
+            add(pj + b, pi + a, -pq[a * n + b])
+    for r in xrange(n_dims):
+      if pj is None: # tile j is fixed
+        aj = unknowns(j, r)
+        for a in xrange(n):
+          B[r][pi + a] += sum(pq[a * n + b] * aj[b] for b in xrange(n))
+      elif pi is None: # tile i is fixed
+        ai = unknowns(i, r)
+        for b in xrange(n):
+          B[r][pj + b] += sum(pq[a * n + b] * ai[a] for a in xrange(n))
+      if 1 == n:
+        if pi is not None:
+          B[r][pi] += shifts[r]
+        if pj is not None:
+          B[r][pj] -= shifts[r]
+
+  # Cholesky decomposition K = U^T U, in place within the band
+  for u in xrange(size):
+    for v in xrange(u, min(size, u + band)):
+      s = K[u * band + v - u]
+      for k in xrange(max(0, v - band + 1), u):
+        s -= K[k * band + u - k] * K[k * band + v - k]
+      if u == v:
+        if s <= K[u * band] * 1e-12: # relative to the diagonal
+          syncPrint("Can't solve linearly: the pointmatches don't constrain all degrees of freedom")
+          return False
+        K[u * band] = sqrt(s)
+      else:
+        K[u * band + v - u] = s / K[u * band]
+  # Solve U^T y = b and then U x = y, in place, for each dimension
+  for b in B:
+    for u in xrange(size):
+      s = b[u]
+      for k in xrange(max(0, u - band + 1), u):
+        s -= K[k * band + u - k] * b[k]
+      b[u] = s / K[u * band]
+    for u in xrange(size -1, -1, -1):
+      s = b[u]
+      for v in xrange(u + 1, min(size, u + band)):
+        s -= K[u * band + v - u] * b[v]
+      b[u] = s / K[u * band]
+
+  for k in free:
+    p = position[k]
+    matrix = []
+    for r in xrange(n_dims):
+      if n > 1:
+        matrix.extend(B[r][p : p + n])
+      else:
+        matrix.extend([1.0 if c == r else 0.0 for c in xrange(n_dims)] + [B[r][p]])
+    tiles[k].getModel().set(modelFromMatrix(modelclass, matrix))
+  return True
+
+
+def optimizeTiles(tiles, indices, fixed_indices, links, params, prealign=False):
+  """ Optimize the pose of the tiles at indices, except of those at fixed_indices,
+      given the links (see connectTiles) between them.
+      When params["solver"] is "linear", use solveLinear, which is exact and much faster,
+      otherwise (the default, or when the models can't be solved linearly) use a TileConfiguration,
+      see optimize. Either way, expects the params of optimize.
+      prealign: whether to run TileConfiguration.preAlign first, which solveLinear doesn't need.
+      Returns the maximum error: the largest mean distance between the pointmatches of a tile. """
+  if "linear" == params.get("solver", None):
+    if solveLinear(tiles, indices, fixed_indices, links):
+      for k in indices:
+        tiles[k].apply()
+      max_error = 0
+      for k in indices:
+        tiles[k].updateCost()
+        max_error = max(max_error, tiles[k].getDistance())
+      return max_error
+    syncPrint("Optimizing with a TileConfiguration instead")
+  tc = TileConfiguration()
+  tc.addTiles([tiles[k] for k in indices])
+  for k in fixed_indices:
+    tc.fixTile(tiles[k])
+  if prealign:
+    syncPrint("Running TileConfiguration.preAlign")
+    tc.preAlign()
+  optimize(tc, params)
+  return tc.getMaxError()
+
+
+def optimizeIncrementally(tiles, pairs, connectPairs, changed, fixed_tile_indices, params):
+  """ Optimize the pose of the tiles near those that changed, rather than of all tiles.
+      The tiles within params["incremental_window"] indices of a changed tile are optimized,
+      while the tiles they are connected to are fixed at their pose. When the maximum error
+      of the optimized tiles exceeds params["incremental_maxError"], all tiles are connected
+      and optimized together, starting from their current pose.
+      tiles: one per image, not connected yet, with models set to their initial pose
+             (see modelFromMatrix): the prior pose for unchanged images and a guess for the others.
+      pairs: all pairs of tile indices (i, j) to connect, see pairIndices.
+      connectPairs: a function that, given a list of pairs, returns an iterable of
+                    (i, j, pointmatches) for each pair. Only called for pairs not yet connected.
+      changed: the indices of the tiles whose images or pointmatches changed.
+      fixed_tile_indices: the tiles to fix when optimizing all tiles together.
+      params: those of optimizeTiles, and "incremental_window" and "incremental_maxError".
+      Returns True when all tiles were optimized together. """
+  connected = set()
+  links = []
+  def connect(selected):
+    selected = [pair for pair in selected if pair not in connected]
+    connected.update(selected)
+    links.extend(connectTiles(tiles, connectPairs(selected)))
+  #
+  w = params["incremental_window"]
+  window = set(k for i in changed for k in xrange(max(0, i - w), min(len(tiles), i + w + 1)))
+  if not window:
+    syncPrint("No changed tiles: nothing to optimize")
+    return False
+  connect([(i, j) for i, j in pairs if i in window or j in window])
+  for tile in tiles:
+    tile.apply() # pointmatches to the initial pose
+  free = sorted(window)
+  boundary = set(k for i, j, _ in links for k in (i, j) if k not in window)
+  fixed = boundary.union(k for k in fixed_tile_indices if k in window)
+  if not fixed:
+    fixed.add(free[0])
+  syncPrint("Optimizing %i tiles around %i changed, with %i fixed tiles" % (len(free), len(changed), len(boundary)))
+  max_error = optimizeTiles(tiles, sorted(window.union(boundary)), sorted(fixed), links, params)
+  if max_error <= params["incremental_maxError"]:
+    return False
+
+  syncPrint("Maximum error %f exceeds %f: optimizing all tiles" % (max_error, params["incremental_maxError"]))
+  connect(pairs)
+  for tile in tiles:
+    tile.apply()
+  optimizeTiles(tiles, range(len(tiles)), fixed_tile_indices, links, params)
+  return True
+
+
 def computeForwardTransforms(img_filenames, img_loader, getCalibration, csv_dir, exe, modelclass, params, exe_shutdown=True):
   """ Compute transforms from image i to image i+1,
       returning an identity transform for the first image,
@@ -119,7 +717,8 @@ def computeForwardTransforms(img_filenames, img_loader, getCalibration, csv_dir,
       exe.shutdown()
 
 
-def computeOptimizedTransforms(img_filenames, img_loader, getCalibration, csv_dir, exe, modelclass, params, verbose=True):
+def computeOptimizedTransforms(img_filenames, img_loader, getCalibration, csv_dir, exe, modelclass, params, verbose=True,
+                               initial=None, changed=None):
   """ Compute transforms for all images at once,
       simultaneously considering registrations between image i to image i+1, i+2 ... i+n,
       where n is params["n_adjacent"].
@@ -133,72 +732,66 @@ def computeOptimizedTransforms(img_filenames, img_loader, getCalibration, csv_di
        * params["maxPlateauwidth"]
        * params["maxIterations"]
        * params["damp"]
+      Optionally, for a coarse-to-fine mode (see findPointMatchesCoarseToFine):
+       * params["coarse_level"]: the level of the image pyramid to first extract features from,
+                                 defaults to zero (no coarse-to-fine mode).
+       * params["coarse_search_radius"]: in calibrated units, to find matching features
+                                         near their predicted positions.
+       * the RANSAC_PARAM_NAMES, to fit a model at the coarse level,
+         and any of the POINTMATCH_PARAM_NAMES or RANSAC_PARAM_NAMES prefixed with "coarse_"
+         to override them at the coarse level (see coarseParams),
+         plus those of ransacOptions.
+      Optionally, to update prior matrices rather than optimizing all tiles from scratch:
+       * initial: a list with the prior matrix of each image, or None for images without one,
+                  e.g. from loadInitialMatrices.
+       * changed: the indices of additional images to optimize, e.g. whose pointmatches were redone.
+       * params["incremental_window"] and params["incremental_maxError"], see optimizeIncrementally.
+      Optionally, params["solver"] as "linear" to optimize with solveLinear, see optimizeTiles.
       Returns a list of affine 3D matrices, each a double[] with 12 values, corresponding to the img_filenames.
   """
-  # Ensure features exist in CSV files, or create them
-  ensureFeaturesForAll(img_filenames, img_loader, getCalibration, csv_dir, params, exe, verbose=verbose)
-  
-  # One Tile per time point
-  tiles = [Tile(modelclass()) for _ in img_filenames]
+  # Ensure features exist in CSV files, or create them,
+  # and also for the coarse level of the image pyramid, from the same loaded images
+  coarse_to_fine = params.get("coarse_level", 0) > 0
+  ensureFeaturesForAll(img_filenames, img_loader, getCalibration, csv_dir, params, exe, verbose=verbose,
+                       coarse_params=coarseParams(params, names=FEATURE_PARAM_NAMES) if coarse_to_fine else None)
   
   # Extract pointmatches from img_filename i to all in range(i+1, i+n)
   def findPointMatchesProxy(i, j):
-    pointmatches = findPointMatches(img_filenames[i], img_filenames[j],
-                                    img_loader, getCalibration, csv_dir, exe, params, verbose=verbose)
+    if coarse_to_fine:
+      pointmatches = findPointMatchesCoarseToFine(img_filenames[i], img_filenames[j], img_loader, getCalibration,
+                                                  csv_dir, exe, modelclass, params, verbose=verbose)
+    else:
+      pointmatches = findPointMatches(img_filenames[i], img_filenames[j],
+                                      img_loader, getCalibration, csv_dir, exe, params, verbose=verbose)
     return i, j, pointmatches
   #
-  futures = []
-
-  if params.get("all_to_all", False):
-    for i, j in combinations(xrange(len(img_filenames)), 2):
-      futures.append(exe.submit(Task(findPointMatchesProxy, i, j)))
-  else:
-    n = params["n_adjacent"]
-    for i in xrange(len(img_filenames) - n + 1):
-      for inc in xrange(1, n):
-        # All features were extracted already, so the 'exe' won't be used in findPointMatches
-        futures.append(exe.submit(Task(findPointMatchesProxy, i, i + inc)))
-  
-  # Join tiles with tiles for which pointmatches were computed
-  for f in futures:
-     i, j, pointmatches = f.get()
-     if 0 == len(pointmatches):
-       syncPrint("Zero pointmatches for %i vs %i" % (i, j))
-       continue
-     syncPrint("connecting tile %i with %i" % (i, j))
-     tiles[i].connect(tiles[j], pointmatches) # reciprocal connection
-  
-  # Optimize tile pose
-  tc = TileConfiguration()
-  tc.addTiles(tiles)
+  def connectPairs(pairs):
+    # All features were extracted already, so the 'exe' won't be used in findPointMatches
+    futures = [exe.submit(Task(findPointMatchesProxy, i, j)) for i, j in pairs]
+    for f in futures:
+      yield f.get()
+  #
+  pairs = pairIndices(len(img_filenames), params)
   fixed_tile_indices = params.get("fixed_tile_indices", [0]) # default: fix first tile
   syncPrint("Fixed tile indices: %s" % str(fixed_tile_indices))
-  for index in fixed_tile_indices:
-    tc.fixTile(tiles[index])
-  #
-  if TranslationModel3D != modelclass:
-    syncPrint("Running TileConfiguration.preAlign, given %s" % modelclass.getSimpleName())
-    tc.preAlign()
+
+  if initial and "incremental_window" in params and any(m is not None for m in initial):
+    tiles = initialTiles(modelclass, initial)
+    changed = set(changed or []).union(i for i, m in enumerate(initial) if m is None)
+    optimizeIncrementally(tiles, pairs, connectPairs, sorted(changed), fixed_tile_indices, params)
   else:
-    syncPrint("No prealign, model is %s" % modelclass.getSimpleName())
-  #
-  maxAllowedError = params["maxAllowedError"]
-  maxPlateauwidth = params["maxPlateauwidth"]
-  maxIterations = params["maxIterations"]
-  damp = params["damp"]
-  tc.optimizeSilentlyConcurrent(ErrorStatistic(maxPlateauwidth + 1), maxAllowedError,
-                                maxIterations, maxPlateauwidth, damp)
+    # One Tile per time point
+    tiles = [Tile(modelclass()) for _ in img_filenames]
+    # Join tiles with tiles for which pointmatches were computed
+    links = connectTiles(tiles, connectPairs(pairs))
+    # Optimize tile pose
+    optimizeTiles(tiles, range(len(tiles)), fixed_tile_indices, links, params,
+                  prealign=TranslationModel3D != modelclass)
 
   # TODO problem: can fail when there are 0 inliers
 
   # Return model matrices as double[] arrays with 12 values
-  matrices = []
-  for tile in tiles:
-    a = nativeArray('d', [3, 4])
-    tile.getModel().toMatrix(a) # Can't use model.toArray: different order of elements
-    matrices.append(a[0] + a[1] + a[2]) # Concat: flatten to 1-dimensional array
-  
-  return matrices
+  return [modelMatrix(tile.getModel(), 3) for tile in tiles]
   
 
 def asBackwardConcatTransforms(matrices, transformclass=AffineTransform3D):
@@ -0,0 +1,132 @@
+from org.objectweb.asm import ClassWriter, Opcodes, Label
+from lib.asm import CustomClassLoader
+
+
+def createNativePointMatchMomentsClass(classloader=None):
+  """ Bytecode for the class my/PointMatchMoments, see java/asm/my/PointMatchMoments.java
+      with its single static method:
+
+      moments(List<PointMatch> pointmatches, int n, double[] pp, double[] pq, double[] qq)
+
+      which adds to the n x n matrices pp, pq and qq the sums over all pointmatches
+      of w * p * p^T, w * p * q^T and w * q * q^T, with p and q the local coordinates
+      of the two points of a match, extended with a 1, and w its weight. """
+  cw = ClassWriter(ClassWriter.COMPUTE_FRAMES) # also computes maxs
+
+  cw.visit(52, Opcodes.ACC_PUBLIC + Opcodes.ACC_FINAL + Opcodes.ACC_SUPER, "my/PointMatchMoments",
+           None, "java/lang/Object", None)
+
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC, "<init>", "()V", None, None)
+  mv.visitCode()
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitMethodInsn(Opcodes.INVOKESPECIAL, "java/lang/Object", "<init>", "()V", False)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(1, 1)
+  mv.visitEnd()
+
+  # Local variables: 0: pointmatches, 1: n, 2: pp, 3: pq, 4: qq, 5: p, 6: q, 7: i, 8: size, 9: pm,
+  #                  10-11: w (double), 12: a, 13-14: wpa (double), 15-16: wqa (double), 17: b, 18: k
+  mv = cw.visitMethod(Opcodes.ACC_PUBLIC + Opcodes.ACC_STATIC + Opcodes.ACC_FINAL, "moments",
+                      "(Ljava/util/List;I[D[D[D)V", None, None)
+  mv.visitCode()
+  for index in (5, 6):
+    mv.visitVarInsn(Opcodes.ILOAD, 1)
+    mv.visitIntInsn(Opcodes.NEWARRAY, Opcodes.T_DOUBLE)
+    mv.visitVarInsn(Opcodes.ASTORE, index) # p = new double[n], q = new double[n]
+    mv.visitVarInsn(Opcodes.ALOAD, index)
+    mv.visitVarInsn(Opcodes.ILOAD, 1)
+    mv.visitInsn(Opcodes.ICONST_1)
+    mv.visitInsn(Opcodes.ISUB)
+    mv.visitInsn(Opcodes.DCONST_1)
+    mv.visitInsn(Opcodes.DASTORE) # p[n - 1] = 1.0, q[n - 1] = 1.0
+  mv.visitInsn(Opcodes.ICONST_0)
+  mv.visitVarInsn(Opcodes.ISTORE, 7) # i = 0
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitMethodInsn(Opcodes.INVOKEINTERFACE, "java/util/List", "size", "()I", True)
+  mv.visitVarInsn(Opcodes.ISTORE, 8) # size = pointmatches.size()
+  l_loop_i = Label()
+  l_return = Label()
+  mv.visitLabel(l_loop_i)
+  mv.visitVarInsn(Opcodes.ILOAD, 7)
+  mv.visitVarInsn(Opcodes.ILOAD, 8)
+  mv.visitJumpInsn(Opcodes.IF_ICMPGE, l_return) # i < size
+  mv.visitVarInsn(Opcodes.ALOAD, 0)
+  mv.visitVarInsn(Opcodes.ILOAD, 7)
+  mv.visitMethodInsn(Opcodes.INVOKEINTERFACE, "java/util/List", "get", "(I)Ljava/lang/Object;", True)
+  mv.visitTypeInsn(Opcodes.CHECKCAST, "mpicbg/models/PointMatch")
+  mv.visitVarInsn(Opcodes.ASTORE, 9) # pm = pointmatches.get(i)
+  mv.visitVarInsn(Opcodes.ALOAD, 9)
+  mv.visitMethodInsn(Opcodes.INVOKEVIRTUAL, "mpicbg/models/PointMatch", "getWeight", "()D", False)
+  mv.visitVarInsn(Opcodes.DSTORE, 10) # w = pm.getWeight()
+  for getter, index in (("getP1", 5), ("getP2", 6)):
+    mv.visitVarInsn(Opcodes.ALOAD, 9)
+    mv.visitMethodInsn(Opcodes.INVOKEVIRTUAL, "mpicbg/models/PointMatch", getter, "()Lmpicbg/models/Point;", False)
+    mv.visitMethodInsn(Opcodes.INVOKEVIRTUAL, "mpicbg/models/Point", "getL", "()[D", False)
+    mv.visitInsn(Opcodes.ICONST_0)
+    mv.visitVarInsn(Opcodes.ALOAD, index)
+    mv.visitInsn(Opcodes.ICONST_0)
+    mv.visitVarInsn(Opcodes.ILOAD, 1)
+    mv.visitInsn(Opcodes.ICONST_1)
+    mv.visitInsn(Opcodes.ISUB)
+    mv.visitMethodInsn(Opcodes.INVOKESTATIC, "java/lang/System", "arraycopy",
+                       "(Ljava/lang/Object;ILjava/lang/Object;II)V", False) # copy pm.getP1().getL() into p, etc.
+  mv.visitInsn(Opcodes.ICONST_0)
+  mv.visitVarInsn(Opcodes.ISTORE, 12) # a = 0
+  l_loop_a = Label()
+  l_next_i = Label()
+  mv.visitLabel(l_loop_a)
+  mv.visitVarInsn(Opcodes.ILOAD, 12)
+  mv.visitVarInsn(Opcodes.ILOAD, 1)
+  mv.visitJumpInsn(Opcodes.IF_ICMPGE, l_next_i) # a < n
+  for array_index, store_index in ((5, 13), (6, 15)):
+    mv.visitVarInsn(Opcodes.DLOAD, 10)
+    mv.visitVarInsn(Opcodes.ALOAD, array_index)
+    mv.visitVarInsn(Opcodes.ILOAD, 12)
+    mv.visitInsn(Opcodes.DALOAD)
+    mv.visitInsn(Opcodes.DMUL)
+    mv.visitVarInsn(Opcodes.DSTORE, store_index) # wpa = w * p[a], wqa = w * q[a]
+  mv.visitInsn(Opcodes.ICONST_0)
+  mv.visitVarInsn(Opcodes.ISTORE, 17) # b = 0
+  l_loop_b = Label()
+  l_next_a = Label()
+  mv.visitLabel(l_loop_b)
+  mv.visitVarInsn(Opcodes.ILOAD, 17)
+  mv.visitVarInsn(Opcodes.ILOAD, 1)
+  mv.visitJumpInsn(Opcodes.IF_ICMPGE, l_next_a) # b < n
+  mv.visitVarInsn(Opcodes.ILOAD, 12)
+  mv.visitVarInsn(Opcodes.ILOAD, 1)
+  mv.visitInsn(Opcodes.IMUL)
+  mv.visitVarInsn(Opcodes.ILOAD, 17)
+  mv.visitInsn(Opcodes.IADD)
+  mv.visitVarInsn(Opcodes.ISTORE, 18) # k = a * n + b
+  # pp[k] += wpa * p[b]; pq[k] += wpa * q[b]; qq[k] += wqa * q[b]
+  for matrix_index, factor_index, array_index in ((2, 13, 5), (3, 13, 6), (4, 15, 6)):
+    mv.visitVarInsn(Opcodes.ALOAD, matrix_index)
+    mv.visitVarInsn(Opcodes.ILOAD, 18)
+    mv.visitInsn(Opcodes.DUP2)
+    mv.visitInsn(Opcodes.DALOAD)
+    mv.visitVarInsn(Opcodes.DLOAD, factor_index)
+    mv.visitVarInsn(Opcodes.ALOAD, array_index)
+    mv.visitVarInsn(Opcodes.ILOAD, 17)
+    mv.visitInsn(Opcodes.DALOAD)
+    mv.visitInsn(Opcodes.DMUL)
+    mv.visitInsn(Opcodes.DADD)
+    mv.visitInsn(Opcodes.DASTORE)
+  mv.visitIincInsn(17, 1) # ++b
+  mv.visitJumpInsn(Opcodes.GOTO, l_loop_b)
+  mv.visitLabel(l_next_a)
+  mv.visitIincInsn(12, 1) # ++a
+  mv.visitJumpInsn(Opcodes.GOTO, l_loop_a)
+  mv.visitLabel(l_next_i)
+  mv.visitIincInsn(7, 1) # ++i
+  mv.visitJumpInsn(Opcodes.GOTO, l_loop_i)
+  mv.visitLabel(l_return)
+  mv.visitInsn(Opcodes.RETURN)
+  mv.visitMaxs(0, 0) # computed
+  mv.visitEnd()
+
+  cw.visitEnd()
+
+  if not classloader:
+    classloader = CustomClassLoader()
+  return classloader.defineClass("my/PointMatchMoments", cw.toByteArray())
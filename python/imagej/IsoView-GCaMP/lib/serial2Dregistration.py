@@ -44,12 +44,12 @@ from net.imglib2.converter import RealUnsignedByteConverter
 from java.awt.event import KeyAdapter, KeyEvent
 from jarray import zeros, array
 from functools import partial
-from java.util.concurrent import Executors, TimeUnit
 # From lib
-from io import readUnsignedShorts, read2DImageROI, ImageJLoader, lazyCachedCellImg, SectionCellLoader, writeN5
-from util import SoftMemoize, newFixedThreadPool, Task, RunTask, TimeItTask, ParallelTasks, numCPUs, nativeArray, syncPrint
-from features import savePointMatches, loadPointMatches
-from registration import loadMatrices, saveMatrices
+from io import readUnsignedShorts, read2DImageROI, ImageJLoader, lazyCachedCellImg, SectionCellLoader, writeN5, writeN5Multiscale
+from util import SoftMemoize, newFixedThreadPool, Task, ParallelTasks, numCPUs, nativeArray, syncPrint
+from features import savePointMatches, loadPointMatches, hasPointMatches
+from registration import loadMatrices, saveMatrices, matricesName, saveSeries, loadInitialMatrices, initialTiles, optimizeIncrementally, \
+                         connectTiles, optimizeTiles, modelMatrix
 from ui import showStack, wrap
 from converter import convert
 from pixels import autoAdjust
@@ -84,12 +84,11 @@ def extractBlockMatches(filepath1, filepath2, params, csvDir, exeload, load):
   exeload: an ExecutorService for parallel loading of image files.
   load: a function that knows how to load the image from the filepath.
 
-  return False if the CSV file already exists, True if it has to be computed.
+  return False if the pointmatches exist already, True if they have to be computed.
   """
 
-  # Skip if pointmatches CSV file exists already:
-  csvpath = os.path.join(csvDir, basename(filepath1) + '.' + basename(filepath2) + ".pointmatches.csv")
-  if os.path.exists(csvpath):
+  # Skip if pointmatches exist already, in the PointMatchStore or as a CSV file with the same params:
+  if hasPointMatches(filepath1, filepath2, csvDir, params):
     return False
 
   try:
@@ -182,9 +181,9 @@ def extractBlockMatches(filepath1, filepath2, params, csvDir, exeload, load):
                                                      Double.MAX_VALUE,
                                                      params["rod"]) # rod: ratio of best vs second best
 
-    # Store pointmatches
-    savePointMatches(os.path.basename(filepath1),
-                     os.path.basename(filepath2),
+    # Store pointmatches, keyed by the params and the image files
+    savePointMatches(filepath1,
+                     filepath2,
                      sourceMatches,
                      csvDir,
                      params)
@@ -204,13 +203,13 @@ def pointmatchingTasks(filepaths, csvDir, params, n_adjacent, exeload):
 
 
 def ensurePointMatches(filepaths, csvDir, params, n_adjacent):
-  """ If a pointmatches csv file doesn't exist, will create it. """
+  """ If the pointmatches don't exist, will create them. """
   w = ParallelTasks("ensurePointMatches", exe=newFixedThreadPool(numCPUs()))
   exeload = newFixedThreadPool()
   try:
     count = 1
     for result in w.chunkConsume(numCPUs() * 2, pointmatchingTasks(filepaths, csvDir, params, n_adjacent, exeload)):
-      if result: # is False when CSV file already exists
+      if result: # is False when the pointmatches already exist
         syncPrint("Completed %i/%i" % (count, len(filepaths) * n_adjacent))
       count += 1
     syncPrint("Awaiting all remaining pointmatching tasks to finish.")
@@ -224,8 +223,8 @@ def ensurePointMatches(filepaths, csvDir, params, n_adjacent):
 
 
 def loadPointMatchesPlus(filepaths, i, j, csvDir, params):
-  return i, j, loadPointMatches(os.path.basename(filepaths[i]),
-                                os.path.basename(filepaths[j]),
+  return i, j, loadPointMatches(filepaths[i],
+                                filepaths[j],
                                 csvDir,
                                 params,
                                 verbose=False)
@@ -254,40 +253,53 @@ def makeLinkedTiles(filepaths, csvDir, params, n_adjacent):
     pass
 
 
-def align(filepaths, csvDir, params, paramsTileConfiguration):
-  name = "matrices"
-  matrices = loadMatrices(name, csvDir)
-  if matrices:
-    return matrices
+def align(filepaths, csvDir, params, paramsTileConfiguration, changed=None):
+  """ Return one matrix per section, each a double[] with 6 values, loaded from a CSV file
+      or computed by optimizing the pose of all sections jointly and then saved.
+      When paramsTileConfiguration has "incremental_window" and "incremental_maxError",
+      and sections were added or changed since the matrices were last computed, only the sections
+      near those are optimized, see registration.optimizeIncrementally.
+      changed: the indices of additional sections to optimize, e.g. whose pointmatches were redone,
+               starting from their current matrices.
+      With paramsTileConfiguration["solver"] as "linear", solve directly rather than iterating,
+      see registration.optimizeTiles. """
+  # Matrices are keyed by the parameters of the pointmatches and of the optimization, and by the image files
+  m_params = dict(params)
+  m_params.update(paramsTileConfiguration)
+  name = matricesName("matrices", filepaths, TranslationModel2D, m_params)
+  if not changed:
+    matrices = loadMatrices(name, csvDir)
+    if matrices:
+      return matrices
   
   # Optimize
-  tiles = makeLinkedTiles(filepaths, csvDir, params, paramsTileConfiguration["n_adjacent"])
-  tc = TileConfiguration()
-  tc.addTiles(tiles)
-  tc.fixTile(tiles[len(tiles) / 2]) # middle tile
-  
-  maxAllowedError = paramsTileConfiguration["maxAllowedError"]
-  maxPlateauwidth = paramsTileConfiguration["maxPlateauwidth"]
-  maxIterations = paramsTileConfiguration["maxIterations"]
-  damp = paramsTileConfiguration["damp"]
-  tc.optimizeSilentlyConcurrent(ErrorStatistic(maxPlateauwidth + 1), maxAllowedError,
-                                maxIterations, maxPlateauwidth, damp)
+  n_adjacent = paramsTileConfiguration["n_adjacent"]
+  fixed_tile_index = len(filepaths) / 2 # middle tile
+  ensurePointMatches(filepaths, csvDir, params, n_adjacent) # only those missing
+  pairs = [(i, i + inc) for i in xrange(len(filepaths) - n_adjacent) for inc in xrange(1, n_adjacent + 1)]
+  def connectPairs(pairs):
+    for i, j in pairs:
+      yield loadPointMatchesPlus(filepaths, i, j, csvDir, params)
+  initial = None
+  if "incremental_window" in paramsTileConfiguration:
+    initial = loadInitialMatrices("matrices", filepaths, m_params, csvDir)
+  if initial and any(m is not None for m in initial):
+    tiles = initialTiles(TranslationModel2D, initial)
+    changed = set(changed or []).union(i for i, m in enumerate(initial) if m is None)
+    optimizeIncrementally(tiles, pairs, connectPairs, sorted(changed), [fixed_tile_index], paramsTileConfiguration)
+  else:
+    tiles = [Tile(TranslationModel2D()) for _ in filepaths]
+    syncPrint("Loading all pointmatches.")
+    links = connectTiles(tiles, connectPairs(pairs))
+    optimizeTiles(tiles, range(len(tiles)), [fixed_tile_index], links, paramsTileConfiguration)
 
   # TODO problem: can fail when there are 0 inliers
 
   # Return model matrices as double[] arrays with 6 values
-  matrices = []
-  for tile in tiles:
-    # BUG in TransformationModel2D.toMatrix
-    #a = nativeArray('d', [2, 3])
-    #tile.getModel().toMatrix(a)
-    #matrices.append(a[0] + a[1])
-    # Instead:
-    a = zeros(6, 'd')
-    tile.getModel().toArray(a)
-    matrices.append(array([a[0], a[2], a[4], a[1], a[3], a[5]], 'd'))
+  matrices = [modelMatrix(tile.getModel(), 2) for tile in tiles]
 
   saveMatrices(name, matrices, csvDir) # TODO check: saving correctly, now that it's 2D?
+  saveSeries("matrices", filepaths, name, m_params, csvDir)
   
   return matrices
 
@@ -433,7 +445,9 @@ def export8bitN5(filepaths,
                  CLAHE_params=[400, 256, 3.0],
                  copy_threads=2,
                  n5_threads=0, # 0 means as many as CPU cores
-                 block_size=[128,128,128]):
+                 block_size=[128,128,128],
+                 multiscale=False,
+                 cache=None):
   """
   Export into an N5 volume, in parallel, in 8-bit.
 
@@ -443,6 +457,14 @@ def export8bitN5(filepaths,
   interval: for cropping.
   gzip_compression: defaults to 6 as suggested by Saalfeld.
   block_size: defaults to 128x128x128 px.
+  multiscale: defaults to False, to write only the volume as name. If True, write the volume
+              and its area-averaging pyramid as the scale levels name/s0, name/s1, etc.
+              (see io.writeN5Multiscale), which holds in memory, in addition to the sections,
+              one slab of block_size[2] planes per level from s1 onward: about a third
+              of the width * height * block_size[2] of the volume in total.
+  cache: defaults to None, meaning a SoftRefLoaderCache for the sections.
+         Can be e.g. an io.CompressedCellCache, to keep sections evicted from memory compressed
+         instead of reloading and reprocessing them.
   """
 
   dims = Intervals.dimensionsAsLongArray(interval)
@@ -485,64 +507,17 @@ def export8bitN5(filepaths,
   loader = SectionCellLoader(filepaths, asArrayImg=partial(asNormalizedUnsignedByteArrayImg,
                                                            interval, invert, blockRadius, n_bins, slope, matrices, copy_threads))
 
-  # How to preload block_size[2] files at a time? Or at least as many as numCPUs()?
-  # One possibility is to query the SoftRefLoaderCache.map for its entries, using a ScheduledExecutorService,
-  # and preload sections ahead for the whole blockSize[2] dimension.
-
-
-  cachedCellImg = lazyCachedCellImg(loader, voldims, cell_dimensions, UnsignedByteType, BYTE)
-
-  def preload(cachedCellImg, loader, block_size, filepaths):
-    """
-    Find which is the last cell index in the cache, identify to which block
-    (given the blockSize[2] AKA Z dimension) that index belongs to,
-    and concurrently load all cells (sections) that the Z dimension of the blockSize will need.
-    If they are already loaded, these operations are insignificant.
-    """
-    exe = newFixedThreadPool(n_threads=min(block_size[2], numCPUs()), name="preloader")
-    try:
-      # The SoftRefLoaderCache.map is a ConcurrentHashMap with Long keys, aka numbers
-      cache = cachedCellImg.getCache()
-      f1 = cache.getClass().getDeclaredField("cache") # LoaderCacheAsCacheAdapter.cache
-      f1.setAccessible(True)
-      softCache = f1.get(cache)
-      cache = None
-      f2 = softCache.getClass().getDeclaredField("map") # SoftRefLoaderCache.map
-      f2.setAccessible(True)
-      keys = sorted(f2.get(softCache).keySet())
-      if 0 == len(keys):
-        return
-      first = keys[-1] - (keys[-1] % block_size[2])
-      last = max(len(filepaths), first + block_size[2] -1)
-      keys = None
-      msg = "Preloading %i-%i" % (first, first + block_size[2] -1)
-      futures = []
-      for index in xrange(first, first + block_size[2]):
-        futures.append(exe.submit(TimeItTask(softCache.get, index, loader)))
-      softCache = None
-      # Wait for all
-      count = 1
-      while len(futures) > 0:
-        r, t = futures.pop(0).get()
-        # t in miliseconds
-        if t > 500:
-          if msg:
-            syncPrint(msg)
-            msg = None
-          syncPrint("preloaded index %i in %f ms" % (first + count, t))
-        count += 1
-      if not msg: # msg was printed
-        syncPrint("Completed preloading %i-%i" % (first, first + block_size[2] -1))
-    except:
-      syncPrint(sys.exc_info())
-    finally:
-      exe.shutdown()
-
-  preloader = Executors.newSingleThreadScheduledExecutor()
-  preloader.scheduleWithFixedDelay(RunTask(preload, cachedCellImg, loader, block_size), 10, 60, TimeUnit.SECONDS)
+  # Load sections ahead, on a dedicated thread pool: all those needed for the current Z-block
+  cachedCellImg = lazyCachedCellImg(loader, voldims, cell_dimensions, UnsignedByteType, BYTE, cache=cache,
+                                    prefetch=1, block_depth=block_size[2],
+                                    n_threads=min(block_size[2], numCPUs()))
 
   try:
     syncPrint("N5 directory: " + exportDir + "\nN5 dataset name: " + name + "\nN5 blockSize: " + str(block_size))
-    writeN5(cachedCellImg, exportDir, name, block_size, gzip_compression_level=gzip_compression, n_threads=n5_threads)
+    if multiscale:
+      writeN5Multiscale(cachedCellImg, exportDir, name, block_size, gzip_compression_level=gzip_compression, n_threads=n5_threads)
+    else:
+      writeN5(cachedCellImg, exportDir, name, block_size, gzip_compression_level=gzip_compression, n_threads=n5_threads)
   finally:
-    preloader.shutdown()
+    syncPrint("Section loading: " + str(cachedCellImg.getCache().stats()))
+    cachedCellImg.getCache().close()
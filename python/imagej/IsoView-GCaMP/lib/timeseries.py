@@ -0,0 +1,284 @@
+from __future__ import with_statement
+import os, sys, csv
+from java.io import RandomAccessFile
+from java.lang import String
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
+from net.imglib2 import RealPoint
+from synchronize import make_synchronized
+from jarray import zeros, array
+from util import syncPrint
+
+
+# Binary time series store: a matrix of 32-bit floats with one row per timepoint
+# and one column per nucleus, stored row after row and mapped into memory
+# in chunks of chunk_size rows.
+#  * magic: 8 bytes, the ASCII string in TIMESERIES_MAGIC
+#  * n_nuclei: 4-byte int, the number of columns
+#  * chunk_size: 4-byte int, the number of rows per chunk
+#  * n_timepoints: 8-byte long, the number of rows written so far
+#  * 8 bytes of zero padding
+#  * n_timepoints rows of n_nuclei 32-bit floats each
+# All numbers are little-endian.
+TIMESERIES_MAGIC = "IVTSER01"
+TIMESERIES_HEADER_SIZE = 32
+
+# Peak table: the coordinates of each nucleus, one per column of a time series store.
+#  * magic: 8 bytes, the ASCII string in PEAKS_MAGIC
+#  * n_peaks: 4-byte int
+#  * n_dims: 4-byte int
+#  * n_peaks rows of n_dims 64-bit floats each
+# All numbers are little-endian.
+PEAKS_MAGIC = "IVPEAK01"
+
+
+def readTimeSeriesHeader(ra):
+  """ Read the header of the time series store open as RandomAccessFile ra.
+      Returns n_nuclei, chunk_size and n_timepoints, or None if the magic string doesn't match. """
+  if ra.length() < TIMESERIES_HEADER_SIZE:
+    return None
+  bytes = zeros(TIMESERIES_HEADER_SIZE, 'b')
+  ra.seek(0)
+  ra.readFully(bytes)
+  bb = ByteBuffer.wrap(bytes).order(ByteOrder.LITTLE_ENDIAN)
+  bmagic = zeros(8, 'b')
+  bb.get(bmagic)
+  if str(String(bmagic, "US-ASCII")) != TIMESERIES_MAGIC:
+    return None
+  n_nuclei = bb.getInt()
+  chunk_size = bb.getInt()
+  n_timepoints = bb.getLong()
+  return n_nuclei, chunk_size, n_timepoints
+
+
+class TimeSeriesWriter:
+  """ Append rows, one per timepoint, to a time series store.
+      Rows are buffered and written one chunk at a time; the number of timepoints
+      in the header is updated after every chunk, so that a reader, or a writer
+      resuming an interrupted measurement, sees only complete rows.
+      See TIMESERIES_MAGIC for the layout. """
+  def __init__(self, path, n_nuclei, chunk_size=64, resume=False):
+    """ path: the file to write to.
+        n_nuclei: the length of every row.
+        chunk_size: the number of rows to buffer before writing them to the file.
+        resume: if True and path is a time series store with n_nuclei columns,
+                append rows to it, otherwise overwrite it. """
+    self.path = path
+    self.n_nuclei = n_nuclei
+    self.ra = RandomAccessFile(path, 'rw')
+    header = readTimeSeriesHeader(self.ra) if resume else None
+    if header is not None and header[0] == n_nuclei:
+      self.chunk_size = header[1]
+      self.n_timepoints = header[2]
+    else:
+      self.chunk_size = chunk_size
+      self.n_timepoints = 0
+      self.ra.setLength(0)
+      bb = ByteBuffer.allocate(TIMESERIES_HEADER_SIZE).order(ByteOrder.LITTLE_ENDIAN)
+      bb.put(String(TIMESERIES_MAGIC).getBytes("US-ASCII"))
+      bb.putInt(n_nuclei)
+      bb.putInt(chunk_size)
+      bb.putLong(0)
+      self.ra.write(bb.array())
+    self.buffer = ByteBuffer.allocate(self.chunk_size * n_nuclei * 4).order(ByteOrder.LITTLE_ENDIAN)
+    self.fb = self.buffer.asFloatBuffer()
+    self.n_buffered = 0
+
+  @make_synchronized
+  def append(self, row):
+    """ row: a float[] (or a list of numbers) with one value per nucleus. """
+    if len(row) != self.n_nuclei:
+      raise ValueError("Expected %i values, got %i" % (self.n_nuclei, len(row)))
+    if 'f' != getattr(row, "typecode", None):
+      row = array(row, 'f')
+    self.fb.put(row)
+    self.n_buffered += 1
+    if self.n_buffered == self.chunk_size:
+      self.flush()
+
+  @make_synchronized
+  def appendBlock(self, values):
+    """ values: a float[] with consecutive rows, i.e. a multiple of n_nuclei values. """
+    if 0 == len(values):
+      return
+    if 0 == self.n_nuclei or 0 != len(values) % self.n_nuclei:
+      raise ValueError("Expected a multiple of %i values, got %i" % (self.n_nuclei, len(values)))
+    offset = 0
+    while offset < len(values):
+      n_rows = min(self.chunk_size - self.n_buffered, (len(values) - offset) / self.n_nuclei)
+      self.fb.put(values, offset, n_rows * self.n_nuclei)
+      offset += n_rows * self.n_nuclei
+      self.n_buffered += n_rows
+      if self.n_buffered == self.chunk_size:
+        self.flush()
+
+  @make_synchronized
+  def flush(self):
+    """ Write the buffered rows and update the number of timepoints in the header. """
+    if 0 == self.n_buffered:
+      return
+    self.ra.seek(TIMESERIES_HEADER_SIZE + self.n_timepoints * self.n_nuclei * 4)
+    self.ra.write(self.buffer.array(), 0, self.n_buffered * self.n_nuclei * 4)
+    self.n_timepoints += self.n_buffered
+    self.n_buffered = 0
+    self.fb.clear()
+    bb = ByteBuffer.allocate(8).order(ByteOrder.LITTLE_ENDIAN)
+    bb.putLong(self.n_timepoints)
+    self.ra.seek(16)
+    self.ra.write(bb.array())
+
+  def close(self):
+    self.flush()
+    self.ra.getFD().sync() # Ensure it's written
+    self.ra.close()
+
+
+class TimeSeries:
+  """ Read-only, memory-mapped access to a time series store, by timepoint (row),
+      by window of timepoints, or by nucleus (column).
+      Behaves like a list of float[] rows: len(ts) is the number of timepoints
+      and ts[t] a float[] with the value of every nucleus at timepoint t.
+      Only the chunks that are read are mapped into memory.
+      See TIMESERIES_MAGIC for the layout. """
+  def __init__(self, path):
+    self.path = path
+    self.ra = RandomAccessFile(path, 'r')
+    header = readTimeSeriesHeader(self.ra)
+    if header is None:
+      self.ra.close()
+      raise Exception("Not a time series store: %s" % path)
+    self.n_nuclei, self.chunk_size, self.n_timepoints = header
+    self.chunks = {} # chunk index vs FloatBuffer
+
+  @make_synchronized
+  def chunk(self, index):
+    """ The FloatBuffer with the rows of chunk index, mapped on first use. """
+    fb = self.chunks.get(index, None)
+    if fb is None:
+      first = index * self.chunk_size
+      n_rows = min(self.chunk_size, self.n_timepoints - first)
+      row_bytes = self.n_nuclei * 4
+      bb = self.ra.getChannel().map(FileChannel.MapMode.READ_ONLY,
+                                    TIMESERIES_HEADER_SIZE + first * row_bytes,
+                                    n_rows * row_bytes)
+      fb = bb.order(ByteOrder.LITTLE_ENDIAN).asFloatBuffer()
+      self.chunks[index] = fb
+    return fb
+
+  def __len__(self):
+    return self.n_timepoints
+
+  def __getitem__(self, t):
+    if t < 0:
+      t += self.n_timepoints
+    if t < 0 or t >= self.n_timepoints:
+      raise IndexError("timepoint %i out of range" % t)
+    row = zeros(self.n_nuclei, 'f')
+    fb = self.chunk(t / self.chunk_size).duplicate() # own position, for thread safety
+    fb.position((t % self.chunk_size) * self.n_nuclei)
+    fb.get(row)
+    return row
+
+  def window(self, first, last):
+    """ The rows of timepoints from first (inclusive) to last (exclusive), as a list of float[]. """
+    return [self[t] for t in xrange(max(0, first), min(last, self.n_timepoints))]
+
+  def block(self, first, last):
+    """ The rows of timepoints from first (inclusive) to last (exclusive),
+        concatenated into a single float[], copied in bulk from each chunk. """
+    first, last = max(0, first), min(last, self.n_timepoints)
+    values = zeros(max(0, last - first) * self.n_nuclei, 'f')
+    t = first
+    while t < last:
+      index = t / self.chunk_size
+      n_rows = min(last, (index + 1) * self.chunk_size) - t
+      fb = self.chunk(index).duplicate() # own position, for thread safety
+      fb.position((t % self.chunk_size) * self.n_nuclei)
+      fb.get(values, (t - first) * self.n_nuclei, n_rows * self.n_nuclei)
+      t += n_rows
+    return values
+
+  def column(self, index, first=0, last=None):
+    """ The values of nucleus index from timepoint first (inclusive) to last (exclusive), as a float[]. """
+    last = self.n_timepoints if last is None else min(last, self.n_timepoints)
+    first = max(0, first)
+    values = zeros(max(0, last - first), 'f')
+    for t in xrange(first, last):
+      values[t - first] = self.chunk(t / self.chunk_size).get((t % self.chunk_size) * self.n_nuclei + index)
+    return values
+
+  def close(self):
+    self.chunks.clear()
+    self.ra.close()
+
+
+def saveTimeSeries(path, rows, n_nuclei=None):
+  """ Write all rows, an iterable of float[] (one per timepoint), as a time series store at path.
+      n_nuclei: defaults to the length of the first row.
+      Returns a TimeSeries reading the store. """
+  writer = None
+  try:
+    for row in rows:
+      if writer is None:
+        writer = TimeSeriesWriter(path, n_nuclei if n_nuclei is not None else len(row))
+      writer.append(row)
+    if writer is None:
+      writer = TimeSeriesWriter(path, n_nuclei if n_nuclei is not None else 0)
+  finally:
+    if writer:
+      writer.close()
+  return TimeSeries(path)
+
+
+def savePeaks(path, peaks):
+  """ Write the coordinates of peaks, a list of RealLocalizable, as a peak table at path.
+      See PEAKS_MAGIC for the layout. """
+  n_dims = peaks[0].numDimensions() if peaks else 3
+  bb = ByteBuffer.allocate(8 + 4 + 4 + len(peaks) * n_dims * 8).order(ByteOrder.LITTLE_ENDIAN)
+  bb.put(String(PEAKS_MAGIC).getBytes("US-ASCII"))
+  bb.putInt(len(peaks))
+  bb.putInt(n_dims)
+  for peak in peaks:
+    for d in xrange(n_dims):
+      bb.putDouble(peak.getDoublePosition(d))
+  ra = RandomAccessFile(path, 'rw')
+  try:
+    ra.setLength(0)
+    ra.write(bb.array())
+    ra.getFD().sync()
+  finally:
+    ra.close()
+
+
+def loadPeaks(path):
+  """ Read a peak table written by savePeaks.
+      Returns a list of RealPoint, or None if path is not a peak table. """
+  ra = RandomAccessFile(path, 'r')
+  try:
+    fc = ra.getChannel()
+    bb = fc.map(FileChannel.MapMode.READ_ONLY, 0, fc.size()).order(ByteOrder.LITTLE_ENDIAN)
+    bmagic = zeros(8, 'b')
+    bb.get(bmagic)
+    if str(String(bmagic, "US-ASCII")) != PEAKS_MAGIC:
+      return None
+    n_peaks = bb.getInt()
+    n_dims = bb.getInt()
+    return [RealPoint(array((bb.getDouble() for d in xrange(n_dims)), 'd'))
+            for i in xrange(n_peaks)]
+  finally:
+    ra.close()
+
+
+def exportTimeSeriesCSV(ts, peaks, csv_path):
+  """ Write the TimeSeries ts as a CSV file with one row per timepoint
+      and a header with the coordinates of each peak as "x::y::z". """
+  try:
+    with open(csv_path, 'w') as csvfile:
+      w = csv.writer(csvfile, delimiter=",", quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+      w.writerow(["timepoint"] + ["::".join("%.2f" % peak.getDoublePosition(d) for d in xrange(peak.numDimensions()))
+                                  for peak in peaks])
+      for t in xrange(len(ts)):
+        w.writerow([t] + ts[t].tolist())
+  except:
+    syncPrint("Failed to export time series to %s" % csv_path)
+    syncPrint(str(sys.exc_info()))
@@ -1,10 +1,11 @@
 from __future__ import with_statement
 import sys, os, csv
-sys.path.append(os.path.dirname(os.path.dirname(sys.argv[0]))
+sys.path.append(os.path.dirname(os.path.dirname(sys.argv[0])))
 from lib.io import readN5
 from lib.synthetic import virtualPointsRAI
 from lib.ui import showStack, wrap, showAsComposite
 from lib.deltaFoverF import computeDeltaFOverF
+from lib.timeseries import exportTimeSeriesCSV
 from net.imglib2.view import Views
 from ij import IJ
 
@@ -67,13 +68,14 @@ params = {
 # Ignoring series 1 for now
 peaks, measurements, baselines, dFoF = computeDeltaFOverF(tgtDir, series[0], img4Da, params, mask=mask)
 
-with open(os.path.join(srcDir, "%s_deltaFoF.csv" % series[0]), 'w') as csvfile:
-  w = csv.writer(csvfile, delimiter=",", quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-  # Header: with peak coordinates
-  w.writerow(["timepoint"] + ["%.2f::%.2f::%.2f" % tuple(peak.getFloatPosition(d) for d in xrange(3)) for peak in peaks])
-  for t, row in enumerate(dFoF):
-    w.writerow([t] + row.tolist())
-
+# Measurements, baselines and dFoF are stored as .bin files in tgtDir; export dFoF as CSV too
+try:
+  exportTimeSeriesCSV(dFoF, peaks, os.path.join(srcDir, "%s_deltaFoF.csv" % series[0]))
+finally:
+  # Release the memory-mapped files, so that a later run can overwrite them
+  for ts in (measurements, baselines, dFoF):
+    if hasattr(ts, "close"): # measurements is a list when read from a CSV file
+      ts.close()
 
 # TODO: function compute deltaFOverF which reads it from a file if it exists and opens it in 3D spheres,
 #       And the 3D Viewer has additional functions to either click on a sphere to see the plot over time,
@@ -0,0 +1,23 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.features import saveFeatures, loadFeatures, exportFeaturesCSV, Constellation
+from jarray import array
+
+params = {"radius": 40, "min_angle": 0.25, "sigmaSmaller": [2.0, 3.0]}
+
+features = [Constellation(0.1 * i, 10.0 + i, 20.0 + i, array([i, i * 2, i * 3], 'd')) for i in xrange(5)]
+
+saveFeatures("img1", "/tmp/", features, params)
+
+loaded = loadFeatures("img1", "/tmp/", params)
+
+for f1, f2 in zip(features, loaded):
+  print list(f1.asRow()) == list(f2.asRow()), list(f2.asRow())
+
+# Same parameters with ints as floats: must match
+print loadFeatures("img1", "/tmp/", {"radius": 40.0, "min_angle": 0.25, "sigmaSmaller": [2, 3]}, validateOnly=True)
+
+# Different parameters: must print a mismatch and return None
+print loadFeatures("img1", "/tmp/", {"radius": 50, "min_angle": 0.25, "sigmaSmaller": [2.0, 3.0]})
+
+print exportFeaturesCSV("img1", "/tmp/", params)
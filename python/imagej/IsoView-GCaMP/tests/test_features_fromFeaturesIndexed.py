@@ -0,0 +1,35 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.features import Constellation, PointMatches, fromFeaturesIndexed
+from jarray import array
+from java.lang import System
+import random
+
+# Synthetic constellations with quantized descriptors,
+# so that many descriptor differences fall right at the epsilons
+def makeFeatures(n):
+  return [Constellation(random.randint(0, 314) * 0.01,
+                        random.randint(1, 200) * 0.5,
+                        random.randint(1, 200) * 0.5,
+                        array([random.random() * 100 for d in xrange(3)], 'd'))
+          for i in xrange(n)]
+
+features1 = makeFeatures(20000)
+features2 = makeFeatures(20000)
+
+def same(pms1, pms2):
+  return len(pms1) == len(pms2) \
+     and all(a.getP1() == b.getP1() and a.getP2() == b.getP2() for a, b in zip(pms1, pms2))
+
+for scale_invariant, angle_epsilon, len_epsilon_sq in [(False, 0.02, 1.5), (True, 0.02, 0.01)]:
+  method = PointMatches.fromFeaturesScaleInvariant if scale_invariant else PointMatches.fromFeatures
+  t0 = System.currentTimeMillis()
+  expected = method(features1, features2, angle_epsilon, len_epsilon_sq).pointmatches
+  t1 = System.currentTimeMillis()
+  for n_threads in [1, 4]:
+    t2 = System.currentTimeMillis()
+    pms = fromFeaturesIndexed(features1, features2, angle_epsilon, len_epsilon_sq,
+                              scale_invariant=scale_invariant, n_threads=n_threads).pointmatches
+    t3 = System.currentTimeMillis()
+    print "scale_invariant=%s, n_threads=%i: %i point matches, same: %s; all to all: %i ms, indexed: %i ms" % \
+      (scale_invariant, n_threads, len(pms), same(expected, pms), t1 - t0, t3 - t2)
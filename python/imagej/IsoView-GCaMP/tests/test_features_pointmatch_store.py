@@ -0,0 +1,44 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.features import savePointMatches, loadPointMatches, pointMatchStore, closePointMatchStores, paramsHash
+from lib.util import newFixedThreadPool, Task
+from mpicbg.models import Point, PointMatch
+from jarray import array
+import os
+
+directory = "/tmp/pointmatches-store-test/"
+if not os.path.exists(directory):
+  os.mkdir(directory)
+closePointMatchStores()
+if os.path.exists(os.path.join(directory, "pointmatches.db")):
+  os.remove(os.path.join(directory, "pointmatches.db"))
+
+params = {"angle_epsilon": 0.02, "len_epsilon_sq": 64}
+
+def makePointMatches(i, n):
+  return [PointMatch(Point(array([i, j, 0], 'd')), Point(array([i + 1, j, 0], 'd'))) for j in xrange(n)]
+
+# Many threads appending concurrently
+exe = newFixedThreadPool()
+try:
+  futures = [exe.submit(Task(savePointMatches, "img%i" % i, "img%i" % (i + 1), makePointMatches(i, i), directory, params))
+             for i in xrange(100)]
+  for f in futures:
+    f.get()
+finally:
+  exe.shutdown()
+
+# Reopen: the index is rebuilt from the file
+closePointMatchStores()
+
+for i in xrange(100):
+  pms = loadPointMatches("img%i" % i, "img%i" % (i + 1), directory, params, verbose=False)
+  assert i == len(pms), "Expected %i, got %i" % (i, len(pms))
+  for j, pm in enumerate(pms):
+    assert list(pm.getP1().getL()) == [i, j, 0]
+    assert list(pm.getP2().getL()) == [i + 1, j, 0]
+
+# Different params: not found
+print loadPointMatches("img1", "img2", directory, {"angle_epsilon": 0.05, "len_epsilon_sq": 64})
+
+print "Stored pairs:", len(pointMatchStore(directory).index)
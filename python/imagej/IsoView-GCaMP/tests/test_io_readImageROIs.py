@@ -0,0 +1,62 @@
+import sys, os, tempfile
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.io import readImageROIs
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from java.io import RandomAccessFile
+from java.nio import ByteBuffer, ByteOrder
+from jarray import zeros
+from itertools import izip
+import random
+
+# Synthetic 3D raw volume of unsigned shorts, after a header of 100 bytes
+dimensions = [301, 257, 17]
+header = 100
+size = dimensions[0] * dimensions[1] * dimensions[2]
+shorts = zeros(size, 'h')
+for i in xrange(size):
+  shorts[i] = i % 65535 - 32768 # wraps around as unsigned
+img = ArrayImgs.unsignedShorts(shorts, dimensions)
+
+path = os.path.join(tempfile.gettempdir(), "test_io_readImageROIs.raw")
+bb = ByteBuffer.allocate(header + size * 2).order(ByteOrder.LITTLE_ENDIAN)
+bb.position(header)
+bb.asShortBuffer().put(shorts)
+ra = RandomAccessFile(path, 'rw')
+try:
+  ra.setLength(0)
+  ra.write(bb.array())
+finally:
+  ra.close()
+
+def randomInterval(dimensions):
+  minimum = [random.randint(0, d -1) for d in dimensions]
+  maximum = [random.randint(m, min(m + 40, d -1)) for m, d in izip(minimum, dimensions)]
+  return [minimum, maximum]
+
+def check(source, imgs, intervals):
+  for roi, interval in izip(imgs, intervals):
+    expected = Views.flatIterable(Views.interval(source, interval[0], interval[1])).cursor()
+    c = Views.flatIterable(roi).cursor()
+    while c.hasNext():
+      if c.next().get() != expected.next().get():
+        return False
+  return True
+
+for memory_mapped in [False, True]:
+  # 3D, including overlapping and identical ROIs
+  intervals = [randomInterval(dimensions) for i in xrange(200)]
+  intervals.append(intervals[0])
+  imgs = readImageROIs(path, dimensions, intervals, pixelType=UnsignedShortType, header=header,
+                       memory_mapped=memory_mapped)
+  print "3D, memory_mapped=%s:" % memory_mapped, check(img, imgs, intervals)
+
+  # 2D: the first section only, read as if it were a 2D image with the same header
+  intervals = [randomInterval(dimensions[:2]) for i in xrange(200)]
+  imgs = readImageROIs(path, dimensions[:2], intervals, pixelType=UnsignedShortType, header=header,
+                       memory_mapped=memory_mapped)
+  print "2D, memory_mapped=%s:" % memory_mapped, check(Views.hyperSlice(img, 2, 0), imgs, intervals)
+
+os.remove(path)
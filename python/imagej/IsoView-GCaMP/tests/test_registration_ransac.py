@@ -0,0 +1,47 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.registration import fit
+from mpicbg.models import Point, PointMatch, TranslationModel3D, RigidModel3D
+from java.lang import System
+from jarray import array
+import random
+
+# Synthetic pointmatches: a fraction of inliers displaced by a known translation plus noise,
+# and the rest random outliers
+def pointmatches(n, inlier_ratio, translation):
+  pms = []
+  for i in xrange(n):
+    p = [random.uniform(0, 1000) for d in xrange(3)]
+    if random.random() < inlier_ratio:
+      q = [v + t + random.gauss(0, 0.5) for v, t in zip(p, translation)]
+    else:
+      q = [random.uniform(0, 1000) for d in xrange(3)]
+    pms.append(PointMatch(Point(array(p, 'd')), Point(array(q, 'd'))))
+  return pms
+
+translation = [20.0, -10.0, 5.0]
+# n_iterations, maxEpsilon, minInlierRatio, minNumInliers, maxTrust
+ransac_params = [1000, 5.0, 0.0000001, 5, 4]
+
+for modelclass in [TranslationModel3D, RigidModel3D]:
+  for inlier_ratio in [0.5, 0.1]:
+    pms = pointmatches(5000, inlier_ratio, translation)
+    for options in [{},
+                    {"confidence": 0.99},
+                    {"confidence": 0.99, "n_threads": 4},
+                    {"confidence": 0.99, "n_threads": 4, "subset_size": 200}]:
+      model = modelclass()
+      t0 = System.currentTimeMillis()
+      modelFound, inliers = fit(model, pms, *ransac_params, **options)
+      t1 = System.currentTimeMillis()
+      estimated = model.apply(array([0, 0, 0], 'd'))
+      deviation = max(abs(a - b) for a, b in zip(estimated, translation))
+      print "%s, inlier ratio %.1f, %s: found %s, %i inliers, deviation %.3f, %i ms" % \
+        (modelclass.getSimpleName(), inlier_ratio, options, modelFound, len(inliers), deviation, t1 - t0)
+
+# Very few inliers among many pointmatches: the probability of a sample of only inliers
+# is below 1e-16, and must not stop the search nor raise
+pms = pointmatches(100000, 0.00005, translation)
+model = TranslationModel3D()
+modelFound, inliers = fit(model, pms, 200, 5.0, 0.0, 3, 4, confidence=0.99, n_threads=4)
+print "Few inliers among 100000: found %s, %i inliers" % (modelFound, len(inliers))
@@ -0,0 +1,58 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.registration import connectTiles, optimizeTiles, modelMatrix
+from mpicbg.models import Tile, Point, PointMatch, TranslationModel2D, AffineModel2D, TranslationModel3D, AffineModel3D
+from java.lang import System
+from jarray import array
+import random
+
+# Pointmatches between the same random world positions in each pair of tiles of known poses,
+# each tile linked to its n_adjacent next tiles, plus noise
+def links(truth, n_dims, n_adjacent, noise):
+  ls = []
+  for i in xrange(len(truth)):
+    for j in xrange(i + 1, min(len(truth), i + n_adjacent + 1)):
+      pointmatches = []
+      for _ in xrange(50):
+        world = array([random.uniform(0, 1000) for d in xrange(n_dims)], 'd')
+        p = truth[i].applyInverse(world)
+        q = truth[j].applyInverse(world)
+        pointmatches.append(PointMatch(Point(p), Point(array([v + random.gauss(0, noise) for v in q], 'd'))))
+      ls.append((i, j, pointmatches))
+  return ls
+
+def randomModel(modelclass, n_dims):
+  model = modelclass()
+  t = [random.uniform(-50, 50) for d in xrange(n_dims)]
+  if modelclass in (TranslationModel2D, TranslationModel3D):
+    model.set(*t)
+  elif AffineModel2D == modelclass:
+    model.set(1.0 + random.uniform(-0.05, 0.05), random.uniform(-0.05, 0.05),
+              random.uniform(-0.05, 0.05), 1.0 + random.uniform(-0.05, 0.05), t[0], t[1])
+  else:
+    m = [1.0 + random.uniform(-0.05, 0.05) if r == c else random.uniform(-0.05, 0.05)
+         for r in xrange(3) for c in xrange(3)]
+    model.set(m[0], m[1], m[2], t[0], m[3], m[4], m[5], t[1], m[6], m[7], m[8], t[2])
+  return model
+
+params = {"maxAllowedError": 0, "maxPlateauwidth": 200, "maxIterations": 1000, "damp": 1.0}
+
+for modelclass, n_dims in [(TranslationModel2D, 2), (AffineModel2D, 2), (TranslationModel3D, 3), (AffineModel3D, 3)]:
+  n_tiles = 200
+  truth = [modelclass()] + [randomModel(modelclass, n_dims) for _ in xrange(n_tiles - 1)]
+  for noise in [0.0, 1.0]:
+    ls = links(truth, n_dims, 3, noise)
+    results = []
+    for solver in ["linear", "TileConfiguration"]:
+      tiles = [Tile(modelclass()) for _ in xrange(n_tiles)]
+      connected = connectTiles(tiles, ls)
+      p = dict(params)
+      p["solver"] = solver
+      t0 = System.currentTimeMillis()
+      max_error = optimizeTiles(tiles, range(n_tiles), [0], connected, p,
+                                prealign=modelclass in (AffineModel2D, AffineModel3D))
+      t1 = System.currentTimeMillis()
+      deviation = max(abs(a - b) for tile, model in zip(tiles, truth)
+                      for a, b in zip(modelMatrix(tile.getModel(), n_dims), modelMatrix(model, n_dims)))
+      results.append("%s: max error %.4f, deviation from truth %.6f, %i ms" % (solver, max_error, deviation, t1 - t0))
+    print "%s, noise %.1f:\n  %s" % (modelclass.getSimpleName(), noise, "\n  ".join(results))
@@ -0,0 +1,55 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.timeseries import TimeSeriesWriter, TimeSeries, savePeaks, loadPeaks
+from net.imglib2 import RealPoint
+from jarray import array
+import os
+
+directory = "/tmp/timeseries-test/"
+if not os.path.exists(directory):
+  os.mkdir(directory)
+path = os.path.join(directory, "test_fluorescence.bin")
+
+n_nuclei = 7
+
+def value(t, i):
+  return t * 100 + i
+
+# Write 30 timepoints in chunks of 8, with an interruption after 20
+writer = TimeSeriesWriter(path, n_nuclei, chunk_size=8)
+for t in xrange(20):
+  writer.append(array([value(t, i) for i in xrange(n_nuclei)], 'f'))
+writer.close()
+
+writer = TimeSeriesWriter(path, n_nuclei, resume=True)
+assert 20 == writer.n_timepoints
+for t in xrange(20, 30):
+  writer.append([value(t, i) for i in xrange(n_nuclei)])
+writer.close()
+
+ts = TimeSeries(path)
+assert 30 == len(ts)
+for t, row in enumerate(ts):
+  assert [value(t, i) for i in xrange(n_nuclei)] == list(row)
+assert [value(t, 3) for t in xrange(30)] == list(ts.column(3))
+assert [value(t, 5) for t in xrange(6, 17)] == list(ts.column(5, 6, 17))
+assert [[value(t, i) for i in xrange(n_nuclei)] for t in xrange(15, 30)] == [list(row) for row in ts.window(15, 40)]
+assert [value(t, i) for t in xrange(5, 21) for i in xrange(n_nuclei)] == list(ts.block(5, 21))
+
+# Append blocks of rows that straddle chunks
+path2 = os.path.join(directory, "test_block.bin")
+writer = TimeSeriesWriter(path2, n_nuclei, chunk_size=8)
+writer.appendBlock(ts.block(0, 11))
+writer.appendBlock(ts.block(11, 30))
+writer.close()
+ts2 = TimeSeries(path2)
+assert list(ts.block(0, 30)) == list(ts2.block(0, 30))
+ts2.close()
+ts.close()
+
+peaks = [RealPoint.wrap(array([i, i * 0.5, i * 0.25], 'd')) for i in xrange(n_nuclei)]
+savePeaks(os.path.join(directory, "test_peaks.bin"), peaks)
+for p1, p2 in zip(peaks, loadPeaks(os.path.join(directory, "test_peaks.bin"))):
+  assert [p1.getDoublePosition(d) for d in xrange(3)] == [p2.getDoublePosition(d) for d in xrange(3)]
+
+print "OK"